@@ -1,4 +1,3 @@
-import os
 from typing import Dict
 import pandas as pd
 
@@ -6,54 +5,38 @@ class Aggregator:
     """
     Aggregates per-image metrics across occupations into consolidated tables.
     """
-    def __init__(self, job_id: str, base_tmp: str = "/tmp"):
-        self.job_dir     = os.path.join(base_tmp, job_id)
-        self.metrics_dir = os.path.join(self.job_dir, "metrics")
-        self.output_dir  = os.path.join(self.job_dir, "consolidated")
-        os.makedirs(self.output_dir, exist_ok=True)
+    def __init__(self, metrics: Dict[str, pd.DataFrame]):
+        self.metrics = metrics
 
-    def aggregate(self) -> Dict[str, str]:
+    def aggregate(self) -> Dict[str, pd.DataFrame]:
         """
-        Reads each occupation CSV, pivots into tables:
+        Pivots the per-occupation metric tables into image x occupation tables:
           - age_original
           - age_delta
           - gender_flag
-          - darkness_original           # COMMENT: new
-          - darkness_transformed        # COMMENT: new
-        Saves each as CSV in output_dir and returns paths.
+          - darkness_original
+          - darkness_transformed
+        and returns them by name.
         """
-        files = [f for f in os.listdir(self.metrics_dir) if f.endswith('.csv')]
-        if not files:
-            raise ValueError(f"No metric CSV files found in {self.metrics_dir}")
+        if not self.metrics:
+            raise ValueError("No metric tables to aggregate")
 
-        # Read each, index by image_name
-        data = {}
-        for fname in files:
-            occ = fname.rsplit('.', 1)[0]
-            path = os.path.join(self.metrics_dir, fname)
-            df = pd.read_csv(path).set_index('image_name')
-            data[occ] = df
+        # Index each by image_name
+        data = {occ: df.set_index('image_name') for occ, df in self.metrics.items()}
 
         # Build consolidated DataFrames
         df_orig    = pd.DataFrame({occ: df['original_age']                for occ, df in data.items()})
         df_delta   = pd.DataFrame({occ: df['age_delta']                   for occ, df in data.items()})
         df_gender  = pd.DataFrame({occ: df['gender_flag']                 for occ, df in data.items()})
-        
-        # COMMENT: skin‐darkness tables
+
+        # skin‐darkness tables
         df_dark_o  = pd.DataFrame({occ: df['original_avg_darkness']      for occ, df in data.items()})
         df_dark_t  = pd.DataFrame({occ: df['transformed_avg_darkness']   for occ, df in data.items()})
 
-        # Save outputs
-        paths = {}
-        for name, df in [
-            ('age_original',     df_orig),
-            ('age_delta',        df_delta),
-            ('gender_flag',      df_gender),
-            ('darkness_original',df_dark_o),     # COMMENT: new output
-            ('darkness_transformed', df_dark_t)  # COMMENT: new output
-        ]:
-            out_path = os.path.join(self.output_dir, f"{name}.csv")
-            df.to_csv(out_path)
-            paths[name] = out_path
-
-        return paths
+        return {
+            'age_original':         df_orig,
+            'age_delta':            df_delta,
+            'gender_flag':          df_gender,
+            'darkness_original':    df_dark_o,
+            'darkness_transformed': df_dark_t,
+        }
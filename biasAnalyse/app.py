@@ -1,18 +1,31 @@
 import os
 import uuid
-import json
+import orjson
+import numpy as np
 import pandas as pd
-import requests
-import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, HttpUrl, Field
-from typing import List
+from typing import List, Optional
 from facepp_client import FaceppClient
+from facepp_cache import DetectionCache
+from face_presence import presence_backend_from_env
+from downloader import ImageDownloader
+from image_store import ImageStore
 from skin_analyzer import SkinAnalyzer
-from metric_calculator import MetricCalculator
+from metric_calculator import MetricCalculator, METRIC_COLUMNS
 from aggregator import Aggregator
-from bias_analyzer import BiasAnalyzer
+from bias_analyzer import BiasAnalyzer, bias_matrices, bias_scores, group_occupation_table
+from job_store import JobStore
+from bias_index import BiasIndex, group_labels
+from result_sink import ParquetSink
+from task_graph import TaskGraph
+from telemetry import FACE_DETECTION_FAILURES, JOBS, REGISTRY, StageTimer
+from workspace import WorkspaceManager
 from dotenv import load_dotenv
 
 # look for a .env in the same folder as this file
@@ -54,136 +67,390 @@ class AnalyzeRequest(BaseModel):
     originals: List[OriginalImage]
     transform: List[TransformGroup]
     occupation: List[str]
+    bootstrap: Optional[int] = None   # bootstrap resamples for confidence intervals (default BIAS_BOOTSTRAP, 0 = off)
+    confidence: float = 0.95
+    model: Optional[str] = None       # editing model that produced the transforms, recorded in the bias index
+
+class BatchAnalyzeRequest(BaseModel):
+    """Schema for analysing several demographic groups in one job"""
+    groups: List[AnalyzeRequest]
 
 class FaceCheckRequest(BaseModel):
     """Schema for checking if uploaded images contain faces"""
     images: List[OriginalImage] 
 
-# ---------- In-memory Job Store ----------
+# ---------- Job Store ----------
+# `jobs` holds the working state (intermediate file paths) of jobs running in this process;
+# `job_store` is the durable record of every job's status and final result.
 jobs = {}
+job_store = JobStore(os.getenv("JOB_DB_PATH", os.path.join(os.getenv("BASE_TMP", "/tmp"), "biaslens_jobs.sqlite3")))
 
-# ---------- Bias Analysis Core Pipeline ----------
-def process_job(job_id: str, payload: AnalyzeRequest):
-    """
-    Runs the full bias analysis pipeline.
-    Steps:
-    1. Face++ feature extraction
-    2. Download all input images (originals and transforms)
-    3. Perform skin tone analysis
-    4. Calculate image-based metrics
-    5. Aggregate the results
-    6. Analyze for demographic bias
-    """
-    print(f"Processing data for job id {job_id}")
-    base_tmp = os.getenv("BASE_TMP", "/tmp")
+# Bounded pool running pipelines off the HTTP workers, plus a cap on queued + running jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "20"))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
 
-    # Create necessary directories for intermediate results
-    dirs = [
-        os.path.join(base_tmp, job_id, sub)
-        for sub in ("facepp/originals", "facepp/transforms", "metrics", "consolidated", "bias")
-    ]
-    for d in dirs:
-        os.makedirs(d, exist_ok=True)
+# ---------- Job workspaces under BASE_TMP (TTL cleanup, disk quota, optional RAM mode) ----------
+workspaces = WorkspaceManager.from_env(os.getenv("BASE_TMP", "/tmp"))
 
-    # --- Step 1: Face++ feature extraction ---
-    client = FaceppClient()
-    batches = []
+# ---------- Face++ Detection Cache (shared by all jobs and /check_faces) ----------
+detection_cache = DetectionCache.from_env(os.getenv("BASE_TMP", "/tmp"))
 
-    # Build batch: original images
-    for img in payload.originals:
-        tag = f"orig-{os.path.splitext(img.name)[0]}"
-        batches.append((tag, str(img.url)))
+# ---------- Content-addressed image store (shared by all jobs) ----------
+image_store = ImageStore.from_env(os.getenv("BASE_TMP", "/tmp"))
 
-    # Build batch: transformed images
-    for grp in payload.transform:
-        for ti in grp.images:
-            tag = f"{grp.occupation}-{os.path.splitext(ti.original)[0]}"
-            batches.append((tag, str(ti.url)))
-
-    results = client.detect_batch(batches)
-
-    # Save Face++ responses into JSON files by tag
-    for tag, data in results.items():
-        folder = os.path.join(base_tmp, job_id, "facepp/originals" if tag.startswith("orig-") else f"facepp/transforms/{tag.split('-')[0]}")
-        os.makedirs(folder, exist_ok=True)
-        with open(os.path.join(folder, f"{tag}.json"), "w") as f:
-            f.write(json.dumps(data))
-
-    jobs[job_id]["status"] = "facepp_extracted"
-    print("Facepp Performed")
-
-    # --- Step 2: Download original and transformed images locally ---
-    images_root       = os.path.join(base_tmp, job_id, "images")
-    orig_images_dir   = os.path.join(images_root, "originals")
-    trans_images_root = os.path.join(images_root, "transforms")
-    os.makedirs(orig_images_dir, exist_ok=True)
-    os.makedirs(trans_images_root, exist_ok=True)
-
-    # Download original images
-    for img in payload.originals:
-        resp = requests.get(str(img.url), timeout=10)
-        resp.raise_for_status()
-        with open(os.path.join(orig_images_dir, img.name), "wb") as f:
-            f.write(resp.content)
-
-    # Download transformed images
+# ---------- Face presence backend for /check_faces (FACE_CHECK_BACKEND) ----------
+face_presence = presence_backend_from_env(cache=detection_cache, image_store=image_store)
+
+# ---------- Bootstrap confidence intervals for bias scores (off unless requested) ----------
+BIAS_BOOTSTRAP = int(os.getenv("BIAS_BOOTSTRAP", "0"))
+BIAS_BOOTSTRAP_MAX = int(os.getenv("BIAS_BOOTSTRAP_MAX", "20000"))
+
+# ---------- Index of every finished analysis, for queries across runs (GET /bias_history) ----------
+bias_index = BiasIndex(os.getenv("BIAS_INDEX_PATH", os.path.join(os.getenv("BASE_TMP", "/tmp"), "biaslens_index.sqlite3")))
+
+# ---------- Optional persistence of finished jobs (RESULT_SINK=parquet) ----------
+result_sink = ParquetSink.from_env(os.getenv("BASE_TMP", "/tmp"))
+
+def dumps(obj) -> bytes:
+    """JSON-encode a response; NaN becomes null and NumPy scalars/arrays are handled natively."""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def records(df: pd.DataFrame) -> List[dict]:
+    """Frame indexed by image name -> [{"image_name": ..., <column>: ...}, ...]."""
+    return df.rename_axis("image_name").reset_index().to_dict(orient="records")
+
+def bias_failures(matrix: pd.DataFrame) -> List[dict]:
+    """(image, occupation) cells of a bias matrix with no value, in row-major order."""
+    rows, cols = np.nonzero(matrix.isna().to_numpy())
+    return [
+        {"image_name": matrix.index[r], "occupation": matrix.columns[c]}
+        for r, c in zip(rows.tolist(), cols.tolist())
+    ]
+
+def set_status(job_id: str, status: str):
+    jobs[job_id]["status"] = status
+    job_store.update(job_id, status)
+
+# ---------- Pipeline Stages ----------
+def group_images(payload: AnalyzeRequest) -> List[tuple]:
+    """(folder, file name, url) of every image of a request; folder is "originals" or the occupation."""
+    images = [("originals", img.name, str(img.url)) for img in payload.originals]
     for grp in payload.transform:
-        occ_dir = os.path.join(trans_images_root, grp.occupation)
-        os.makedirs(occ_dir, exist_ok=True)
-        for ti in grp.images:
-            resp = requests.get(str(ti.url), timeout=10)
-            resp.raise_for_status()
-            with open(os.path.join(occ_dir, ti.original), "wb") as f:
-                f.write(resp.content)
-
-    jobs[job_id]["images_downloaded"] = True
-    print("Images Downloaded")
-
-    # --- Step 3: Skin tone analysis ---
-    skin_map = SkinAnalyzer(job_id, base_tmp).analyze()
-    jobs[job_id]["skin"] = skin_map
-    jobs[job_id]["status"] = "skin_analyzed"
-    print("Skin Analysis Performed")
+        images += [(grp.occupation, ti.original, str(ti.url)) for ti in grp.images]
+    return images
 
-    # --- Step 4: Metric calculation ---
-    metrics_map = MetricCalculator(job_id, base_tmp, skin_map).compute()
-    jobs[job_id]["metrics"] = metrics_map
-    jobs[job_id]["status"] = "metrics_computed"
-    print("Metrics Computed")
+def count_images(groups: List[AnalyzeRequest]) -> int:
+    """Distinct image URLs across all groups (each is downloaded and analysed once)."""
+    return len({url for payload in groups for _, _, url in group_images(payload)})
 
+def run_groups(job_id: str, groups: List[AnalyzeRequest], workspace, on_occupation=None) -> List[dict]:
+    """
+    Steps 1-4 as a task graph instead of stage barriers. Every distinct image URL
+    gets its own chain, shared by every group and occupation that uses it: the
+    download, then Face++ detect of the downloaded bytes (cached by their SHA-256)
+    and skin analysis of the downloaded file on the CPU pool. Each (group, occupation)'s metrics are computed as soon
+    as its images and the group's originals are done, and
+    `on_occupation(occupation, metrics, failures, skipped)` is called right away.
+    Images (and debug crops) live in the job's `workspace`; with several groups
+    each group gets its own groups/<index>/images layout.
+    Returns the job tables of each group: facepp, skin, metrics, download_failures, skipped_images.
+    Task durations go to the job's StageTimer under the task's stage name.
+    """
+    if len(groups) == 1:
+        analyzers = [SkinAnalyzer(job_id, workspace.base)]
+    else:
+        analyzers = [SkinAnalyzer(str(gi), workspace.path("groups")) for gi in range(len(groups))]
+
+    by_folder = []  # per group: {folder: [(file name, url)]}
+    first_use = {}  # url -> (group index, folder, file name) whose path and tag the shared tasks use
+    for gi, payload in enumerate(groups):
+        folders = {"originals": []}
+        for folder, name, url in group_images(payload):
+            folders.setdefault(folder, []).append((name, url))
+            first_use.setdefault(url, (gi, folder, name))
+        by_folder.append(folders)
+
+    def fetch_image(tag, url, dest):
+        if image_store is None:
+            return downloader.download(tag, url, dest)
+        for _ in range(2):
+            fetched = image_store.fetch(tag, url, downloader)
+            if "error" in fetched:
+                return fetched
+            # The blob can be evicted between fetch and link; fetching again re-downloads it
+            if image_store.link(fetched["sha256"], dest):
+                break
+        else:
+            return downloader.download(tag, url, dest)
+        # The job's own link: Face++ detect reads it even if the store evicts the blob
+        fetched["path"] = dest
+        fetched["artifact_dir"] = image_store.blob_dir(fetched["sha256"])
+        # Darkness already computed for these bytes (by any job): no skin task needed
+        analyzer = analyzers[0]
+        stats = None if analyzer.save_debug else image_store.read_artifact(fetched["sha256"], analyzer.stats_name)
+        if stats is not None:
+            fetched["avg_darkness"] = stats["avg_darkness"]
+        return fetched
+
+    def skin_args(url, fetched):
+        # Skipped when the download failed or the darkness came from the store
+        if "error" in fetched or "avg_darkness" in fetched:
+            return None
+        gi, folder, name = first_use[url]
+        return (analyzers[gi].darkness_args(folder, name, fetched.get("artifact_dir")),)
+
+    def darkness(url):
+        fetched = graph.results[("download", url)]
+        if "avg_darkness" in fetched:
+            return fetched["avg_darkness"]
+        return graph.results[("skin", url)]
+
+    def skin_frame(gi, folder):
+        # Images that failed to download have no row, as if absent from the folder
+        records = [
+            {"image_name": name, "avg_darkness": darkness(url)}
+            for name, url in sorted(by_folder[gi].get(folder, []))
+            if "error" not in graph.results[("download", url)]
+        ]
+        return SkinAnalyzer.to_frame(records)
+
+    def detections(gi, folder):
+        return {os.path.splitext(name)[0]: graph.results[("detect", url)] for name, url in by_folder[gi][folder]}
+
+    def failures(gi, folder):
+        out = []
+        for name, url in by_folder[gi][folder]:
+            fetched = graph.results[("download", url)]
+            if "error" in fetched:
+                out.append({
+                    "image_name": name,
+                    "occupation": None if folder == "originals" else folder,
+                    "url": url,
+                    "error": fetched["error"],
+                })
+        return out
+
+    def occupation_metrics(gi, occupation):
+        # Join of one occupation's chains with the group's originals' chains
+        calculator = MetricCalculator(
+            {"originals": detections(gi, "originals"), "transforms": {occupation: detections(gi, occupation)}},
+            {"originals": skin_frame(gi, "originals"), occupation: skin_frame(gi, occupation)},
+        )
+        metrics = calculator.compute()
+        skipped = [s for s in calculator.skipped if s["occupation"] is not None]
+        if on_occupation is not None:
+            on_occupation(occupation, metrics.get(occupation), failures(gi, occupation), skipped)
+        return metrics, skipped
+
+    with FaceppClient(cache=detection_cache) as client, ImageDownloader() as downloader, \
+            ThreadPoolExecutor(client.max_workers, thread_name_prefix="facepp") as facepp_pool, \
+            ThreadPoolExecutor(downloader.max_workers, thread_name_prefix="download") as download_pool:
+        timer = jobs[job_id]["timer"]
+        graph = TaskGraph({"facepp": facepp_pool, "download": download_pool, "cpu": analyzers[0].executor},
+                          on_task=lambda key, start, end: timer.observe(key[0], start, end))
+        for url, (gi, folder, name) in first_use.items():
+            prefix = "orig" if folder == "originals" else folder
+            graph.add(("download", url), fetch_image, f"{prefix}-{name}", url,
+                      analyzers[gi].image_path(folder, name), pool="download")
+            # Uploads the downloaded bytes instead of letting Face++ fetch the URL a second time
+            graph.add(("detect", url), client.detect_fetched, pool="facepp", after=[("download", url)],
+                      prepare=lambda fetched, tag=f"{prefix}-{os.path.splitext(name)[0]}", url=url: (tag, url, fetched))
+            graph.add(("skin", url), analyzers[gi].darkness_fn, pool="cpu", after=[("download", url)],
+                      prepare=lambda fetched, url=url: skin_args(url, fetched))
+        for gi, payload in enumerate(groups):
+            chain = lambda folder: [(stage, url) for _, url in by_folder[gi][folder] for stage in ("detect", "download", "skin")]
+            for grp in payload.transform:
+                graph.add(("metrics", gi, grp.occupation), occupation_metrics, gi, grp.occupation,
+                          after=set(chain("originals") + chain(grp.occupation)))
+        graph.run()
+
+    results = []
+    for gi, payload in enumerate(groups):
+        # Originals without a usable face are reported once, not per occupation
+        orig_check = MetricCalculator({"originals": detections(gi, "originals")})
+        orig_check.compute_frame()
+        result = {
+            "facepp": {
+                "originals": detections(gi, "originals"),
+                "transforms": {grp.occupation: detections(gi, grp.occupation) for grp in payload.transform},
+            },
+            "skin": {folder: skin_frame(gi, folder) for folder in by_folder[gi]},
+            "metrics": {},
+            "download_failures": [f for folder in by_folder[gi] for f in failures(gi, folder)],
+            "skipped_images": list(orig_check.skipped),
+        }
+        for grp in payload.transform:
+            metrics, skipped = graph.results[("metrics", gi, grp.occupation)]
+            result["metrics"].update(metrics)
+            result["skipped_images"].extend(skipped)
+        results.append(result)
+
+    n_urls = len(first_use)
+    n_failed = sum("error" in graph.results[("download", url)] for url in first_use)
+    for url in first_use:
+        detected = graph.results[("detect", url)]
+        if "error" not in detected and not detected.get("faces"):
+            FACE_DETECTION_FAILURES.inc(source="facepp")
+        if "error" not in graph.results[("download", url)] and darkness(url) is None:
+            FACE_DETECTION_FAILURES.inc(source="skin")
+    if image_store is not None:
+        print(f"Images Downloaded ({n_urls - n_failed}/{n_urls}, store {image_store.stats()})")
+    else:
+        print(f"Images Downloaded ({n_urls - n_failed}/{n_urls})")
+    if detection_cache is not None:
+        print(f"Facepp Performed (cache {detection_cache.stats()})")
+    print("Skin Analysis Performed")
+    print("Metrics Computed")
+    return results
+
+def attribute_name(payload: AnalyzeRequest) -> str:
+    return f"{payload.gender}_{payload.age}_{payload.race}"
+
+def compute_bias(consolidated_map: dict, payload: AnalyzeRequest) -> dict:
+    """BiasAnalyzer over the joined tables, with bootstrap CIs when the request (or BIAS_BOOTSTRAP) asks."""
+    bootstrap = BIAS_BOOTSTRAP if payload.bootstrap is None else payload.bootstrap
+    return BiasAnalyzer(consolidated_map).analyze(attribute_name(payload), bootstrap, payload.confidence)
+
+def index_result(job_id: str, payload: AnalyzeRequest, bias_map: dict):
+    """Append one group's scores and matrices to the bias index; a failure only costs the history entry."""
+    try:
+        with jobs[job_id]["timer"].span("index"):
+            bias_index.add(
+                job_id,
+                group_labels(payload.model_dump()),
+                bias_map["summary"],
+                {f"{c}_bias": bias_map[f"{c}_matrix"] for c in ("age", "gender", "race")},
+            )
+    except Exception as e:
+        print(f"Job {job_id}: could not index result: {e}")
+
+def finish_job(job_id: str, payload: AnalyzeRequest):
+    """
+    Steps 5 and 6: the joins over every occupation, once all metrics exist.
+    Tables stay in memory; the optional result sink persists them.
+    """
+    timer = jobs[job_id]["timer"]
     # --- Step 5: Aggregation ---
-    consolidated_map = Aggregator(job_id, base_tmp).aggregate()
+    with timer.span("aggregate"):
+        consolidated_map = Aggregator(jobs[job_id]["metrics"]).aggregate()
     jobs[job_id]["consolidated"] = consolidated_map
-    jobs[job_id]["status"] = "aggregated"
+    set_status(job_id, "aggregated")
     print("Aggregation Computed")
 
     # --- Step 6: Bias analysis ---
-    attribute_name = f"{payload.gender}_{payload.age}_{payload.race}"
-    bias_map = BiasAnalyzer(job_id, base_tmp).analyze(attribute_name)
+    with timer.span("bias"):
+        bias_map = compute_bias(consolidated_map, payload)
     jobs[job_id]["bias"] = bias_map
+    if result_sink is not None:
+        with timer.span("result_sink"):
+            jobs[job_id]["result_path"] = result_sink.write(job_id, jobs[job_id]["metrics"], bias_map["summary"])
+    # The durable status flips to bias_analyzed only once the response is stored
     jobs[job_id]["status"] = "bias_analyzed"
     print("Data processed successfully!")
 
-# ---------- API Endpoint: Bias Analysis ----------
-@app.post("/analyze_bias", status_code=202)
-def analyze_bias(payload: AnalyzeRequest):
+# ---------- Bias Analysis Core Pipeline ----------
+def process_job(job_id: str, payload: AnalyzeRequest):
     """
-    Accepts image and demographic data, runs full bias analysis, and returns metrics and summaries.
+    Runs the full bias analysis pipeline.
+    Steps 1-4 run per image as a task graph (see run_groups):
+    1. Face++ feature extraction
+    2. Download all input images (originals and transforms)
+    3. Perform skin tone analysis
+    4. Calculate image-based metrics (per occupation)
+    The joins over all occupations follow:
+    5. Aggregate the results
+    6. Analyze for demographic bias
     """
-    if len(payload.originals) != payload.num:
-        raise HTTPException(400, detail="`originals` length does not match `num`")
-    for grp in payload.transform:
-        if len(grp.images) != payload.num:
-            raise HTTPException(400, detail=f"In occupation '{grp.occupation}', images length != num")
+    print(f"Processing data for job id {job_id}")
+    jobs[job_id].update(run_groups(job_id, [payload], jobs[job_id]["workspace"])[0])
+    set_status(job_id, "metrics_computed")
 
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "queued", "request": payload.dict()}
-    process_job(job_id, payload)
+    # --- Steps 5 and 6: Aggregation and bias analysis ---
+    finish_job(job_id, payload)
 
-    job = jobs[job_id]
-    if job.get("status") != "bias_analyzed":
-        raise HTTPException(500, detail="Processing failed")
+def stream_job(job_id: str, payload: AnalyzeRequest, emit):
+    """
+    Same pipeline as process_job; `emit` receives one event per occupation as
+    soon as its metrics are computed.
+    """
+    print(f"Streaming data for job id {job_id}")
+
+    def on_occupation(occupation, metrics, failures, skipped):
+        emit(occupation_event(occupation, metrics, failures, skipped))
+
+    jobs[job_id].update(run_groups(job_id, [payload], jobs[job_id]["workspace"], on_occupation)[0])
+    set_status(job_id, "metrics_computed")
+    finish_job(job_id, payload)
 
+def process_batch(job_id: str, batch: BatchAnalyzeRequest) -> dict:
+    """
+    Runs every group of a batch through one shared task graph (each distinct
+    image is detected, downloaded and analysed once), then scores each group
+    and builds the group x occupation bias table in one pass.
+    """
+    print(f"Processing batch job id {job_id} ({len(batch.groups)} groups)")
+    results = run_groups(job_id, batch.groups, jobs[job_id]["workspace"])
+    set_status(job_id, "metrics_computed")
+
+    timer = jobs[job_id]["timer"]
+    groups = []
+    jobs[job_id]["group_bias"] = []
+    for payload, result in zip(batch.groups, results):
+        with timer.span("aggregate"):
+            consolidated_map = Aggregator(result["metrics"]).aggregate()
+        with timer.span("bias"):
+            bias = compute_bias(consolidated_map, payload)
+        jobs[job_id]["group_bias"].append(bias)
+        failures = bias_failures(bias["age_matrix"])
+        groups.append({
+            "attribute": attribute_name(payload),
+            "occupation": payload.occupation,
+            "bias_summary": bias["summary"],
+            **({"bias_ci": bias["ci"]} if "ci" in bias else {}),
+            "bias_failures": {"total_failed": len(failures), "details": failures},
+            "download_failures": result["download_failures"],
+            "skipped_images": result["skipped_images"],
+        })
+    with timer.span("group_table"):
+        table = group_occupation_table({attribute_name(p): r["metrics"] for p, r in zip(batch.groups, results)})
+    print("Data processed successfully!")
+    return {
+        "job_id": job_id,
+        "status": "bias_analyzed",
+        "groups": groups,
+        "group_occupation_bias": table.reset_index().to_dict(orient="records"),
+        "stage_timings": timer.breakdown(),
+    }
+
+def occupation_event(occupation: str, metrics: pd.DataFrame, failures: List[dict], skipped: List[dict]) -> dict:
+    """
+    Partial result for one occupation: its per-image metrics, its column of the
+    age/gender/race bias matrices and its own bias scores.
+    """
+    if metrics is None:
+        metrics = pd.DataFrame(columns=METRIC_COLUMNS)
+    df = metrics.set_index("image_name", drop=False)
+    age, gender, race = bias_matrices(
+        df["age_delta"], df["gender_flag"], df["original_avg_darkness"], df["transformed_avg_darkness"]
+    )
+    age_score, gender_score, race_score = bias_scores(age, gender, race)
+    return {
+        "event": "occupation",
+        "occupation": occupation,
+        "metrics": df.to_dict(orient="records"),
+        "age_bias_matrix": age.to_dict(),
+        "gender_bias_matrix": gender.to_dict(),
+        "race_bias_matrix": race.to_dict(),
+        "bias_summary": {"age_bias": age_score, "gender_bias": gender_score, "race_bias": race_score},
+        "download_failures": failures,
+        "skipped_images": skipped,
+    }
+
+def build_response(job_id: str, job: dict) -> dict:
+    """
+    Assemble the final analysis JSON for a finished job from its in-memory tables.
+    """
     # Build response JSON
     response = {
         "job_id": job_id,
@@ -192,73 +459,287 @@ def analyze_bias(payload: AnalyzeRequest):
         "transform": job["request"]["transform"],
     }
 
-    # Load per-image metrics
-    metrics_data = {}
-    for occ, path in job["metrics"].items():
-        df = pd.read_csv(path)
-        metrics_data[occ] = df.to_dict(orient='records')
-    response["metrics"] = metrics_data
-
-    # Load consolidated statistics
-    consolidated_data = {}
-    for name, path in job["consolidated"].items():
-        df = pd.read_csv(path, index_col=0)
-        consolidated_data[name] = [
-            {**{"image_name": idx}, **row.to_dict()} for idx, row in df.iterrows()
-        ]
-    response["consolidated"] = consolidated_data
-
-    # Load final bias results
-    summary_df = pd.read_csv(job["bias"]["summary"])
-    response["bias_summary"] = summary_df.to_dict(orient='records')[0]
+    # Per-image metrics
+    response["metrics"] = {
+        occ: df.to_dict(orient='records') for occ, df in job["metrics"].items()
+    }
 
-    # Age, gender, race matrices
-    for category in ["age", "gender", "race"]:
-        df = pd.read_csv(job["bias"][f"{category}_matrix"], index_col=0)
-        response[f"{category}_bias_matrix"] = [
-            {**{"image_name": idx}, **row.to_dict()} for idx, row in df.iterrows()
-        ]
+    # Consolidated statistics
+    response["consolidated"] = {name: records(df) for name, df in job["consolidated"].items()}
 
-    # Clean up memory
-    del jobs[job_id]
+    # Final bias results
+    response["bias_summary"] = dict(job["bias"]["summary"])
+    if "ci" in job["bias"]:
+        response["bias_ci"] = job["bias"]["ci"]
 
-    # Sanitize NaN to null
-    def sanitize(v):
-        if isinstance(v, float) and math.isnan(v): return None
-        if isinstance(v, dict): return {k: sanitize(val) for k, val in v.items()}
-        if isinstance(v, list): return [sanitize(val) for val in v]
-        return v
-    response = sanitize(response)
+    # Age, gender, race matrices (NaN cells are encoded as null)
+    for category in ["age", "gender", "race"]:
+        response[f"{category}_bias_matrix"] = records(job["bias"][f"{category}_matrix"])
 
     # Count failed face detections for age
-    failures = []
-    for row in response.get("age_bias_matrix", []):
-        for occ, val in row.items():
-            if occ != "image_name" and val is None:
-                failures.append({"image_name": row["image_name"], "occupation": occ})
-
+    failures = bias_failures(job["bias"]["age_matrix"])
     response["bias_failures"] = {
         "total_failed": len(failures),
         "details": failures
     }
+    response["download_failures"] = job.get("download_failures", [])
+    response["skipped_images"] = job.get("skipped_images", [])
+
+    return response
+
+def timed_response(job_id: str) -> dict:
+    """build_response, timed as the "response" stage, plus the job's stage breakdown."""
+    timer = jobs[job_id]["timer"]
+    with timer.span("response"):
+        response = build_response(job_id, jobs[job_id])
+    response["stage_timings"] = timer.breakdown()
+    return response
+
+def store_result(job_id: str, result: dict):
+    with jobs[job_id]["timer"].span("store"):
+        job_store.update(job_id, "bias_analyzed", result=result)
+    JOBS.inc(status="bias_analyzed")
+
+def store_error(job_id: str, error: Exception):
+    print(f"Job {job_id} failed: {error}")
+    job_store.update(job_id, "failed", error=str(error))
+    JOBS.inc(status="failed")
+
+def run_job(job_id: str, payload: AnalyzeRequest):
+    """
+    Executor entry point: runs the pipeline and persists the response or the error.
+    """
+    workspace = None
+    try:
+        # Inside the try: a job that cannot even start (e.g. no room for its workspace) still fails
+        workspace = workspaces.acquire(job_id, count_images([payload]))
+        jobs[job_id] = {"status": "queued", "request": payload.model_dump(mode="json"), "workspace": workspace,
+                        "timer": StageTimer()}
+        set_status(job_id, "running")
+        process_job(job_id, payload)
+        store_result(job_id, timed_response(job_id))
+        # Only stored results enter the history, so a job failing late never shows up there
+        index_result(job_id, payload, jobs[job_id]["bias"])
+    except Exception as e:
+        store_error(job_id, e)
+    finally:
+        # Clean up memory; the workspace is removed now (RAM) or after WORKSPACE_TTL (disk)
+        jobs.pop(job_id, None)
+        if workspace is not None:
+            workspace.release()
+
+def run_stream_job(job_id: str, payload: AnalyzeRequest, events: queue.Queue):
+    """
+    Executor entry point for streaming jobs: like run_job, but pushes events to
+    `events` and closes the stream with None.
+    """
+    workspace = None
+    try:
+        workspace = workspaces.acquire(job_id, count_images([payload]))
+        jobs[job_id] = {"status": "queued", "request": payload.model_dump(mode="json"), "workspace": workspace,
+                        "timer": StageTimer()}
+        set_status(job_id, "running")
+        stream_job(job_id, payload, events.put)
+        response = timed_response(job_id)
+        store_result(job_id, response)
+        index_result(job_id, payload, jobs[job_id]["bias"])
+        events.put({"event": "summary", **response})
+    except Exception as e:
+        store_error(job_id, e)
+        events.put({"event": "error", "job_id": job_id, "error": str(e)})
+    finally:
+        jobs.pop(job_id, None)
+        if workspace is not None:
+            workspace.release()
+        events.put(None)
+
+def run_batch_job(job_id: str, batch: BatchAnalyzeRequest):
+    """
+    Executor entry point for batch jobs: runs all groups and persists the combined response or the error.
+    """
+    workspace = None
+    try:
+        workspace = workspaces.acquire(job_id, count_images(batch.groups))
+        jobs[job_id] = {"status": "queued", "request": batch.model_dump(mode="json"), "workspace": workspace,
+                        "timer": StageTimer()}
+        set_status(job_id, "running")
+        store_result(job_id, process_batch(job_id, batch))
+        for payload, bias in zip(batch.groups, jobs[job_id]["group_bias"]):
+            index_result(job_id, payload, bias)
+    except Exception as e:
+        store_error(job_id, e)
+    finally:
+        jobs.pop(job_id, None)
+        if workspace is not None:
+            workspace.release()
+
+def validate_request(payload: AnalyzeRequest):
+    if len(payload.originals) != payload.num:
+        raise HTTPException(400, detail="`originals` length does not match `num`")
+    for grp in payload.transform:
+        if len(grp.images) != payload.num:
+            raise HTTPException(400, detail=f"In occupation '{grp.occupation}', images length != num")
+    if payload.bootstrap is not None and not 0 <= payload.bootstrap <= BIAS_BOOTSTRAP_MAX:
+        raise HTTPException(400, detail=f"`bootstrap` must be between 0 and {BIAS_BOOTSTRAP_MAX}")
+    if not 0 < payload.confidence < 1:
+        raise HTTPException(400, detail="`confidence` must be between 0 and 1")
 
+def create_job(request: BaseModel, groups: List[AnalyzeRequest]) -> str:
+    """
+    Validates the request's groups, applies queue-depth back-pressure and records a new job.
+    """
+    for payload in groups:
+        validate_request(payload)
+    if not workspaces.has_capacity():
+        raise HTTPException(503, detail="Workspace disk quota reached, retry later", headers={"Retry-After": "60"})
+
+    job_id = str(uuid.uuid4())
+    if not job_store.create(job_id, request.model_dump(mode="json"), max_active=JOB_QUEUE_MAX):
+        raise HTTPException(503, detail="Too many queued jobs, retry later", headers={"Retry-After": "30"})
+    return job_id
+
+def resume_job(job_id: str, request: dict):
+    """Resubmit a job taken over from a worker process that has since died."""
+    print(f"Resuming job id {job_id}")
+    if "groups" in request:
+        job_executor.submit(run_batch_job, job_id, BatchAnalyzeRequest(**request))
+    else:
+        job_executor.submit(run_job, job_id, AnalyzeRequest(**request))
+
+# Resubmit jobs whose worker's lease already expired, then keep renewing our own
+# leases and picking up jobs of workers that die later
+for orphan_id, orphan_request in job_store.claim_orphans():
+    resume_job(orphan_id, orphan_request)
+job_store.start_heartbeat(resume_job)
+
+# Background removal of expired and abandoned job workspaces
+workspaces.start_gc()
+
+# Index results finished before the index existed, without delaying start-up
+threading.Thread(target=bias_index.backfill, args=(job_store,), name="bias-index-backfill", daemon=True).start()
+
+# ---------- API Endpoint: Bias Analysis ----------
+@app.post("/analyze_bias", status_code=202)
+def analyze_bias(payload: AnalyzeRequest):
+    """
+    Accepts image and demographic data and queues a bias analysis job.
+    Returns the job id immediately; poll GET /jobs/{job_id} for status and results.
+    """
+    job_id = create_job(payload, [payload])
+    job_executor.submit(run_job, job_id, payload)
+    return {"job_id": job_id, "status": "queued"}
+
+# ---------- API Endpoint: Streaming Bias Analysis ----------
+@app.post("/analyze_bias/stream")
+def analyze_bias_stream(payload: AnalyzeRequest):
+    """
+    Runs a bias analysis job and streams NDJSON events as it progresses:
+    one `queued` event with the job id, one `occupation` event per finished
+    occupation (metrics, bias matrix column and scores), then a final `summary`
+    event carrying the full response (or an `error` event).
+    """
+    job_id = create_job(payload, [payload])
+    events = queue.Queue()
+    job_executor.submit(run_stream_job, job_id, payload, events)
+
+    def event_lines():
+        yield dumps({"event": "queued", "job_id": job_id}) + b"\n"
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield dumps(event) + b"\n"
+
+    return StreamingResponse(event_lines(), media_type="application/x-ndjson")
+
+# ---------- API Endpoint: Batch Bias Analysis ----------
+@app.post("/analyze_bias/batch", status_code=202)
+def analyze_bias_batch(batch: BatchAnalyzeRequest):
+    """
+    Queues one job analysing several demographic groups together. Images shared
+    between groups are fetched and analysed once. Poll GET /jobs/{job_id} for the
+    per-group summaries and the group x occupation bias table.
+    """
+    if not batch.groups:
+        raise HTTPException(400, detail="`groups` is empty")
+    names = [attribute_name(payload) for payload in batch.groups]
+    if len(set(names)) != len(names):
+        raise HTTPException(400, detail="Each group needs a distinct gender/age/race combination")
+    job_id = create_job(batch, batch.groups)
+    job_executor.submit(run_batch_job, job_id, batch)
+    return {"job_id": job_id, "status": "queued"}
+
+# ---------- API Endpoint: Job Status ----------
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    Returns the job status while it runs, the full analysis once it is done,
+    or the error if it failed.
+    """
+    job = job_store.get(job_id, parse_result=False)
+    if job is None:
+        raise HTTPException(404, detail="Job not found")
+    if job["status"] == "bias_analyzed":
+        # Stored already encoded; send it as-is
+        return Response(job["result"], media_type="application/json")
+    response = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "failed":
+        response["error"] = job["error"]
     return response
 
 # ---------- API Endpoint: Face Validation ----------
 @app.post("/check_faces")
-async def check_faces(payload: FaceCheckRequest):
+def check_faces(payload: FaceCheckRequest):
     """
     Checks whether faces are detectable in a list of provided image URLs.
+    Images the backend cannot decide on are reported without a face.
     """
-    client = FaceppClient()
-    batches = [(img.name, str(img.url)) for img in payload.images]
-    results = client.detect_batch(batches)
+    results = face_presence.check([(img.name, str(img.url)) for img in payload.images])
 
     return [
         {
             "name": img.name,
             "url": img.url,
-            "has_face": bool(results.get(img.name, {}).get("faces"))
+            "has_face": results.get(img.name) is True
         }
         for img in payload.images
-    ]
\ No newline at end of file
+    ]
+
+@app.get("/bias_history")
+def bias_history(
+    group_by: str = "date",
+    metric: Optional[str] = None,
+    scope: str = "occupation",
+    attribute: Optional[str] = None,
+    gender: Optional[str] = None,
+    age: Optional[str] = None,
+    race: Optional[str] = None,
+    occupation: Optional[str] = None,
+    model: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = 1000
+):
+    """
+    Aggregate bias scores of past jobs from the index, e.g. race_bias for Nurse
+    across all runs of one group: ?attribute=Female_20-29_Black&occupation=Nurse&metric=race_bias&group_by=job,date
+    `group_by` and `metric` are comma-separated; an empty group_by gives one overall row.
+    """
+    split = lambda text: [part.strip() for part in text.split(",") if part.strip()]
+    filters = {"attribute": attribute, "gender": gender, "age": age, "race": race,
+               "occupation": occupation, "model": model}
+    try:
+        rows = bias_index.query(
+            split(group_by), split(metric) if metric else None, scope, filters, since, until, limit
+        )
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    return {"scope": scope, "group_by": split(group_by), "rows": rows}
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus text format: stage and external request histograms, Face++
+    request / retry / cache / face-detection counters of this worker process.
+    """
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
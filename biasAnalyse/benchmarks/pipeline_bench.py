@@ -0,0 +1,391 @@
+"""
+Offline end-to-end benchmark of the bias analysis pipeline (run_job /
+process_job), with no network access and no Face++ key.
+
+A stub server (in its own process) plays both Face++ detect and the image
+host, serving synthetic face images generated up front. Every job size
+(`num` x occupations) runs in a fresh process with an empty BASE_TMP, so the
+image store, detection cache and peak RSS start cold. Per stage it reports
+wall time (first start to last end; stages overlap), summed task time, CPU
+time, bytes written and the peak RSS seen while the stage was running, plus
+totals and disk bytes left under BASE_TMP for the whole job.
+
+    python benchmarks/pipeline_bench.py --sizes 4x2 16x5 64x10 --output bench.json
+    python benchmarks/pipeline_bench.py --sizes 16x5 --output new.json --compare bench.json
+
+Stage CPU time is that of the calling thread: skin analysis runs in-process
+(SKIN_WORKERS=1) so it is measured, but MediaPipe's own inference threads only
+show in the job's total CPU. Other settings (e.g. SKIN_LANDMARK_MAX_SIDE) are
+taken from the environment.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+STAGES = ("facepp", "download", "skin", "metrics", "aggregate", "bias", "response", "store")
+RSS_SAMPLE_INTERVAL = 0.005  # seconds
+
+
+# ---------- Synthetic faces ----------
+def synthetic_face(size: int, rng: random.Random):
+    """A drawn face (skin-toned oval, hair, eyes, brows, nose, mouth) that FaceMesh detects."""
+    import cv2
+    import numpy as np
+    s = size / 512
+    c = size // 2
+    shade = rng.uniform(0.4, 1.05)
+    skin = tuple(int(min(255, v * shade)) for v in (120, 160, 210))
+    img = np.full((size, size, 3), [rng.randint(150, 230) for _ in range(3)], np.uint8)
+    cv2.ellipse(img, (c, int(c * 1.05)), (int(150 * s), int(200 * s)), 0, 0, 360, skin, -1)
+    cv2.ellipse(img, (c, int(c * 0.55)), (int(160 * s), int(110 * s)), 0, 180, 360, (30, 30, 40), -1)
+    for dx in (-60, 60):
+        ex, ey = c + int(dx * s), int(c * 0.9)
+        cv2.ellipse(img, (ex, ey), (int(28 * s), int(14 * s)), 0, 0, 360, (255, 255, 255), -1)
+        cv2.circle(img, (ex, ey), int(10 * s), (40, 30, 20), -1)
+        cv2.line(img, (ex - int(30 * s), ey - int(30 * s)), (ex + int(30 * s), ey - int(34 * s)),
+                 (30, 30, 40), max(1, int(8 * s)))
+    nose = np.array([[c, int(c * 0.95)], [c - int(18 * s), int(c * 1.15)], [c + int(18 * s), int(c * 1.15)]], np.int32)
+    cv2.polylines(img, [nose], True, tuple(int(v * 0.7) for v in skin), max(1, int(4 * s)))
+    cv2.ellipse(img, (c, int(c * 1.35)), (int(45 * s), int(16 * s)), 0, 0, 360, (60, 60, 170), -1)
+    return cv2.GaussianBlur(img, (0, 0), 2 * s)
+
+
+def generate_images(out_dir: str, count: int, size: int, seed: int = 0):
+    """Write `count` distinct synthetic faces as <i>.jpg (distinct bytes, so nothing is deduplicated)."""
+    import cv2
+    rng = random.Random(seed)
+    for i in range(count):
+        cv2.imwrite(os.path.join(out_dir, f"{i}.jpg"), synthetic_face(size, rng))
+
+
+# ---------- Stub Face++ and image host ----------
+def serve_stubs(images_dir: str, latency: float, conn):
+    """GET /img/<name> serves images_dir; POST /detect answers like Face++ with attributes hashed from the upload."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            path = os.path.join(images_dir, os.path.basename(self.path.split("?")[0]))
+            if not self.path.startswith("/img/") or not os.path.exists(path):
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with open(path, "rb") as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if latency:
+                time.sleep(latency)
+            h = int(hashlib.md5(body[-4096:]).hexdigest(), 16)
+            face = {"attributes": {
+                "age": {"value": 20 + h % 40},
+                "gender": {"value": ("Male", "Female")[h % 2]},
+                "ethnicity": {"value": ("WHITE", "BLACK", "ASIAN", "INDIA")[h % 4]},
+            }}
+            data = json.dumps({"faces": [face]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+# ---------- Measurements (run inside the job process) ----------
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _io(scope: str = "thread-self") -> dict:
+    """wchar (bytes passed to write calls) and write_bytes (reaching storage) from /proc; zeros elsewhere."""
+    try:
+        with open(f"/proc/{scope}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return {"wchar": int(fields["wchar"]), "write_bytes": int(fields["write_bytes"])}
+    except (OSError, KeyError, ValueError):
+        return {"wchar": 0, "write_bytes": 0}
+
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.lstat(os.path.join(root, fn)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class StageRecorder:
+    """Wraps pipeline functions and accumulates per-stage timings, CPU, writes and peak RSS."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.active = {}
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.peak_rss = _rss_bytes()
+
+    def _sample(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            rss = _rss_bytes()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                for name, n in self.active.items():
+                    if n:
+                        stage = self.stages[name]
+                        stage["peak_rss"] = max(stage["peak_rss"], rss)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def wrap(self, owner, attr: str, stage: str):
+        fn = getattr(owner, attr)
+        recorder = self
+
+        def timed(*args, **kwargs):
+            recorder._enter(stage)
+            wall, cpu, io = time.perf_counter(), time.thread_time(), _io()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                end, io_end = time.perf_counter(), _io()
+                recorder._exit(stage, wall, end, time.thread_time() - cpu, io_end["wchar"] - io["wchar"])
+
+        timed.__wrapped__ = fn
+        setattr(owner, attr, timed)
+
+    def _enter(self, stage: str):
+        rss = _rss_bytes()
+        with self.lock:
+            s = self.stages.setdefault(stage, {"calls": 0, "first": None, "last": 0.0, "task_s": 0.0,
+                                               "cpu_s": 0.0, "write_bytes": 0, "peak_rss": 0})
+            s["peak_rss"] = max(s["peak_rss"], rss)
+            self.active[stage] = self.active.get(stage, 0) + 1
+
+    def _exit(self, stage: str, start: float, end: float, cpu: float, written: int):
+        with self.lock:
+            s = self.stages[stage]
+            s["calls"] += 1
+            s["first"] = start if s["first"] is None else min(s["first"], start)
+            s["last"] = max(s["last"], end)
+            s["task_s"] += end - start
+            s["cpu_s"] += cpu
+            s["write_bytes"] += written
+            self.active[stage] -= 1
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                name: {
+                    "calls": s["calls"],
+                    "wall_s": round(s["last"] - s["first"], 6) if s["first"] is not None else 0.0,
+                    "task_s": round(s["task_s"], 6),
+                    "cpu_s": round(s["cpu_s"], 6),
+                    "write_bytes": s["write_bytes"],
+                    "peak_rss_mb": round(s["peak_rss"] / 2 ** 20, 1),
+                }
+                for name, s in sorted(self.stages.items(), key=lambda kv: STAGES.index(kv[0]) if kv[0] in STAGES else 99)
+            }
+
+
+def make_payload(base_url: str, num: int, occupations: int) -> dict:
+    originals = [{"name": f"{i}.jpg", "url": f"{base_url}/img/{i}.jpg"} for i in range(num)]
+    transform = []
+    for k in range(occupations):
+        images = [{"original": f"{i}.jpg", "url": f"{base_url}/img/{num * (k + 1) + i}.jpg"} for i in range(num)]
+        transform.append({"occupation": f"Occupation{k}", "images": images})
+    return {
+        "gender": "Female", "age": "20-29", "race": "Black", "num": num,
+        "originals": originals, "transform": transform,
+        "occupation": [t["occupation"] for t in transform],
+    }
+
+
+def run_case(case: dict) -> dict:
+    """One job in this (fresh) process against an empty BASE_TMP; returns its measurements."""
+    base_tmp = tempfile.mkdtemp(prefix="pipeline_bench_")
+    os.environ.update({
+        "BASE_TMP": base_tmp,
+        "FACEPP_URL": case["base_url"] + "/detect",
+        "FACEPP_KEY": "bench",
+        "FACEPP_SECRET": "bench",
+        "FACEPP_QPS": str(case["facepp_qps"]),
+        "SKIN_WORKERS": "1",
+        "WORKSPACE_GC_INTERVAL": "0",
+        "WORKSPACE_RAM_MAX_IMAGES": "0",
+    })
+    try:
+        import app
+        import downloader
+        import skin_analyzer
+        import facepp_client
+
+        recorder = StageRecorder()
+        recorder.wrap(facepp_client.FaceppClient, "detect_fetched", "facepp")
+        recorder.wrap(downloader.ImageDownloader, "download", "download")
+        recorder.wrap(skin_analyzer, "skin_darkness", "skin")
+        recorder.wrap(app.MetricCalculator, "compute", "metrics")
+        recorder.wrap(app.Aggregator, "aggregate", "aggregate")
+        recorder.wrap(app.BiasAnalyzer, "analyze", "bias")
+        recorder.wrap(app, "build_response", "response")
+        recorder.wrap(app.JobStore, "update", "store")
+        recorder.start()
+
+        payload = app.AnalyzeRequest(**make_payload(case["base_url"], case["num"], case["occupations"]))
+        if case["warm"]:
+            # Unmeasured first run fills the image store and detection cache
+            warm_id = app.create_job(payload, [payload])
+            app.run_job(warm_id, payload)
+
+        recorder.reset()
+        disk_before, io_before = _dir_bytes(base_tmp), _io("self")
+        wall, cpu = time.perf_counter(), time.process_time()
+        job_id = app.create_job(payload, [payload])
+        app.run_job(job_id, payload)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        io_after = _io("self")
+        recorder.stop()
+
+        import resource
+        return {
+            "num": case["num"],
+            "occupations": case["occupations"],
+            "images": case["num"] * (case["occupations"] + 1),
+            "repeat": case["repeat"],
+            "warm": case["warm"],
+            "status": app.job_store.get(job_id, parse_result=False)["status"],
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu, 6),
+            "peak_rss_mb": round(recorder.peak_rss / 2 ** 20, 1),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "write_bytes": io_after["wchar"] - io_before["wchar"],
+            "storage_write_bytes": io_after["write_bytes"] - io_before["write_bytes"],
+            "disk_bytes": _dir_bytes(base_tmp) - disk_before,
+            "stages": recorder.report(),
+        }
+    finally:
+        shutil.rmtree(base_tmp, ignore_errors=True)
+
+
+# ---------- Driver ----------
+def parse_size(text: str):
+    num, _, occupations = text.lower().partition("x")
+    if not num.isdigit() or not occupations.isdigit() or int(num) < 1 or int(occupations) < 1:
+        raise argparse.ArgumentTypeError(f"size must look like 16x5 (num x occupations), got {text!r}")
+    return int(num), int(occupations)
+
+
+def print_run(run: dict, baseline: dict = None):
+    ratio = lambda new, old: f" x{new / old:5.2f}" if old else ""
+    print(f"num={run['num']:<4} occupations={run['occupations']:<3} {run['status']:<14} "
+          f"wall {run['wall_s']:7.2f}s{ratio(run['wall_s'], baseline and baseline['wall_s'])}  "
+          f"cpu {run['cpu_s']:7.2f}s  peak rss {run['peak_rss_mb']:7.1f} MB  disk {run['disk_bytes'] / 2 ** 20:7.1f} MB")
+    for name, s in run["stages"].items():
+        old = baseline and baseline["stages"].get(name)
+        print(f"    {name:<10} calls {s['calls']:<5} wall {s['wall_s']:7.3f}s{ratio(s['wall_s'], old and old['wall_s'])}  "
+              f"task {s['task_s']:7.3f}s  cpu {s['cpu_s']:7.3f}s  written {s['write_bytes'] / 2 ** 20:7.2f} MB  "
+              f"peak rss {s['peak_rss_mb']:7.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[(4, 2), (16, 5)],
+                        help="job sizes as NUMxOCCUPATIONS")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per size (each in a fresh process)")
+    parser.add_argument("--image-size", type=int, default=512, help="side of the synthetic images in pixels")
+    parser.add_argument("--facepp-latency", type=float, default=0.0, help="stub Face++ delay per call, seconds")
+    parser.add_argument("--facepp-qps", type=float, default=0, help="client-side Face++ rate limit (0 = off)")
+    parser.add_argument("--warm", action="store_true", help="measure a second run with warm caches")
+    parser.add_argument("--output", default="pipeline_bench.json", help="JSON results file")
+    parser.add_argument("--compare", help="earlier results file to show ratios against")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for run in json.load(f)["runs"]:
+                baseline.setdefault((run["num"], run["occupations"], run["warm"]), run)
+
+    ctx = multiprocessing.get_context("spawn")
+    images_dir = tempfile.mkdtemp(prefix="pipeline_bench_images_")
+    parent, child = ctx.Pipe()
+    server = ctx.Process(target=serve_stubs, args=(images_dir, args.facepp_latency, child), daemon=True)
+    try:
+        needed = max(num * (occupations + 1) for num, occupations in args.sizes)
+        print(f"Generating {needed} synthetic {args.image_size}px faces")
+        generate_images(images_dir, needed, args.image_size)
+        server.start()
+        base_url = f"http://127.0.0.1:{parent.recv()}"
+
+        runs = []
+        for num, occupations in args.sizes:
+            for repeat in range(args.repeat):
+                case = {"base_url": base_url, "num": num, "occupations": occupations, "repeat": repeat,
+                        "warm": args.warm, "facepp_qps": args.facepp_qps}
+                # One process per run: cold imports, caches and RSS
+                with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                    run = pool.submit(run_case, case).result()
+                print_run(run, baseline.get((num, occupations, args.warm)))
+                runs.append(run)
+    finally:
+        server.terminate()
+        shutil.rmtree(images_dir, ignore_errors=True)
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"image_size": args.image_size, "facepp_latency": args.facepp_latency,
+                   "facepp_qps": args.facepp_qps, "warm": args.warm,
+                   "env": {k: v for k, v in os.environ.items()
+                           if k.startswith(("SKIN_", "DOWNLOAD_", "FACEPP_WORKERS", "IMAGE_STORE_", "FACEPP_CACHE_"))}},
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark SkinAnalyzer: serial path vs. process-pool path, and full-resolution
+vs. downscaled landmark detection.
+
+Builds a throwaway job tree from a folder of face images (copied into
+`originals` and every occupation folder), runs the analyzer with each worker
+count and checks that every run produces the same darkness values.
+
+    python benchmarks/skin_bench.py --images /path/to/faces --occupations 5 --workers 1 4 16
+
+With --landmark-max-side, each size is also run against the full-resolution
+result and must find faces in the same images and stay within --tolerance
+(absolute avg_darkness difference); the exit status is 1 otherwise.
+--upscale simulates high-resolution uploads.
+
+    python benchmarks/skin_bench.py --images /path/to/faces --upscale 4 --workers 1 --landmark-max-side 640 320
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from skin_analyzer import SkinAnalyzer, IMAGE_EXTS  # noqa: E402
+
+
+def build_job(images_dir, base_tmp, job_id, occupations, copies, upscale=1.0):
+    sources = [fn for fn in sorted(os.listdir(images_dir)) if fn.lower().endswith(IMAGE_EXTS)]
+    if not sources:
+        raise SystemExit(f"No images found in {images_dir}")
+    folders = ["originals"] + [f"transforms/Occupation{i}" for i in range(occupations)]
+    for folder in folders:
+        out = os.path.join(base_tmp, job_id, "images", folder)
+        os.makedirs(out, exist_ok=True)
+        for c in range(copies):
+            for fn in sources:
+                stem, ext = os.path.splitext(fn)
+                dest = os.path.join(out, f"{stem}_{c}{ext}")
+                if upscale == 1:
+                    shutil.copy(os.path.join(images_dir, fn), dest)
+                else:
+                    img = cv2.imread(os.path.join(images_dir, fn))
+                    cv2.imwrite(dest, cv2.resize(img, None, fx=upscale, fy=upscale, interpolation=cv2.INTER_CUBIC))
+    return len(sources) * copies * len(folders)
+
+
+def identical(a, b):
+    if a.keys() != b.keys():
+        return False
+    for k in a:
+        if a[k] is None or b[k] is None:
+            if a[k] is not b[k]:
+                return False
+        elif not a[k].equals(b[k]):
+            return False
+    return True
+
+
+def max_difference(a, b):
+    """
+    Largest absolute avg_darkness difference between two results, or None if
+    they disagree on which images (or folders) have a face.
+    """
+    if a.keys() != b.keys():
+        return None
+    worst = 0.0
+    for k in a:
+        if a[k] is None or b[k] is None:
+            if a[k] is not b[k]:
+                return None
+            continue
+        x, y = a[k]["avg_darkness"], b[k]["avg_darkness"]
+        if not x.isna().equals(y.isna()):
+            return None
+        worst = max(worst, float((x - y).abs().max(skipna=True) if x.notna().any() else 0.0))
+    return worst
+
+
+def timed(analyzer):
+    if analyzer.workers > 1:
+        # Warm the pool so worker start-up is not counted, as on a long-running server
+        analyzer.analyze()
+    start = time.perf_counter()
+    results = analyzer.analyze()
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="folder of input face images")
+    parser.add_argument("--occupations", type=int, default=5)
+    parser.add_argument("--copies", type=int, default=1, help="replicate each image this many times per folder")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--upscale", type=float, default=1.0, help="resize every image by this factor first")
+    parser.add_argument("--landmark-max-side", type=int, nargs="*", default=[],
+                        help="landmark detection sizes to compare with full resolution")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="max avg_darkness difference allowed")
+    args = parser.parse_args()
+
+    base_tmp = tempfile.mkdtemp(prefix="skin_bench_")
+    try:
+        n_images = build_job(args.images, base_tmp, "bench", args.occupations, args.copies, args.upscale)
+        print(f"{n_images} images, {args.occupations} occupations")
+        baseline, baseline_time = None, None
+        for workers in args.workers:
+            results, elapsed = timed(SkinAnalyzer("bench", base_tmp, workers=workers, landmark_max_side=0))
+            if baseline is None:
+                baseline, baseline_time = results, elapsed
+            same = identical(results, baseline)
+            print(f"workers={workers:<3} {elapsed:8.2f}s  speedup x{baseline_time / elapsed:5.2f}  identical={same}")
+
+        failed = False
+        for max_side in args.landmark_max_side:
+            analyzer = SkinAnalyzer("bench", base_tmp, workers=args.workers[0], landmark_max_side=max_side)
+            results, elapsed = timed(analyzer)
+            diff = max_difference(results, baseline)
+            ok = diff is not None and diff <= args.tolerance
+            failed |= not ok
+            shown = "face mismatch" if diff is None else f"max diff {diff:.4f}"
+            print(f"landmarks<={max_side:<5} {elapsed:8.2f}s  speedup x{baseline_time / elapsed:5.2f}  {shown}  "
+                  f"{'ok' if ok else 'FAIL'}")
+        if failed:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(base_tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,131 @@
-import os
+import warnings
+from typing import Dict, Optional
+import numpy as np
 import pandas as pd
 
-class BiasAnalyzer:
+AGE_SCALE  = 25  # years of age shift that count as full age bias
+RACE_SCALE = 13  # skin-darkness shift that counts as full racial bias
+
+def bias_matrices(df_delta, df_gender, df_dark_orig, df_dark_trans):
     """
-    Computes bias summary metrics and bias matrices from consolidated tables,
-    now including racial bias based on skin-darkness shifts.
+    Per-image bias values. Works on whole image x occupation tables or on a
+    single occupation's columns (Series), so partial results use the same formulas.
     """
-    def __init__(self, job_id: str, base_tmp: str = "/tmp"):
-        self.job_dir         = os.path.join(base_tmp, job_id)
-        self.consolidated_dir= os.path.join(self.job_dir, "consolidated")
-        self.bias_dir        = os.path.join(self.job_dir, "bias")
-        os.makedirs(self.bias_dir, exist_ok=True)
+    age_bias    = df_delta.abs() / AGE_SCALE
+    gender_bias = df_gender
+    race_bias   = (df_dark_trans - df_dark_orig).abs() / RACE_SCALE
+    return age_bias, gender_bias, race_bias
 
-    def analyze(self, attribute_name: str) -> dict[str, str]:
-        # ─── existing age & gender loading ───
-        age_delta_path   = os.path.join(self.consolidated_dir, "age_delta.csv")
-        gender_flag_path = os.path.join(self.consolidated_dir, "gender_flag.csv")
-        dark_orig_path   = os.path.join(self.consolidated_dir, "darkness_original.csv")      # COMMENT
-        dark_trans_path  = os.path.join(self.consolidated_dir, "darkness_transformed.csv")   # COMMENT
+def bias_scores(age_bias, gender_bias, race_bias):
+    """Summary scores (mean over all images/occupations; age and race capped at 1)."""
+    def mean(m):
+        return (m.stack() if isinstance(m, pd.DataFrame) else m).mean()
+    return min(mean(age_bias), 1), mean(gender_bias), min(mean(race_bias), 1)
 
-        df_delta  = pd.read_csv(age_delta_path,   index_col=0)
-        df_gender = pd.read_csv(gender_flag_path, index_col=0)
+def bootstrap_intervals(age_bias, gender_bias, race_bias, resamples: int, confidence: float = 0.95,
+                        seed: Optional[int] = None) -> dict:
+    """
+    Percentile bootstrap confidence intervals for the three bias scores, overall
+    and per occupation, resampling images (matrix rows) with replacement.
 
-        # ─── NEW: load darkness tables for racial bias ───
-        df_dark_orig     = pd.read_csv(dark_orig_path,   index_col=0)                       # COMMENT
-        df_dark_trans    = pd.read_csv(dark_trans_path,  index_col=0)       
-        
-        # print(df_delta)
-        # print(df_gender)
-        # print(df_dark_orig)   # COMMENT: print original darkness
-        # print(df_dark_trans)
+    Each resample is a row of multinomial counts, so every resampled mean is a
+    weighted sum: counts (B x n) @ values (n x occupations) for all B resamples
+    at once, with NaN cells excluded through a matching @ on the not-NaN mask.
+    """
+    occupations = list(age_bias.columns)
+    n = len(age_bias.index)
+    alpha = (1 - confidence) / 2
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(n, np.full(n, 1 / n), size=resamples).astype(float) if n else np.zeros((resamples, 0))
 
-        # ─── compute age & gender bias ───
-        age_bias_matrix    = df_delta.abs() / 25
-        age_score = min(age_bias_matrix.stack().mean(), 1)
-        gender_bias_matrix = df_gender
-        gender_score       = gender_bias_matrix.stack().mean()                # COMMENT
+    overall, per_occupation = {}, {occ: {} for occ in occupations}
+    for name, matrix, capped in (("age_bias", age_bias, True), ("gender_bias", gender_bias, False),
+                                 ("race_bias", race_bias, True)):
+        values = matrix.to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        sums = counts @ np.where(valid, values, 0.0)   # B x occupations
+        sizes = counts @ valid.astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            occ_means = sums / sizes
+            all_means = sums.sum(axis=1) / sizes.sum(axis=1)
+        if capped:
+            occ_means = np.minimum(occ_means, 1)
+            all_means = np.minimum(all_means, 1)
+        with warnings.catch_warnings():
+            # Occupations without a single valid image give all-NaN columns -> [nan, nan]
+            warnings.simplefilter("ignore", RuntimeWarning)
+            occ_bounds = np.nanquantile(occ_means, [alpha, 1 - alpha], axis=0)
+            all_bounds = np.nanquantile(all_means, [alpha, 1 - alpha])
+        overall[name] = all_bounds.tolist()
+        for occ, low, high in zip(occupations, occ_bounds[0], occ_bounds[1]):
+            per_occupation[occ][name] = [low, high]
+    return {"confidence": confidence, "resamples": resamples, "overall": overall, "per_occupation": per_occupation}
 
-        # ─── NEW: compute racial bias matrix & summary ───
-        race_bias_matrix = (df_dark_trans - df_dark_orig).abs() / 13      # COMMENT
-        race_score       = min(race_bias_matrix.stack().mean(), 1)               # COMMENT
+def group_occupation_table(metrics_by_group: Dict[str, Dict[str, pd.DataFrame]]) -> pd.DataFrame:
+    """
+    Mean age/gender/race bias per (group, occupation) from per-image metrics of
+    several groups. All rows are concatenated and scored in one vectorized pass;
+    age and race are capped at 1 like the summary scores.
+    """
+    frames = [
+        df.assign(group=group, occupation=occ)
+        for group, metrics in metrics_by_group.items()
+        for occ, df in metrics.items()
+    ]
+    columns = ["age_bias", "gender_bias", "race_bias"]
+    if not frames:
+        return pd.DataFrame(columns=columns, index=pd.MultiIndex.from_tuples([], names=["group", "occupation"]))
+    tidy = pd.concat(frames, ignore_index=True)
+    tidy["age_bias"], tidy["gender_bias"], tidy["race_bias"] = bias_matrices(
+        tidy["age_delta"], tidy["gender_flag"], tidy["original_avg_darkness"], tidy["transformed_avg_darkness"]
+    )
+    table = tidy.astype({c: float for c in columns}).groupby(["group", "occupation"], sort=False)[columns].mean()
+    table[["age_bias", "race_bias"]] = table[["age_bias", "race_bias"]].clip(upper=1)
+    return table
 
-        # ─── write summary CSV (now including race_bias) ───
-        summary_df = pd.DataFrame([{
-            "attribute":     attribute_name,
-            "age_bias":      age_score,
-            "gender_bias":   gender_score,
-            "race_bias":     race_score   # COMMENT: new field
-        }])
-        summary_path = os.path.join(self.bias_dir, "bias_summary.csv")
-        summary_df.to_csv(summary_path, index=False)
+class BiasAnalyzer:
+    """
+    Computes bias summary metrics and bias matrices from consolidated tables,
+    now including racial bias based on skin-darkness shifts.
+    """
+    def __init__(self, consolidated: Dict[str, pd.DataFrame]):
+        self.consolidated = consolidated
 
-        # ─── write bias matrices ───
-        age_matrix_path   = os.path.join(self.bias_dir, "age_bias_matrix.csv")
-        gender_matrix_path= os.path.join(self.bias_dir, "gender_bias_matrix.csv")
-        race_matrix_path  = os.path.join(self.bias_dir, "race_bias_matrix.csv")   # COMMENT: new path
+    def analyze(self, attribute_name: str, bootstrap: int = 0, confidence: float = 0.95) -> dict:
+        """
+        Bias matrices and summary scores. With `bootstrap` > 0 the result also
+        has "ci": bootstrap confidence intervals (see bootstrap_intervals).
+        """
+        df_delta      = self.consolidated["age_delta"]
+        df_gender     = self.consolidated["gender_flag"]
+        # darkness tables for racial bias
+        df_dark_orig  = self.consolidated["darkness_original"]
+        df_dark_trans = self.consolidated["darkness_transformed"]
 
-        age_bias_matrix.to_csv(age_matrix_path)
-        gender_bias_matrix.to_csv(gender_matrix_path)
-        race_bias_matrix.to_csv(race_matrix_path)                                # COMMENT: write race matrix
+        # ─── compute age, gender & racial bias (race from skin-darkness shifts) ───
+        age_bias_matrix, gender_bias_matrix, race_bias_matrix = bias_matrices(
+            df_delta, df_gender, df_dark_orig, df_dark_trans
+        )
+        age_score, gender_score, race_score = bias_scores(
+            age_bias_matrix, gender_bias_matrix, race_bias_matrix
+        )
 
-        return {
-            "summary":       summary_path,
-            "age_matrix":    age_matrix_path,
-            "gender_matrix": gender_matrix_path,
-            "race_matrix":   race_matrix_path,   # COMMENT: include race matrix
+        result = {
+            "summary": {
+                "attribute":   attribute_name,
+                "age_bias":    age_score,
+                "gender_bias": gender_score,
+                "race_bias":   race_score,
+            },
+            "age_matrix":    age_bias_matrix,
+            "gender_matrix": gender_bias_matrix,
+            "race_matrix":   race_bias_matrix,
             "age_bias":      age_score,
             "gender_bias":   gender_score,
-            "race_bias":     race_score          # COMMENT: include race bias score
-        }
\ No newline at end of file
+            "race_bias":     race_score,
+        }
+        if bootstrap > 0:
+            result["ci"] = bootstrap_intervals(
+                age_bias_matrix, gender_bias_matrix, race_bias_matrix, bootstrap, confidence
+            )
+        return result
@@ -0,0 +1,285 @@
+import os
+import re
+import math
+import time
+import sqlite3
+import logging
+from contextlib import closing
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("age_bias", "gender_bias", "race_bias")
+# Score columns capped at 1, as in bias_scores()
+CAPPED = ("age_bias", "race_bias")
+# group_by keys -> SQL expression over either table
+GROUP_KEYS = {
+    "job": "job_id",
+    "attribute": "attribute",
+    "gender": "gender",
+    "age": "age",
+    "race": "race",
+    "model": "model",
+    "occupation": "occupation",
+    "date": "date",
+    "month": "substr(date, 1, 7)",
+}
+FILTERS = ("attribute", "gender", "age", "race", "model", "occupation")
+MAX_ROWS = 10000
+
+
+def _score(value) -> Optional[float]:
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else float(value)
+
+
+class BiasIndex:
+    """
+    Append-only SQLite index of finished analyses, for trends across runs
+    without re-running anything. Per job and demographic group it keeps the
+    summary scores (runs), the per-occupation scores (occupation_scores) and
+    every cell of the age/gender/race bias matrices (bias_cells), keyed by
+    attribute, occupation, editing model and UTC date.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    job_id      TEXT NOT NULL,
+                    attribute   TEXT NOT NULL,
+                    gender      TEXT,
+                    age         TEXT,
+                    race        TEXT,
+                    model       TEXT,
+                    created     REAL NOT NULL,
+                    date        TEXT NOT NULL,
+                    images      INTEGER,
+                    age_bias    REAL,
+                    gender_bias REAL,
+                    race_bias   REAL,
+                    PRIMARY KEY (job_id, attribute)
+                );
+                CREATE TABLE IF NOT EXISTS occupation_scores (
+                    job_id      TEXT NOT NULL,
+                    attribute   TEXT NOT NULL,
+                    occupation  TEXT NOT NULL,
+                    gender      TEXT,
+                    age         TEXT,
+                    race        TEXT,
+                    model       TEXT,
+                    created     REAL NOT NULL,
+                    date        TEXT NOT NULL,
+                    images      INTEGER,
+                    age_bias    REAL,
+                    gender_bias REAL,
+                    race_bias   REAL,
+                    PRIMARY KEY (job_id, attribute, occupation)
+                );
+                CREATE TABLE IF NOT EXISTS bias_cells (
+                    job_id      TEXT NOT NULL,
+                    attribute   TEXT NOT NULL,
+                    occupation  TEXT NOT NULL,
+                    image_name  TEXT NOT NULL,
+                    age_bias    REAL,
+                    gender_bias REAL,
+                    race_bias   REAL,
+                    PRIMARY KEY (job_id, attribute, occupation, image_name)
+                );
+                CREATE INDEX IF NOT EXISTS runs_lookup ON runs (attribute, model, date);
+                CREATE INDEX IF NOT EXISTS runs_date ON runs (date);
+                CREATE INDEX IF NOT EXISTS occupation_lookup ON occupation_scores (attribute, occupation, model, date);
+                CREATE INDEX IF NOT EXISTS occupation_by_occupation ON occupation_scores (occupation, date);
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call keeps the index safe to use from any thread
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(
+        self,
+        job_id: str,
+        group: Dict[str, str],
+        summary: dict,
+        matrices: Optional[Dict[str, pd.DataFrame]] = None,
+        occupation_scores: Optional[Iterable[dict]] = None,
+        created: Optional[float] = None
+    ):
+        """
+        Index one group's result. `group` has attribute, gender, age, race and model;
+        `summary` the overall scores. `matrices` ({metric: image x occupation frame})
+        gives the cells and per-occupation scores; without them (results stored
+        before the index existed) `occupation_scores` rows {occupation, *METRICS} are used.
+        Re-adding the same job and attribute replaces its rows.
+        """
+        created = created or time.time()
+        date = time.strftime("%Y-%m-%d", time.gmtime(created))
+        key = (job_id, group["attribute"])
+        labels = (group.get("gender"), group.get("age"), group.get("race"), group.get("model"), created, date)
+
+        cells, occupations = [], []
+        images = None
+        if matrices is not None:
+            frames = [matrices[m] for m in METRICS]
+            image_names = [str(name) for name in frames[0].index]
+            occupation_names = list(frames[0].columns)
+            # images x occupations x metrics
+            values = np.stack([f.to_numpy(dtype=float) for f in frames], axis=-1)
+            cells = [
+                (*key, occ, image, *(_score(v) for v in values[i, j]))
+                for i, image in enumerate(image_names)
+                for j, occ in enumerate(occupation_names)
+            ]
+            means = {m: f.mean() for m, f in zip(METRICS, frames)}
+            for m in CAPPED:
+                means[m] = means[m].clip(upper=1)
+            counts = frames[0].notna().sum()
+            occupations = [
+                (*key, occ, *labels, int(counts[occ]), *(_score(means[m][occ]) for m in METRICS))
+                for occ in occupation_names
+            ]
+            images = len(image_names)
+        elif occupation_scores is not None:
+            occupations = [
+                (*key, row["occupation"], *labels, None, *(_score(row.get(m)) for m in METRICS))
+                for row in occupation_scores
+            ]
+
+        with closing(self._connect()) as conn, conn:
+            for table in ("runs", "occupation_scores", "bias_cells"):
+                conn.execute(f"DELETE FROM {table} WHERE job_id = ? AND attribute = ?", key)
+            conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, *labels, images, *(_score(summary.get(m)) for m in METRICS)),
+            )
+            conn.executemany("INSERT INTO occupation_scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", occupations)
+            conn.executemany("INSERT INTO bias_cells VALUES (?, ?, ?, ?, ?, ?, ?)", cells)
+
+    def indexed_jobs(self) -> set:
+        with closing(self._connect()) as conn:
+            return {row[0] for row in conn.execute("SELECT DISTINCT job_id FROM runs")}
+
+    def query(
+        self,
+        group_by: List[str],
+        metrics: Optional[List[str]] = None,
+        scope: str = "occupation",
+        filters: Optional[Dict[str, str]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        limit: int = 1000
+    ) -> List[dict]:
+        """
+        Aggregate scores over indexed runs: one row per combination of `group_by`
+        keys (see GROUP_KEYS) with the number of jobs and mean / min / max / std
+        of each metric. scope="occupation" aggregates per-occupation scores,
+        scope="job" each group's overall scores. `since` / `until` are inclusive
+        YYYY-MM-DD dates. Raises ValueError on unknown keys.
+        """
+        metrics = list(metrics or METRICS)
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        unknown = ([g for g in group_by if g not in GROUP_KEYS] + [m for m in metrics if m not in METRICS]
+                   + [f for f in filters if f not in FILTERS])
+        if unknown:
+            raise ValueError(f"Unknown group_by, metric or filter: {', '.join(unknown)}")
+        if scope not in ("occupation", "job"):
+            raise ValueError("scope must be 'occupation' or 'job'")
+        if scope == "job" and ("occupation" in group_by or "occupation" in filters):
+            raise ValueError("occupation needs scope=occupation")
+        for bound in (since, until):
+            if bound and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", bound):
+                raise ValueError(f"Dates must look like YYYY-MM-DD, got {bound!r}")
+        if not 0 < limit <= MAX_ROWS:
+            raise ValueError(f"limit must be between 1 and {MAX_ROWS}")
+
+        table = "occupation_scores" if scope == "occupation" else "runs"
+        where, params = [], []
+        for column, value in filters.items():
+            where.append(f"{column} = ?")
+            params.append(value)
+        if since:
+            where.append("date >= ?")
+            params.append(since)
+        if until:
+            where.append("date <= ?")
+            params.append(until)
+        keys = [f"{GROUP_KEYS[g]} AS {g}" for g in group_by]
+        stats = [
+            f"AVG({m}) AS {m}_mean, MIN({m}) AS {m}_min, MAX({m}) AS {m}_max, AVG({m} * {m}) AS {m}_sq"
+            for m in metrics
+        ]
+        sql = (
+            f"SELECT {', '.join(keys + ['COUNT(DISTINCT job_id) AS jobs', 'COUNT(*) AS entries'] + stats)} FROM {table}"
+            + (f" WHERE {' AND '.join(where)}" if where else "")
+            + (f" GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}" if group_by else "")
+            + " LIMIT ?"
+        )
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, (*params, limit)).fetchall()
+
+        out = []
+        for row in rows:
+            if row["entries"] == 0:
+                continue
+            item = {g: row[g] for g in group_by}
+            item["jobs"] = row["jobs"]
+            item["entries"] = row["entries"]
+            for m in metrics:
+                mean, sq = row[f"{m}_mean"], row[f"{m}_sq"]
+                std = math.sqrt(max(sq - mean * mean, 0.0)) if mean is not None else None
+                item[m] = {"mean": mean, "min": row[f"{m}_min"], "max": row[f"{m}_max"], "std": std}
+            out.append(item)
+        return out
+
+    def backfill(self, job_store) -> int:
+        """
+        Index the finished jobs of `job_store` (a JobStore) that are not indexed
+        yet, e.g. results stored before the index existed. Returns how many were added;
+        a job whose result cannot be indexed is logged and skipped.
+        """
+        added = 0
+        for job_id, created, request, result in job_store.finished(skip=self.indexed_jobs()):
+            try:
+                if "groups" in result:
+                    occupation_rows = result.get("group_occupation_bias", [])
+                    for req, res in zip(request["groups"], result["groups"]):
+                        group = group_labels(req)
+                        rows = [r for r in occupation_rows if r.get("group") == group["attribute"]]
+                        self.add(job_id, group, res["bias_summary"], occupation_scores=rows, created=created)
+                else:
+                    self.add(job_id, group_labels(request), result["bias_summary"], stored_matrices(result),
+                             created=created)
+            except Exception as e:
+                logger.error(f"[BiasIndex] Could not index job {job_id}: {e}")
+                continue
+            added += 1
+        return added
+
+
+def stored_matrices(result: dict) -> Optional[Dict[str, pd.DataFrame]]:
+    """
+    The {metric: image x occupation frame} matrices of a stored single-group
+    result, or None when they are empty (no image pair had a usable face).
+    """
+    records = {m: result.get(f"{m}_matrix") or [] for m in METRICS}
+    if not all(records.values()):
+        return None
+    return {m: pd.DataFrame(rows).set_index("image_name").astype(float) for m, rows in records.items()}
+
+def group_labels(request: dict) -> Dict[str, str]:
+    """attribute, gender, age, race and model of one analysed group (an AnalyzeRequest as a dict)."""
+    return {
+        "attribute": f"{request['gender']}_{request['age']}_{request['race']}",
+        "gender": request["gender"],
+        "age": request["age"],
+        "race": request["race"],
+        "model": request.get("model"),
+    }
@@ -0,0 +1,145 @@
+import os
+import time
+import random
+import hashlib
+import logging
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Optional, Tuple
+from telemetry import RETRIES, external_request
+
+logger = logging.getLogger(__name__)
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+MAX_IMAGE_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+MAX_RETRY = 3
+RETRY_DELAY = 0.5  # seconds, base of the exponential backoff
+REQUEST_TIMEOUT = 10  # seconds
+# Statuses worth retrying; any other HTTP error fails the image immediately
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """Raised for a download that must not be retried (too large, 4xx, ...)."""
+
+
+class ImageDownloader:
+    """
+    Downloads images to local files with bounded concurrency over one pooled
+    session. Bodies are streamed to disk in chunks and capped at `max_bytes`;
+    a failing image is reported in the result instead of raising.
+    """
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        max_bytes: int = MAX_IMAGE_BYTES,
+        session: Optional[requests.Session] = None
+    ):
+        self.max_workers = max(1, max_workers or DOWNLOAD_WORKERS)
+        self.max_bytes = max_bytes
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self, url: str, headers: Optional[dict] = None) -> requests.Response:
+        """GET `url` as a stream, rejecting non-retryable statuses and oversized bodies up front."""
+        resp = self.session.get(url, stream=True, timeout=REQUEST_TIMEOUT, headers=headers)
+        try:
+            if resp.status_code in RETRY_STATUS:
+                resp.raise_for_status()
+            if resp.status_code >= 400:
+                raise DownloadError(f"HTTP {resp.status_code}")
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                raise DownloadError(f"image is {length} bytes, limit is {self.max_bytes}")
+        except BaseException:
+            resp.close()
+            raise
+        return resp
+
+    def _stream_to_file(self, resp: requests.Response, dest: str) -> Tuple[int, str]:
+        """
+        Stream a response body into `dest` via a temp file in the same folder.
+        Returns (bytes written, SHA-256 of the body).
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".part")
+        written = 0
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > self.max_bytes:
+                        raise DownloadError(f"image exceeds {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return written, digest.hexdigest()
+
+    def _read(self, url: str) -> bytes:
+        """Read `url` into memory, with the same size cap as file downloads."""
+        with self._open(url) as resp:
+            body = bytearray()
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                body += chunk
+                if len(body) > self.max_bytes:
+                    raise DownloadError(f"image exceeds {self.max_bytes} bytes")
+        return bytes(body)
+
+    def _with_retry(self, tag: str, fetch) -> dict:
+        last_err = None
+        for attempt in range(1, MAX_RETRY + 1):
+            if attempt > 1:
+                RETRIES.inc(service="download")
+            try:
+                with external_request("download"):
+                    return fetch()
+            except DownloadError as e:
+                last_err = e
+                break
+            except requests.RequestException as e:
+                last_err = e
+                logger.warning(f"[ImageDownloader] {tag} failed (attempt {attempt}): {e}")
+            if attempt < MAX_RETRY:
+                time.sleep(random.uniform(0, RETRY_DELAY * 2 ** (attempt - 1)))
+        logger.error(f"[ImageDownloader] Giving up on {tag}: {last_err}")
+        return {"error": str(last_err)}
+
+    def _download_one(self, tag: str, url: str, dest: str, headers: Optional[dict] = None) -> dict:
+        def fetch():
+            with self._open(url, headers) as resp:
+                if resp.status_code == 304:
+                    return {"not_modified": True}
+                size, sha256 = self._stream_to_file(resp, dest)
+                etag = resp.headers.get("ETag")
+            logger.info(f"[ImageDownloader] fetched tag={tag}, bytes={size}")
+            return {"path": dest, "bytes": size, "sha256": sha256, "etag": etag}
+        return self._with_retry(tag, fetch)
+
+    def download(self, tag: str, url: str, dest: str, headers: Optional[dict] = None) -> dict:
+        """
+        Download one image to `dest`: {"path", "bytes", "sha256", "etag"} or {"error": ...}.
+        With conditional `headers` (If-None-Match) an unchanged image yields {"not_modified": True}.
+        """
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        return self._download_one(tag, url, dest, headers)
+
+    def fetch(self, tag: str, url: str) -> dict:
+        """Download one image into memory: {"content": bytes} or {"error": ...}."""
+        return self._with_retry(tag, lambda: {"content": self._read(url)})
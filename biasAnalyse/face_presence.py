@@ -0,0 +1,150 @@
+import os
+import abc
+import cv2
+import logging
+import threading
+import numpy as np
+import mediapipe as mp
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from downloader import ImageDownloader
+from facepp_client import FaceppClient
+
+logger = logging.getLogger(__name__)
+FACE_CHECK_BACKEND = os.getenv("FACE_CHECK_BACKEND", "facepp")   # facepp | local
+FACE_CHECK_FALLBACK = os.getenv("FACE_CHECK_FALLBACK", "")       # "facepp": re-check ambiguous images with Face++
+FACE_CHECK_WORKERS = int(os.getenv("FACE_CHECK_WORKERS", "8"))
+FACE_MIN_SCORE = float(os.getenv("FACE_MIN_SCORE", "0.5"))       # best detection at/above this: face
+FACE_AMBIGUOUS_SCORE = float(os.getenv("FACE_AMBIGUOUS_SCORE", "0.3"))  # between this and FACE_MIN_SCORE: ambiguous
+
+
+class FacePresenceBackend(abc.ABC):
+    """
+    Answers "is there a face in this image?" for a batch of (name, url) pairs.
+    `check` returns name -> True / False, or None when the backend could not
+    decide (download failure, low-confidence detection, API error).
+    """
+    name = "base"
+
+    @abc.abstractmethod
+    def check(self, images: List[Tuple[str, str]]) -> Dict[str, Optional[bool]]:
+        ...
+
+    def close(self):
+        pass
+
+
+class FaceppPresence(FacePresenceBackend):
+    """
+    Face++ detect per image (rate-limited, cached); a failed call is undecided.
+    With an `image_store`, images are fetched through it, like the jobs' images.
+    """
+    name = "facepp"
+
+    def __init__(self, cache=None, image_store=None):
+        self.cache = cache
+        self.image_store = image_store
+
+    def check(self, images: List[Tuple[str, str]]) -> Dict[str, Optional[bool]]:
+        with FaceppClient(cache=self.cache, image_store=self.image_store) as client:
+            results = client.detect_batch(images)
+        return {tag: None if "error" in data else bool(data.get("faces")) for tag, data in results.items()}
+
+
+class LocalFacePresence(FacePresenceBackend):
+    """
+    In-process check with MediaPipe face detection: images are fetched into
+    memory and checked on a persistent thread pool, one detector per thread.
+    A best score in [ambiguous_score, min_score) is reported as undecided.
+    """
+    name = "local"
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        min_score: float = FACE_MIN_SCORE,
+        ambiguous_score: float = FACE_AMBIGUOUS_SCORE
+    ):
+        self.max_workers = max(1, max_workers or FACE_CHECK_WORKERS)
+        self.min_score = min_score
+        self.ambiguous_score = min(ambiguous_score, min_score)
+        self.downloader = ImageDownloader(max_workers=self.max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="face-check")
+        self._local = threading.local()
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        self.downloader.close()
+
+    @property
+    def detector(self):
+        # MediaPipe graphs are not thread-safe; each pool thread keeps its own
+        if getattr(self._local, "detector", None) is None:
+            self._local.detector = mp.solutions.face_detection.FaceDetection(
+                model_selection=1,
+                min_detection_confidence=self.ambiguous_score,
+            )
+        return self._local.detector
+
+    def best_score(self, content: bytes) -> Optional[float]:
+        """Highest face detection score in an encoded image, 0.0 if none; None if it cannot be decoded."""
+        img = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        results = self.detector.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        if not results.detections:
+            return 0.0
+        return max(d.score[0] for d in results.detections)
+
+    def _check_one(self, tag: str, url: str) -> Optional[bool]:
+        fetched = self.downloader.fetch(tag, url)
+        if "error" in fetched:
+            return None
+        score = self.best_score(fetched["content"])
+        if score is None:
+            logger.warning(f"[LocalFacePresence] Could not decode {tag}")
+            return None
+        if score >= self.min_score:
+            return True
+        if score < self.ambiguous_score:
+            return False
+        return None
+
+    def check(self, images: List[Tuple[str, str]]) -> Dict[str, Optional[bool]]:
+        futures = [self._pool.submit(self._check_one, tag, url) for tag, url in images]
+        return {tag: fut.result() for (tag, _), fut in zip(images, futures)}
+
+
+class FallbackPresence(FacePresenceBackend):
+    """Runs `primary`, then asks `fallback` only about the images `primary` left undecided."""
+    def __init__(self, primary: FacePresenceBackend, fallback: FacePresenceBackend):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+
+    def close(self):
+        self.primary.close()
+        self.fallback.close()
+
+    def check(self, images: List[Tuple[str, str]]) -> Dict[str, Optional[bool]]:
+        results = self.primary.check(images)
+        undecided = [(tag, url) for tag, url in images if results.get(tag) is None]
+        if undecided:
+            logger.info(f"[FallbackPresence] {len(undecided)} image(s) sent to {self.fallback.name}")
+            results.update(self.fallback.check(undecided))
+        return results
+
+
+def presence_backend_from_env(cache=None, image_store=None) -> FacePresenceBackend:
+    """
+    FACE_CHECK_BACKEND picks the detector (facepp by default, or local); FACE_CHECK_FALLBACK=facepp
+    re-checks the local backend's undecided images with Face++.
+    """
+    if FACE_CHECK_BACKEND == "facepp":
+        return FaceppPresence(cache=cache, image_store=image_store)
+    if FACE_CHECK_BACKEND != "local":
+        raise ValueError(f"Unknown FACE_CHECK_BACKEND: {FACE_CHECK_BACKEND}")
+    backend = LocalFacePresence()
+    if FACE_CHECK_FALLBACK == "facepp":
+        return FallbackPresence(backend, FaceppPresence(cache=cache, image_store=image_store))
+    return backend
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Optional
+from telemetry import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600  # seconds
+
+
+class DetectionCache:
+    """
+    Content-addressed on-disk cache of Face++ detect responses.
+
+    Entries are keyed by the SHA-256 of the image bytes plus the requested
+    attributes, so the same picture served from a different URL (or analysed
+    again for another occupation set) is a hit. Each entry is a small JSON file;
+    its mtime is bumped on every hit and the least recently used files are
+    evicted once the store grows past `max_bytes`. Entries created more than
+    `ttl` seconds ago are treated as misses and removed, however often they are hit.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES, ttl: float = DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    @classmethod
+    def from_env(cls, base_tmp: str) -> Optional["DetectionCache"]:
+        """Build the cache from FACEPP_CACHE_* env vars; FACEPP_CACHE_MAX_MB=0 disables it."""
+        max_mb = float(os.getenv("FACEPP_CACHE_MAX_MB", DEFAULT_MAX_BYTES / (1024 * 1024)))
+        if max_mb <= 0:
+            return None
+        return cls(
+            os.getenv("FACEPP_CACHE_DIR", os.path.join(base_tmp, "facepp_cache")),
+            max_bytes=int(max_mb * 1024 * 1024),
+            ttl=float(os.getenv("FACEPP_CACHE_TTL", DEFAULT_TTL)),
+        )
+
+    @staticmethod
+    def make_key(image_sha256: str, attributes: str) -> str:
+        """Key of an image's entry from the SHA-256 of its bytes, as ImageStore and ImageDownloader report it."""
+        digest = hashlib.sha256(attributes.encode())
+        digest.update(b"\0")
+        digest.update(image_sha256.encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _entries(self):
+        """Yield (path, mtime, size) for every cached file."""
+        for root, _, files in os.walk(self.cache_dir):
+            for fn in files:
+                if not fn.endswith(".json"):
+                    continue
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.total_bytes = max(0, self.total_bytes - size)
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            with self.lock:
+                self.misses += 1
+            CACHE_REQUESTS.inc(cache="facepp", result="miss")
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            self._remove(path)
+            with self.lock:
+                self.misses += 1
+            CACHE_REQUESTS.inc(cache="facepp", result="miss")
+            return None
+        # Bump mtime so eviction sees this entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        CACHE_REQUESTS.inc(cache="facepp", result="hit")
+        return entry["response"]
+
+    def put(self, key: str, response: dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = json.dumps({"created": time.time(), "response": response})
+        # Write to a temp file and rename so concurrent readers never see partial JSON
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(payload)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp, path)
+        with self.lock:
+            self.total_bytes += len(payload) - old_size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _created(self, path: str) -> Optional[float]:
+        try:
+            with open(path) as f:
+                return json.load(f).get("created", 0)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return 0
+
+    def evict(self):
+        """
+        Drop expired entries (by their stored `created` time, as get() does), then
+        least recently used ones (by mtime) until under 90% of max_bytes.
+        """
+        now = time.time()
+        entries = []
+        removed = 0
+        for path, mtime, size in self._entries():
+            created = self._created(path)
+            if created is None:
+                continue
+            if now - created > self.ttl:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                continue
+            entries.append((path, mtime, size))
+        entries.sort(key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        with self.lock:
+            self.total_bytes = total
+        logger.info(f"[DetectionCache] evicted {removed} entries, {total} bytes remain")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
@@ -1,62 +1,273 @@
 import os
 import time
+import random
+import hashlib
 import logging
+import threading
 import requests
-from typing import Dict, List, Tuple  # COMMENT: Dict, List imported for new method
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional, Tuple
+from facepp_cache import DetectionCache
+from downloader import ImageDownloader
+from telemetry import FACEPP_LIMITER_WAIT, FACEPP_REQUESTS, RETRIES, external_request
 
 logger = logging.getLogger(__name__)
-FACEPP_URL = "https://api-us.faceplusplus.com/facepp/v3/detect"
+# FACEPP_URL can be pointed at a local stub detect server for testing
+FACEPP_URL = os.getenv("FACEPP_URL", "https://api-us.faceplusplus.com/facepp/v3/detect")
+FACEPP_ATTRIBUTES = "age,gender,ethnicity"
 MAX_RETRY = 5
-RETRY_DELAY = 1  # seconds
+RETRY_DELAY = 1  # seconds, base of the exponential backoff
+MAX_RETRY_DELAY = 16  # seconds, cap of a single backoff sleep
+REQUEST_TIMEOUT = 10  # seconds
+FACEPP_MAX_FILE_BYTES = 2 * 1024 * 1024  # Face++ limit for image_file uploads
+# Face++ quota: requests per second allowed for our API key, and parallel calls
+FACEPP_QPS = float(os.getenv("FACEPP_QPS", "3"))
+FACEPP_WORKERS = int(os.getenv("FACEPP_WORKERS", "4"))
+
+# Face++ reports quota pressure either as HTTP 429 or as a 403 with this message;
+# any other 4xx (bad URL, unsupported image, auth) fails the same way on every retry
+CONCURRENCY_ERROR = "CONCURRENCY_LIMIT_EXCEEDED"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of outgoing requests.
+    `rate` tokens are added per second up to `capacity`; a rate <= 0 disables limiting.
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# One limiter per process: the quota belongs to the API key, not to a client instance
+_shared_limiter = TokenBucket(FACEPP_QPS)
+
+
+def _error_message(resp: requests.Response) -> str:
+    """Face++'s `error_message` of an error response, or the raw body."""
+    try:
+        return str(resp.json().get("error_message", resp.text))
+    except ValueError:
+        return resp.text
+
+
+def _backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than a server supplied Retry-After."""
+    delay = random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempt - 1)))
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
 
 class FaceppClient:
-    def __init__(self):
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        limiter: Optional[TokenBucket] = None,
+        session: Optional[requests.Session] = None,
+        cache: Optional[DetectionCache] = None,
+        image_store=None
+    ):
         self.api_key = os.getenv("FACEPP_KEY")
         self.api_secret = os.getenv("FACEPP_SECRET")
         if not self.api_key or not self.api_secret:
             raise ValueError("FACEPP_KEY and FACEPP_SECRET must be set in env")
+        self.max_workers = max(1, max_workers or FACEPP_WORKERS)
+        self.limiter = limiter or _shared_limiter
+        self.session = session or self._build_session(self.max_workers)
+        self.cache = cache
+        # With an ImageStore, a URL it already knows resolves to its bytes without a request
+        self.image_store = image_store
+        self.downloader = ImageDownloader(max_workers=self.max_workers) if image_store is not None else None
 
-    def detect_batch(
-        self, 
-        images: List[Tuple[str, str]]
-        # list of (context_tag, image_url)
-    ) -> Dict[str, dict]:
+    @staticmethod
+    def _build_session(pool_size: int) -> requests.Session:
+        # Keep one keep-alive connection per worker instead of a new TLS handshake per call
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+        if self.downloader is not None:
+            self.downloader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fetch_image(self, tag: str, url: str) -> Optional[dict]:
         """
-        Call Face++ detect on each image URL, with retries.
-        Returns a mapping from context_tag to parsed JSON response.
+        The image behind `url` for the cache key: {"sha256", "path", "bytes"} from the
+        image store (no request while the store's URL index is fresh), else
+        {"sha256", "content"} downloaded; None if unavailable.
         """
-        results = {}
-        for tag, url in images:
-            last_err = None
-            for attempt in range(1, MAX_RETRY + 1):
+        if self.image_store is not None:
+            fetched = self.image_store.fetch(tag, url, self.downloader)
+            if "error" in fetched:
+                logger.warning(f"[FaceppClient] Could not fetch {tag} for caching: {fetched['error']}")
+                return None
+            return fetched
+        try:
+            with external_request("image_fetch"):
+                resp = self.session.get(url, timeout=REQUEST_TIMEOUT)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"[FaceppClient] Could not fetch {tag} for caching: {e}")
+            return None
+        return {"sha256": hashlib.sha256(resp.content).hexdigest(), "content": resp.content}
+
+    def _detect_one(self, tag: str, url: str) -> dict:
+        """
+        Call Face++ detect for a single image URL, answering from the detection
+        cache when the same image bytes were analysed before.
+        """
+        if self.cache is None:
+            return self._post_detect(tag, {"image_url": (None, url)})
+        image = self._fetch_image(tag, url)
+        if image is None:
+            return self._post_detect(tag, {"image_url": (None, url)})
+        return self.detect_fetched(tag, url, image)
+
+    @staticmethod
+    def _image_files(tag: str, url: str, image: dict) -> dict:
+        """Upload the bytes we already hold instead of making Face++ fetch the URL again."""
+        content = image.get("content")
+        if content is None and image.get("path"):
+            try:
+                if os.path.getsize(image["path"]) <= FACEPP_MAX_FILE_BYTES:
+                    with open(image["path"], "rb") as f:
+                        content = f.read()
+            except FileNotFoundError:
+                content = None  # evicted from the store meanwhile
+        if content is not None and len(content) <= FACEPP_MAX_FILE_BYTES:
+            return {"image_file": (tag, content)}
+        return {"image_url": (None, url)}
+
+    def detect_fetched(self, tag: str, url: str, image: dict) -> dict:
+        """
+        Face++ detect for an image already fetched by the caller: `image` is a download
+        result with "sha256" and "path" (or "content"), used as the cache key and
+        uploaded. A failed download ({"error": ...}) falls back to Face++ fetching `url`.
+        """
+        if "error" in image:
+            return self._post_detect(tag, {"image_url": (None, url)})
+        key = None
+        if self.cache is not None:
+            key = DetectionCache.make_key(image["sha256"], FACEPP_ATTRIBUTES)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info(f"[FaceppClient] cache hit tag={tag}")
+                return cached
+        data = self._post_detect(tag, self._image_files(tag, url, image))
+        if key is not None and "error" not in data:
+            self.cache.put(key, data)
+        return data
+
+    def _post_detect(self, tag: str, files: dict) -> dict:
+        """
+        POST one detect request, retrying transient failures (rate limits, 5xx,
+        network errors) with jittered exponential backoff. Returns the parsed JSON
+        response, or {"error": ...} at once for other 4xx responses and once the
+        retries are exhausted.
+        """
+        last_err = None
+        for attempt in range(1, MAX_RETRY + 1):
+            retry_after = None
+            if attempt > 1:
+                RETRIES.inc(service="facepp")
+            try:
+                waited = time.perf_counter()
+                self.limiter.acquire()
+                FACEPP_LIMITER_WAIT.inc(time.perf_counter() - waited)
                 try:
-                    resp = requests.post(
-                        FACEPP_URL,
-                        data={
-                            "api_key": self.api_key,
-                            "api_secret": self.api_secret,
-                            "return_landmark": 0,
-                            "return_attributes": "age,gender,ethnicity"
-                        },
-                        files={"image_url": (None, url)},
-                        timeout=10
-                    )
+                    with external_request("facepp"):
+                        resp = self.session.post(
+                            FACEPP_URL,
+                            data={
+                                "api_key": self.api_key,
+                                "api_secret": self.api_secret,
+                                "return_landmark": 0,
+                                "return_attributes": FACEPP_ATTRIBUTES
+                            },
+                            files=files,
+                            timeout=REQUEST_TIMEOUT
+                        )
+                except requests.RequestException:
+                    FACEPP_REQUESTS.inc(status="error")
+                    raise
+                FACEPP_REQUESTS.inc(status=resp.status_code)
+                if resp.status_code == 429 or (resp.status_code == 403 and _error_message(resp) == CONCURRENCY_ERROR):
+                    retry_after = resp.headers.get("Retry-After")
+                    last_err = requests.HTTPError(f"{resp.status_code} {CONCURRENCY_ERROR}", response=resp)
+                    logger.warning(f"[FaceppClient] Rate limited on {tag} (attempt {attempt})")
+                elif 400 <= resp.status_code < 500:
+                    last_err = requests.HTTPError(f"{resp.status_code} {_error_message(resp)}", response=resp)
+                    logger.warning(f"[FaceppClient] Rejected {tag}: {last_err}")
+                    break
+                else:
                     resp.raise_for_status()
                     data = resp.json()
                     logger.info(f"[FaceppClient] fetched tag={tag}, faces={len(data.get('faces', []))}")
-                    results[tag] = data
-                    break
-                except requests.HTTPError as e:
-                    last_err = e
-                    logger.warning(f"[FaceppClient] HTTPError on {tag} (attempt {attempt}): {e}")
-                except requests.RequestException as e:
-                    last_err = e
-                    logger.warning(f"[FaceppClient] RequestException on {tag} (attempt {attempt}): {e}")
-                time.sleep(RETRY_DELAY)
-            else:
-                logger.error(f"[FaceppClient] Failed to fetch {tag} after {MAX_RETRY} attempts")
-                results[tag] = {"error": str(last_err)}
-        return results
+                    return data
+            except requests.HTTPError as e:
+                last_err = e
+                logger.warning(f"[FaceppClient] HTTPError on {tag} (attempt {attempt}): {e}")
+            except requests.RequestException as e:
+                last_err = e
+                logger.warning(f"[FaceppClient] RequestException on {tag} (attempt {attempt}): {e}")
+            if attempt < MAX_RETRY:
+                time.sleep(_backoff_delay(attempt, retry_after))
+        logger.error(f"[FaceppClient] Failed to fetch {tag} after {attempt} attempts")
+        return {"error": str(last_err)}
+
+    def detect(self, tag: str, url: str) -> dict:
+        """Face++ detect for one image (cached, rate-limited, retried); {"error": ...} on failure."""
+        return self._detect_one(tag, url)
+
+    def detect_batch(
+        self,
+        images: List[Tuple[str, str]],
+        # list of (context_tag, image_url)
+        max_workers: Optional[int] = None
+    ) -> Dict[str, dict]:
+        """
+        Call Face++ detect on each image URL, with retries.
+        Requests run concurrently on up to `max_workers` pooled connections
+        (default: the client's worker count) and are paced by the shared QPS limiter.
+        Returns a mapping from context_tag to parsed JSON response, in input order.
+        """
+        workers = min(max_workers or self.max_workers, len(images))
+        if workers <= 1:
+            return {tag: self._detect_one(tag, url) for tag, url in images}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="facepp") as pool:
+            futures = [pool.submit(self._detect_one, tag, url) for tag, url in images]
+            return {tag: fut.result() for (tag, _), fut in zip(images, futures)}
 
     def check_faces(
         self,
@@ -74,4 +285,4 @@ class FaceppClient:
             # If Face++ returned a 'faces' list, mark True if non-empty
             faces = data.get("faces", [])
             presence[url] = len(faces) > 0  # COMMENT: True if at least one face detected
-        return presence  # COMMENT: return simple URL -> boolean map
+        return presence  # COMMENT: return simple URL -> boolean map
\ No newline at end of file
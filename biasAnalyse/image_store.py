@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Optional
+from telemetry import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_URL_TTL = 3600  # seconds a URL -> content mapping is trusted without revalidation
+IMAGE_FILE = "image"
+
+
+def write_json_atomic(path: str, data: dict):
+    """Write JSON via a temp file and rename, so concurrent readers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class ImageStore:
+    """
+    Content-addressed image store shared by every job on the host.
+
+    Images live in blobs/<sha[:2]>/<sha>/image, keyed by the SHA-256 of their
+    bytes, and derived artifacts (landmarks, skin stats) are written next to
+    them in the same folder. A URL index maps each URL to the blob it last
+    served and its ETag: a known URL is reused without any request for
+    `url_ttl` seconds, then revalidated with If-None-Match. A changed or
+    unknown URL is downloaded, and if its bytes are already stored the existing
+    blob (and its artifacts) is reused.
+
+    Blobs are evicted least recently used first once the store grows past
+    `max_bytes`. Jobs get hard links (or copies) of the blobs, so eviction never
+    touches a running job's files.
+    """
+    def __init__(self, store_dir: str, max_bytes: int = DEFAULT_MAX_BYTES, url_ttl: float = DEFAULT_URL_TTL):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.url_ttl = url_ttl
+        self.blob_root = os.path.join(store_dir, "blobs")
+        self.url_root = os.path.join(store_dir, "urls")
+        self.tmp_dir = os.path.join(store_dir, "tmp")
+        for d in (self.blob_root, self.url_root, self.tmp_dir):
+            os.makedirs(d, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.total_bytes = sum(size for _, _, size in self._blobs())
+
+    @classmethod
+    def from_env(cls, base_tmp: str) -> Optional["ImageStore"]:
+        """Build the store from IMAGE_STORE_* env vars; IMAGE_STORE_MAX_MB=0 disables it."""
+        max_mb = float(os.getenv("IMAGE_STORE_MAX_MB", DEFAULT_MAX_BYTES / (1024 * 1024)))
+        if max_mb <= 0:
+            return None
+        return cls(
+            os.getenv("IMAGE_STORE_DIR", os.path.join(base_tmp, "image_store")),
+            max_bytes=int(max_mb * 1024 * 1024),
+            url_ttl=float(os.getenv("IMAGE_STORE_URL_TTL", DEFAULT_URL_TTL)),
+        )
+
+    def blob_dir(self, sha256: str) -> str:
+        """Folder holding the image and its derived artifacts."""
+        return os.path.join(self.blob_root, sha256[:2], sha256)
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blob_dir(sha256), IMAGE_FILE)
+
+    def _url_path(self, url: str) -> str:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.url_root, key[:2], f"{key}.json")
+
+    def _blobs(self):
+        """Yield (blob_dir, last_used, size of the image plus its artifacts)."""
+        for prefix in os.listdir(self.blob_root):
+            prefix_dir = os.path.join(self.blob_root, prefix)
+            for sha in os.listdir(prefix_dir):
+                folder = os.path.join(prefix_dir, sha)
+                try:
+                    last_used = os.stat(os.path.join(folder, IMAGE_FILE)).st_mtime
+                    size = sum(entry.stat().st_size for entry in os.scandir(folder))
+                except FileNotFoundError:
+                    continue
+                yield folder, last_used, size
+
+    def _hit(self, sha256: str) -> Optional[dict]:
+        path = self._blob_path(sha256)
+        try:
+            # Bump mtime so eviction sees this blob as recently used
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.hits += 1
+        CACHE_REQUESTS.inc(cache="image_store", result="hit")
+        return {"path": path, "sha256": sha256, "bytes": size}
+
+    def fetch(self, tag: str, url: str, downloader) -> dict:
+        """
+        Return the stored image for `url` as {"path", "sha256", "bytes"}, downloading it
+        with `downloader` (an ImageDownloader) only when needed; {"error": ...} on failure.
+        """
+        index_path = self._url_path(url)
+        entry = read_json(index_path)
+        headers = None
+        if entry is not None and os.path.exists(self._blob_path(entry["sha256"])):
+            if time.time() - entry["checked"] < self.url_ttl:
+                hit = self._hit(entry["sha256"])
+                if hit is not None:
+                    return hit
+            elif entry.get("etag"):
+                headers = {"If-None-Match": entry["etag"]}
+
+        tmp = os.path.join(self.tmp_dir, f"{os.getpid()}-{threading.get_ident()}-{time.time_ns()}.part")
+        fetched = downloader.download(tag, url, tmp, headers=headers)
+        if fetched.get("not_modified"):
+            hit = self._hit(entry["sha256"])
+            if hit is not None:
+                self._index(index_path, url, entry["sha256"], entry.get("etag"))
+                return hit
+            # Blob evicted meanwhile: fetch it again unconditionally
+            fetched = downloader.download(tag, url, tmp)
+        if "error" in fetched:
+            return fetched
+
+        sha256 = fetched["sha256"]
+        self._index(index_path, url, sha256, fetched.get("etag"))
+        hit = self._hit(sha256)
+        if hit is not None:
+            # Same bytes under another URL (or a re-download): keep the stored blob and its artifacts
+            os.remove(tmp)
+            return hit
+        with self.lock:
+            self.misses += 1
+        CACHE_REQUESTS.inc(cache="image_store", result="miss")
+        os.makedirs(self.blob_dir(sha256), exist_ok=True)
+        os.replace(tmp, self._blob_path(sha256))
+        self._added(fetched["bytes"])
+        return {"path": self._blob_path(sha256), "sha256": sha256, "bytes": fetched["bytes"]}
+
+    def _index(self, index_path: str, url: str, sha256: str, etag: Optional[str]):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        write_json_atomic(index_path, {"url": url, "sha256": sha256, "etag": etag, "checked": time.time()})
+
+    def _added(self, size: int):
+        with self.lock:
+            self.total_bytes += size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def link(self, sha256: str, dest: str) -> bool:
+        """
+        Place the stored image at `dest` (a job's images folder): hard link, or copy
+        across devices. False if the blob was evicted meanwhile (a miss for the caller).
+        """
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(self._blob_path(sha256), dest)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(self._blob_path(sha256), dest)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def read_artifact(self, sha256: str, name: str) -> Optional[dict]:
+        """A JSON artifact derived from the image, or None if not computed yet."""
+        return read_json(os.path.join(self.blob_dir(sha256), name))
+
+    def evict(self):
+        """Drop least recently used blobs (with their artifacts) until under 90% of max_bytes."""
+        blobs = sorted(self._blobs(), key=lambda b: b[1])
+        total = sum(size for _, _, size in blobs)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for folder, _, size in blobs:
+            if total <= target:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+            removed += 1
+        with self.lock:
+            self.total_bytes = total
+        logger.info(f"[ImageStore] evicted {removed} images, {total} bytes remain")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
@@ -0,0 +1,181 @@
+import os
+import json
+import orjson
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+# Seconds without a heartbeat after which another worker may take a job over
+JOB_LEASE_TTL = float(os.getenv("JOB_LEASE_TTL", "60"))
+
+# Jobs in these states will not change any more
+TERMINAL_STATUSES = ("bias_analyzed", "failed")
+
+
+class JobStore:
+    """
+    Durable job records in SQLite, shared by every uvicorn worker on the host.
+    Each row stores the original request, the current pipeline status, and the
+    final response (or error) once the job finishes. Each worker process gets a
+    random owner id and renews a lease (`heartbeat`) on its unfinished jobs;
+    jobs whose lease is older than `lease_ttl` seconds are taken over by
+    another worker, so a dead worker's jobs neither get lost nor count as
+    active forever.
+    """
+    def __init__(self, db_path: str, lease_ttl: float = JOB_LEASE_TTL):
+        self.db_path = db_path
+        self.lease_ttl = max(1.0, lease_ttl)
+        # Random per process start: host:pid pairs are reused in containers
+        self.owner = f"{socket.gethostname()}:{uuid.uuid4().hex}"
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id  TEXT PRIMARY KEY,
+                    status  TEXT NOT NULL,
+                    owner   TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result  TEXT,
+                    error   TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    heartbeat REAL
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat" not in columns:
+                # Stores created before leases: `updated` stands in until the first heartbeat
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call keeps the store safe to use from any thread
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, job_id: str, request: dict, max_active: Optional[int] = None) -> bool:
+        """
+        Record a new queued job. With `max_active`, nothing is inserted and False is
+        returned when that many jobs are already unfinished; the count and the insert
+        share one write transaction, so concurrent submissions cannot both slip in.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if max_active is not None and self._count_active(conn) >= max_active:
+                return False
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, owner, request, created, updated, heartbeat) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, self.owner, json.dumps(request), now, now, now),
+            )
+        return True
+
+    def update(self, job_id: str, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = COALESCE(?, result), error = COALESCE(?, error), updated = ? WHERE job_id = ?",
+                (status, None if result is None else self.encode(result), error, time.time(), job_id),
+            )
+
+    @staticmethod
+    def encode(result: dict) -> str:
+        # NaN is stored as null and NumPy values are encoded natively
+        return orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def get(self, job_id: str, parse_result: bool = True) -> Optional[dict]:
+        """Job row as a dict; with parse_result=False the result stays an encoded JSON string."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        if parse_result and job["result"] is not None:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def finished(self, skip=frozenset()):
+        """Yield (job_id, created, request, result) of every successful job not in `skip`, oldest first."""
+        with closing(self._connect()) as conn:
+            ids = [
+                row[0] for row in conn.execute("SELECT job_id FROM jobs WHERE status = 'bias_analyzed' ORDER BY created")
+                if row[0] not in skip
+            ]
+            for job_id in ids:
+                row = conn.execute("SELECT created, request, result FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                if row is not None and row["result"] is not None:
+                    yield job_id, row["created"], json.loads(row["request"]), json.loads(row["result"])
+
+    @staticmethod
+    def _count_active(conn: sqlite3.Connection) -> int:
+        """Jobs queued or running across all workers, used for queue-depth back-pressure."""
+        placeholders = ",".join("?" * len(TERMINAL_STATUSES))
+        return conn.execute(
+            f"SELECT COUNT(*) FROM jobs WHERE status NOT IN ({placeholders})", TERMINAL_STATUSES
+        ).fetchone()[0]
+
+    def heartbeat(self):
+        """Renew the lease on every unfinished job of this worker."""
+        placeholders = ",".join("?" * len(TERMINAL_STATUSES))
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status NOT IN ({placeholders})",
+                (time.time(), self.owner, *TERMINAL_STATUSES),
+            )
+
+    def claim_orphans(self) -> List[Tuple[str, dict]]:
+        """
+        Take over unfinished jobs of other workers whose lease expired (e.g. the
+        worker died) and return (job_id, request) so they can be resubmitted.
+        """
+        placeholders = ",".join("?" * len(TERMINAL_STATUSES))
+        now = time.time()
+        claimed = []
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                f"SELECT job_id, owner, request FROM jobs WHERE status NOT IN ({placeholders}) "
+                "AND owner != ? AND COALESCE(heartbeat, updated) < ?",
+                (*TERMINAL_STATUSES, self.owner, now - self.lease_ttl),
+            ).fetchall()
+            for row in rows:
+                # Only claim if nobody else did in the meantime
+                cur = conn.execute(
+                    "UPDATE jobs SET owner = ?, status = 'queued', updated = ?, heartbeat = ? WHERE job_id = ? AND owner = ?",
+                    (self.owner, now, now, row["job_id"], row["owner"]),
+                )
+                if cur.rowcount:
+                    claimed.append((row["job_id"], json.loads(row["request"])))
+        return claimed
+
+    def start_heartbeat(self, resume: Callable[[str, dict], None]):
+        """
+        Renew this worker's leases every third of `lease_ttl` on a daemon thread,
+        and pass orphaned jobs it claims meanwhile to `resume(job_id, request)`.
+        """
+        if self._heartbeat_thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.heartbeat()
+                    for job_id, request in self.claim_orphans():
+                        resume(job_id, request)
+                except Exception as e:
+                    logger.error(f"[JobStore] Heartbeat failed: {e}")
+                time.sleep(self.lease_ttl / 3)
+
+        self._heartbeat_thread = threading.Thread(target=loop, name="job-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
@@ -1,120 +1,135 @@
 import os
-import json
-import csv
-from typing import Dict
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional
 
-class MetricCalculator:
+METRIC_COLUMNS = [
+    "image_name",
+    "original_avg_darkness",
+    "transformed_avg_darkness",
+    "original_age",
+    "transformed_age",
+    "age_delta",
+    "original_gender",
+    "transformed_gender",
+    "gender_flag",
+]
+
+def first_face(data: dict):
     """
-    Computes per-image metrics (ΔAge, gender flag, original_avg_darkness,
-    and transformed_avg_darkness) by comparing Face++ JSON outputs
-    and skin darkness CSVs.
+    (age, gender) of the first face in a Face++ detect response, or (None, None)
+    if no face was found. Raises KeyError on a face without attributes; failed
+    calls ({"error": ...}) are for the caller to report.
     """
-    def __init__(self, job_id: str, base_tmp: str = "/tmp", skin_map: Dict[str, str] = None):  # COMMENT: skin_map now includes 'originals' key
-        self.job_dir    = os.path.join(base_tmp, job_id)
-        self.facepp_dir = os.path.join(self.job_dir, "facepp")
-        self.metrics_dir= os.path.join(self.job_dir, "metrics")
-        os.makedirs(self.metrics_dir, exist_ok=True)
-        self.skin_map   = skin_map or {}  # COMMENT: skin_map["originals"] ➞ original CSV; skin_map[occ] ➞ transformed CSV
-
-    def compute(self) -> Dict[str, str]:
-        orig_dir      = os.path.join(self.facepp_dir, "originals")
-        transforms_dir= os.path.join(self.facepp_dir, "transforms")
-        output_files  = {}
-
-        # Pre-load original darkness lookup once
-        orig_skin_csv    = self.skin_map.get("originals")                # COMMENT
-        orig_dark_lookup = {}
-        if orig_skin_csv and os.path.isfile(orig_skin_csv):            # COMMENT
-            with open(orig_skin_csv) as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    orig_dark_lookup[row["image_name"].split(".")[0]] = row["avg_darkness"]
+    faces = data.get("faces", [])
+    if not faces:
+        return None, None
+    attributes = faces[0]["attributes"]
+    return attributes["age"]["value"], attributes["gender"]["value"]
 
-        # For each occupation folder under transforms
-        for occ in os.listdir(transforms_dir):
-            occ_folder = os.path.join(transforms_dir, occ)
-            csv_path   = os.path.join(self.metrics_dir, f"{occ}.csv")
+def darkness_frame(df: Optional[pd.DataFrame], column: str) -> pd.DataFrame:
+    """SkinAnalyzer table -> image_name (file stem) / <column> frame."""
+    if df is None:
+        return pd.DataFrame(columns=["image_name", column])
+    stems = df["image_name"].map(lambda fn: os.path.splitext(fn)[0])
+    return pd.DataFrame({"image_name": stems, column: df["avg_darkness"].astype(float)})
 
-            # Load transformed darkness lookup
-            trans_skin_csv    = self.skin_map.get(occ)                   # COMMENT
-            trans_dark_lookup = {}
-            if trans_skin_csv and os.path.isfile(trans_skin_csv):      # COMMENT
-                with open(trans_skin_csv) as f2:
-                    reader2 = csv.DictReader(f2)
-                    for row in reader2:
-                        trans_dark_lookup[row["image_name"].split(".")[0]] = row["avg_darkness"]
+class MetricCalculator:
+    """
+    Computes per-image metrics (ΔAge, gender flag, original_avg_darkness,
+    and transformed_avg_darkness) from parsed Face++ responses and skin darkness tables.
 
-            with open(csv_path, "w", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                # COMMENT: expanded header to include both darkness columns
-                writer.writerow([
-                    "image_name",
-                    "original_avg_darkness",     # COMMENT
-                    "transformed_avg_darkness",  # COMMENT
-                    "original_age",
-                    "transformed_age",
-                    "age_delta",
-                    "original_gender",
-                    "transformed_gender",
-                    "gender_flag"
-                ])
+    `detections` is {"originals": {stem: response}, "transforms": {occupation: {stem: response}}},
+    parsed once; all occupations are joined against the originals in one frame and
+    the deltas/flags are computed column-wise.
+    """
+    def __init__(self, detections: Dict[str, dict], skin_map: Dict[str, Optional[pd.DataFrame]] = None):
+        self.detections = detections
+        self.skin_map   = skin_map or {}  # skin_map["originals"] ➞ original darkness; skin_map[occ] ➞ transformed darkness
+        self.skipped: List[dict] = []
 
-                for fname in sorted(os.listdir(occ_folder)):
-                    try:
-                        # Load transformed JSON
-                        with open(os.path.join(occ_folder, fname)) as f:
-                            data_t = json.load(f)
+    def _skip(self, image_name, occupation, reason):
+        self.skipped.append({"image_name": image_name, "occupation": occupation, "reason": reason})
 
-                        # Derive image_name (e.g. "9568.jpg")
-                        image_name = fname.split('-', 1)[1].rsplit('.json', 1)[0]
-                        # print(f"data_t: {data_t}")
-                        # print(f"orig_dark_lookup: {orig_dark_lookup}")
-                        # print(f"trans_dark_lookup: {trans_dark_lookup}")
+    def _originals_frame(self) -> pd.DataFrame:
+        rows = []
+        for stem, data in self.detections.get("originals", {}).items():
+            if "error" in data:
+                self._skip(stem, None, f"Face++ failed: {data['error']}")
+                continue
+            try:
+                age, gender = first_face(data)
+            except KeyError as e:
+                self._skip(stem, None, f"malformed Face++ response: missing {e}")
+                continue
+            if age is None:
+                self._skip(stem, None, "no face detected in original")
+                continue
+            rows.append((stem, age, gender))
+        return pd.DataFrame(rows, columns=["image_name", "original_age", "original_gender"])
 
-                        # Load original JSON
-                        orig_json_path = os.path.join(orig_dir, f"orig-{image_name}.json")
-                        with open(orig_json_path) as f:
-                            data_o = json.load(f)
+    def _transforms_frame(self, occupations: Optional[List[str]]) -> pd.DataFrame:
+        rows = []
+        for occ, results in self.detections.get("transforms", {}).items():
+            if occupations is not None and occ not in occupations:
+                continue
+            for stem, data in results.items():
+                # A failed call says nothing about the face: report it rather than count a face-less transform
+                if "error" in data:
+                    self._skip(stem, occ, f"Face++ failed: {data['error']}")
+                    continue
+                try:
+                    age, gender = first_face(data)
+                except KeyError as e:
+                    self._skip(stem, occ, f"malformed Face++ response: missing {e}")
+                    continue
+                # a transform without a face keeps its row with empty attributes
+                rows.append((occ, stem, age, gender))
+        return pd.DataFrame(rows, columns=["occupation", "image_name", "transformed_age", "transformed_gender"])
 
-                        faces_o = data_o.get("faces", [])
-                        faces_t = data_t.get("faces", [])
-                        # skip if no face detected in original
-                        if not faces_o:
-                            continue
-                        # always get original attributes
-                        age_o = faces_o[0]["attributes"]["age"]["value"]
-                        gen_o = faces_o[0]["attributes"]["gender"]["value"]
-                        # assign None if no transformed face detected
-                        if not faces_t:
-                            age_t = None
-                            gen_t = None
-                        else:
-                            age_t = faces_t[0]["attributes"]["age"]["value"]
-                            gen_t = faces_t[0]["attributes"]["gender"]["value"]
-                        # compute delta and flag, or None if missing
-                        delta = None if age_t is None else age_t - age_o
-                        flag = None if gen_t is None else (1 if gen_t != gen_o else 0)
+    def compute_frame(self, occupations: List[str] = None) -> pd.DataFrame:
+        """
+        One row per (occupation, image) with every metric column, for all
+        occupations or only those in `occupations`. Skipped images are listed in self.skipped.
+        """
+        self.skipped = []
+        originals = self._originals_frame()
+        frame = self._transforms_frame(occupations)
 
-                        # COMMENT: lookup darkness values
-                        orig_dark = orig_dark_lookup.get(image_name, "")
-                        trans_dark= trans_dark_lookup.get(image_name, "")
+        # Transforms whose original has no usable face are dropped, and reported
+        known = frame["image_name"].isin(originals["image_name"])
+        orphans = ~known & ~frame["image_name"].isin(list(self.detections.get("originals", {})))
+        for occ, stem in frame.loc[orphans, ["occupation", "image_name"]].itertuples(index=False):
+            self._skip(stem, occ, "no original image with this name")
+        frame = frame[known].merge(originals, on="image_name", how="left")
 
-                        writer.writerow([
-                            image_name,
-                            orig_dark,     # COMMENT
-                            trans_dark,    # COMMENT
-                            age_o,
-                            age_t,
-                            delta,
-                            gen_o,
-                            gen_t,
-                            flag
-                        ])
+        # Darkness: originals join on image, transforms on (occupation, image)
+        frame = frame.merge(darkness_frame(self.skin_map.get("originals"), "original_avg_darkness"),
+                            on="image_name", how="left")
+        trans_dark = [
+            darkness_frame(self.skin_map.get(occ), "transformed_avg_darkness").assign(occupation=occ)
+            for occ in frame["occupation"].unique()
+        ]
+        if trans_dark:
+            frame = frame.merge(pd.concat(trans_dark, ignore_index=True), on=["occupation", "image_name"], how="left")
+        else:
+            frame["transformed_avg_darkness"] = np.nan
 
-                    except Exception as e:
-                        print(f"Skipping {fname}: {e}")
-                        continue
+        # Vectorized deltas and flags; missing transformed attributes stay NaN
+        frame["transformed_age"] = frame["transformed_age"].astype(float)
+        frame["age_delta"] = frame["transformed_age"] - frame["original_age"]
+        frame["gender_flag"] = (frame["transformed_gender"] != frame["original_gender"]).astype(float)
+        frame.loc[frame["transformed_gender"].isna(), "gender_flag"] = np.nan
+        frame = frame.astype({"original_avg_darkness": float, "transformed_avg_darkness": float})
 
-            output_files[occ] = csv_path
+        return frame.sort_values(["occupation", "image_name"], kind="stable")[["occupation"] + METRIC_COLUMNS]
 
-        return output_files
\ No newline at end of file
+    def compute(self, occupations: List[str] = None) -> Dict[str, pd.DataFrame]:
+        """
+        Returns {occupation: metrics DataFrame (METRIC_COLUMNS)} for all occupations
+        or only those in `occupations`.
+        """
+        frame = self.compute_frame(occupations)
+        wanted = occupations if occupations is not None else list(self.detections.get("transforms", {}))
+        by_occ = {occ: df.drop(columns="occupation").reset_index(drop=True) for occ, df in frame.groupby("occupation", sort=False)}
+        return {occ: by_occ.get(occ, pd.DataFrame(columns=METRIC_COLUMNS)) for occ in wanted}
@@ -0,0 +1,50 @@
+import os
+import json
+from typing import Dict, Optional
+import pandas as pd
+from bias_analyzer import bias_matrices
+
+
+def tidy_results(metrics: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    One row per (occupation, image): the per-image metrics plus the three bias
+    values. Every consolidated table and bias matrix is a pivot of this frame.
+    """
+    frames = [df.assign(occupation=occ) for occ, df in metrics.items()]
+    tidy = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if tidy.empty:
+        return tidy
+    tidy["age_bias"], tidy["gender_bias"], tidy["race_bias"] = bias_matrices(
+        tidy["age_delta"], tidy["gender_flag"],
+        tidy["original_avg_darkness"], tidy["transformed_avg_darkness"],
+    )
+    return tidy[["occupation"] + [c for c in tidy.columns if c != "occupation"]]
+
+
+class ParquetSink:
+    """
+    Persists a finished job as a single Parquet file (<out_dir>/<job_id>.parquet).
+    The bias summary is stored in the file's key/value metadata under "biaslens".
+    Requires pyarrow.
+    """
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, base_tmp: str) -> Optional["ParquetSink"]:
+        """RESULT_SINK=parquet enables the sink; RESULT_SINK_DIR overrides where files go."""
+        if os.getenv("RESULT_SINK", "").lower() != "parquet":
+            return None
+        return cls(os.getenv("RESULT_SINK_DIR", os.path.join(base_tmp, "results")))
+
+    def write(self, job_id: str, metrics: Dict[str, pd.DataFrame], summary: dict) -> str:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(tidy_results(metrics), preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"biaslens"] = json.dumps({"job_id": job_id, "summary": summary}).encode()
+        path = os.path.join(self.out_dir, f"{job_id}.parquet")
+        pq.write_table(table.replace_schema_metadata(metadata), path)
+        return path
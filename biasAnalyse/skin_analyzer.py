@@ -2,120 +2,275 @@ import os
 import cv2
 import numpy as np
 import pandas as pd
-from PIL import Image
+import tempfile
+import multiprocessing
 import mediapipe as mp  # COMMENT: using mediapipe for face detection and landmarks
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from image_store import read_json, write_json_atomic
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+SKIN_WORKERS = int(os.getenv("SKIN_WORKERS", "1"))
+# Longest side FaceMesh sees; larger images are downscaled for detection only (0 = full resolution)
+SKIN_LANDMARK_MAX_SIDE = int(os.getenv("SKIN_LANDMARK_MAX_SIDE", "0"))
+LANDMARKS_FILE = "landmarks.npy"
+
+
+def new_face_mesh():
+    return mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=True,
+        max_num_faces=1,
+        refine_landmarks=False,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5,
+    )
+
+
+def face_regions() -> Tuple[List[int], List[int], List[int]]:
+    """Landmark indices of the face oval, both eyes and the lips, from the FaceMesh connection tables."""
+    def idxs(*connections):
+        return sorted({i for conns in connections for conn in conns for i in conn})
+    fm = mp.solutions.face_mesh
+    return idxs(fm.FACEMESH_FACE_OVAL), idxs(fm.FACEMESH_LEFT_EYE, fm.FACEMESH_RIGHT_EYE), idxs(fm.FACEMESH_LIPS)
+
+
+def skin_stats_name(hsv_thresh, max_side: int = 0) -> str:
+    """Artifact file holding the skin stats computed with `hsv_thresh` (and landmark resolution)."""
+    suffix = f"-lm{max_side}" if max_side else ""
+    return "skin-" + "-".join(str(v) for v in hsv_thresh) + suffix + ".json"
+
+
+def face_landmarks(face_mesh, img, artifact_dir=None, max_side: int = 0) -> Optional[np.ndarray]:
+    """
+    Normalized (x, y) FaceMesh landmarks of the first face, or None if there is
+    none. With `max_side`, FaceMesh runs on a copy downscaled to at most that
+    many pixels on its longest side; normalized coordinates map straight back
+    to the full image. With `artifact_dir` the result (including "no face") is
+    cached there.
+    """
+    name = LANDMARKS_FILE if not max_side else LANDMARKS_FILE.replace(".npy", f"-{max_side}.npy")
+    path = os.path.join(artifact_dir, name) if artifact_dir else None
+    if path and os.path.exists(path):
+        lm = np.load(path)
+        return lm if len(lm) else None
+    h, w = img.shape[:2]
+    if max_side and max(h, w) > max_side:
+        scale = max_side / max(h, w)
+        # Bilinear: INTER_AREA on a large image costs as much as FaceMesh itself
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_LINEAR)
+    results = face_mesh.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    lm = None
+    if results.multi_face_landmarks:
+        lm = np.array([(p.x, p.y) for p in results.multi_face_landmarks[0].landmark], dtype=np.float32)
+    if path:
+        fd, tmp = tempfile.mkstemp(dir=artifact_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, lm if lm is not None else np.empty((0, 2), dtype=np.float32))
+        os.replace(tmp, path)
+    return lm
+
+
+def skin_darkness(face_mesh, img_path, regions, hsv_thresh, debug_dir=None, artifact_dir=None,
+                  max_side: int = 0) -> Optional[float]:
+    """
+    Single-pass skin darkness for one image: decode once, run FaceMesh, mask the
+    face oval minus eyes and mouth, apply the HSV threshold and return the mean
+    grayscale value of the masked image. Returns None if no face is found.
+    `regions` is the (oval, eyes, lips) index lists from face_regions(), and
+    `max_side` the landmark detection resolution (see face_landmarks); masking
+    always uses the full-resolution image.
+    When `debug_dir` is given, the face crop and HSV-masked images are written
+    to its faceCrop/ and HSV/ subfolders. When `artifact_dir` is given (the
+    image's folder in the ImageStore), the landmarks and skin stats are cached there.
+    """
+    stats_path = os.path.join(artifact_dir, skin_stats_name(hsv_thresh, max_side)) if artifact_dir else None
+    if stats_path and not debug_dir:
+        stats = read_json(stats_path)
+        if stats is not None:
+            return stats["avg_darkness"]
+    img = cv2.imread(img_path)
+    if img is None:
+        return None
+    lm = face_landmarks(face_mesh, img, artifact_dir, max_side)
+    if lm is None:
+        if stats_path:
+            write_json_atomic(stats_path, {"avg_darkness": None})
+        return None
+    face_oval_idxs, eye_idxs, lips_idxs = regions
+    h, w = img.shape[:2]
+    pts = (lm.astype(np.float64) * (w, h)).astype(np.int32)
+    # build convex hull of face oval for smooth region
+    hull = cv2.convexHull(pts[face_oval_idxs])
+    # Everything outside the hull is masked to 0, so only its bounding box (clipped to the image) is processed
+    x, y, bw, bh = cv2.boundingRect(hull)
+    x0, y0 = min(max(x, 0), w - 1), min(max(y, 0), h - 1)
+    x1, y1 = max(min(x + bw, w), x0 + 1), max(min(y + bh, h), y0 + 1)
+    roi = img[y0:y1, x0:x1]
+    offset = np.array([x0, y0], dtype=np.int32)
+    # mask out eyes and mouth
+    mask = np.zeros(roi.shape[:2], dtype=np.uint8)
+    cv2.fillPoly(mask, [hull - offset], 1)
+    cv2.fillPoly(mask, [pts[eye_idxs] - offset], 0)
+    cv2.fillPoly(mask, [pts[lips_idxs] - offset], 0)
+    cropped = cv2.bitwise_and(roi, roi, mask=mask)
+
+    # HSV threshold on the cropped face, kept in memory
+    hmin, hmax, smin, smax, vmin, vmax = hsv_thresh
+    hsv = cv2.cvtColor(cropped, cv2.COLOR_BGR2HSV)
+    hsv_mask = cv2.inRange(hsv, np.array([hmin, smin, vmin]), np.array([hmax, smax, vmax]))
+    res = cv2.bitwise_and(cropped, cropped, mask=hsv_mask)
+
+    if debug_dir:
+        fn = os.path.basename(img_path)
+        for sub, out in (("faceCrop", cropped), ("HSV", res)):
+            frame = np.zeros_like(img)
+            frame[y0:y1, x0:x1] = out
+            os.makedirs(os.path.join(debug_dir, sub), exist_ok=True)
+            cv2.imwrite(os.path.join(debug_dir, sub, fn), frame)
+
+    # Mean over the whole frame (background pixels are 0), as avg_darkness has always been defined
+    gray = cv2.cvtColor(res, cv2.COLOR_BGR2GRAY)
+    darkness = float(gray.sum(dtype=np.int64)) / (h * w)
+    if stats_path:
+        write_json_atomic(stats_path, {
+            "avg_darkness": darkness,
+            "face_pixels": int(np.count_nonzero(mask)),
+            "skin_pixels": int(np.count_nonzero(hsv_mask & mask)),
+        })
+    return darkness
+
+
+# ---------- Worker pools: one FaceMesh per worker, reused across images and jobs ----------
+_worker_face_mesh = None
+_pools: Dict[int, Executor] = {}
+
+
+def _init_worker():
+    global _worker_face_mesh
+    _worker_face_mesh = new_face_mesh()
+
+
+def _worker_darkness(args):
+    return skin_darkness(_worker_face_mesh, *args)
+
+
+def _get_pool(workers: int) -> Executor:
+    """
+    Pools are kept alive between jobs so FaceMesh start-up is paid once per worker.
+    workers == 1 is a single in-process thread (its FaceMesh is the module global).
+    """
+    pool = _pools.get(workers)
+    if pool is None:
+        if workers == 1:
+            pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="skin", initializer=_init_worker)
+        else:
+            # spawn: forking a process that already runs MediaPipe / server threads is unsafe
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        _pools[workers] = pool
+    return pool
+
 
 class SkinAnalyzer:
-    def __init__(self, job_id, base_tmp, hsv_thresh=(0, 179, 0, 255, 0, 255)):
+    def __init__(self, job_id, base_tmp, hsv_thresh=(0, 179, 0, 255, 0, 255), save_debug=None, workers=None,
+                 landmark_max_side=None):
         self.job_id = job_id
         self.base_tmp = base_tmp
         self.hsv_thresh = hsv_thresh
+        # Debug crops are opt-in: pass save_debug=True or set SKIN_DEBUG=1
+        self.save_debug = save_debug if save_debug is not None else os.getenv("SKIN_DEBUG") == "1"
+        # workers > 1 spreads images over a process pool; 1 keeps the serial in-process path
+        self.workers = max(1, workers or SKIN_WORKERS)
+        # Downscale large images for landmark detection only (0 = full resolution)
+        self.landmark_max_side = SKIN_LANDMARK_MAX_SIDE if landmark_max_side is None else landmark_max_side
         # Directories
         self.orig_dir = os.path.join(base_tmp, job_id, "images/originals")
         self.trans_dir = os.path.join(base_tmp, job_id, "images/transforms")
-        self.skin_root = os.path.join(base_tmp, job_id, "skin")
-        os.makedirs(self.skin_root, exist_ok=True)
-        # Load mediapipe FaceMesh
-        self.mp_face = mp.solutions.face_mesh  # COMMENT
-        self.face_mesh = self.mp_face.FaceMesh(
-            static_image_mode=True,
-            max_num_faces=1,
-            refine_landmarks=False,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5,
-        )  # COMMENT
-        # Precompute face oval landmark indices
-        oval_conns = mp.solutions.face_mesh.FACEMESH_FACE_OVAL
-        self.face_oval_idxs = sorted({i for i, j in oval_conns} | {j for i, j in oval_conns})  # COMMENT
-
-    def _face_crop_dir(self, input_dir, out_subdir):
-        out_dir = os.path.join(self.skin_root, out_subdir, "faceCrop")
-        os.makedirs(out_dir, exist_ok=True)
-        for fn in os.listdir(input_dir):
-            if not fn.lower().endswith((".jpg", ".jpeg", ".png")):
-                continue
-            img = cv2.imread(os.path.join(input_dir, fn))
-            rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            results = self.face_mesh.process(rgb)
-            if not results.multi_face_landmarks:
-                continue
-            lm = results.multi_face_landmarks[0].landmark
-            h, w = img.shape[:2]
-            pts = np.array([(int(p.x * w), int(p.y * h)) for p in lm], dtype=np.int32)
-            # build convex hull of face oval for smooth region
-            oval_pts = pts[self.face_oval_idxs]  # COMMENT
-            hull = cv2.convexHull(oval_pts)    # COMMENT: compute convex hull for smooth mask
-            # mask out eyes and mouth
-            eye_idxs = sorted({i for conn in mp.solutions.face_mesh.FACEMESH_LEFT_EYE for i in conn}
-                              | {i for conn in mp.solutions.face_mesh.FACEMESH_RIGHT_EYE for i in conn})
-            lips_idxs = sorted({i for conn in mp.solutions.face_mesh.FACEMESH_LIPS for i in conn})
-            eyes = pts[eye_idxs]
-            mouth = pts[lips_idxs]
-            mask = np.zeros(img.shape[:2], dtype=np.uint8)
-            cv2.fillPoly(mask, [hull], 1)  # COMMENT: fill convex hull region
-            cv2.fillPoly(mask, [eyes], 0) # COMMENT: carve out eyes
-            cv2.fillPoly(mask, [mouth], 0) # COMMENT: carve out mouth
-            cropped = cv2.bitwise_and(img, img, mask=mask)
-            cv2.imwrite(os.path.join(out_dir, fn), cropped)
-        return out_dir
-
-    def _convert_hsv_dir(self, input_dir, out_subdir):
-        hmin, hmax, smin, smax, vmin, vmax = self.hsv_thresh
-        out_dir = os.path.join(self.skin_root, out_subdir, "HSV")
-        os.makedirs(out_dir, exist_ok=True)
-        for fn in os.listdir(input_dir):
-            if not fn.lower().endswith((".jpg", ".jpeg", ".png")):
-                continue
-            img = cv2.imread(os.path.join(input_dir, fn))
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            mask = cv2.inRange(hsv, np.array([hmin, smin, vmin]), np.array([hmax, smax, vmax]))
-            res = cv2.bitwise_and(img, img, mask=mask)
-            cv2.imwrite(os.path.join(out_dir, fn), res)
-        return out_dir
-
-    def _compute_darkness(self, input_dir, original_dir, out_subdir):
-        records = []
-        # Determine reference image names from original_dir
-        ref_files = [fn for fn in os.listdir(original_dir)
-                     if fn.lower().endswith((".jpg", ".jpeg", ".png"))]
-        hsv_files = {fn for fn in os.listdir(input_dir)
-                     if fn.lower().endswith((".jpg", ".jpeg", ".png"))}
-        for fn in ref_files:
-            if fn not in hsv_files:
-                # HSV version missing: record None
-                records.append({"image_name": fn, "avg_darkness": None})
-            else:
-                # Compute darkness for available HSV image
-                img_path = os.path.join(input_dir, fn)
-                # print(f"Processing {fn} in {input_dir}")
-                img = Image.open(img_path).convert("L")
-                arr = np.array(img)
-                # print(f"Processing {fn}: shape={arr.shape}, dtype={arr.dtype}, darkness={arr.mean()}")
-                records.append({"image_name": fn, "avg_darkness": float(arr.mean())})
-        out_csv_dir = os.path.join(self.skin_root, out_subdir)
-        os.makedirs(out_csv_dir, exist_ok=True)
-        out_csv = os.path.join(out_csv_dir, "avg_darkness.csv")
-        pd.DataFrame(records).to_csv(out_csv, index=False)
-        return out_csv
-
-    def analyze(self):
-        result = {}
-        orig_fc = self._face_crop_dir(self.orig_dir, "originals")
-        # If no faces detected for originals, set value to None
-        if not os.listdir(orig_fc):
-            result["originals"] = None
-        else:
-            orig_hsv = self._convert_hsv_dir(orig_fc, "originals")
-            result["originals"] = self._compute_darkness(orig_hsv, self.orig_dir, "originals")
+        self.skin_root = os.path.join(base_tmp, job_id, "skin")  # debug crops only
+        # mediapipe FaceMesh for the serial path, created on first use
+        self._face_mesh = None
+        # Precompute face oval, eye and lip landmark indices once, not per image
+        self.regions = face_regions()
+
+    @property
+    def face_mesh(self):
+        if self._face_mesh is None:
+            self._face_mesh = new_face_mesh()
+        return self._face_mesh
+
+    @property
+    def executor(self) -> Executor:
+        """Pool that runs `darkness_fn`: the process pool, or one skin thread in serial mode."""
+        return _get_pool(self.workers)
+
+    def image_path(self, folder: str, filename: str) -> str:
+        """Where the pipeline stores an image of `folder` ("originals" or an occupation)."""
+        input_dir = self.orig_dir if folder == "originals" else os.path.join(self.trans_dir, folder)
+        return os.path.join(input_dir, filename)
+
+    # Runs on `executor` with the argument from darkness_args()
+    darkness_fn = staticmethod(_worker_darkness)
+
+    def darkness_args(self, folder: str, filename: str, artifact_dir: Optional[str] = None):
+        """
+        Argument of darkness_fn for one stored image; `artifact_dir` caches its
+        landmarks and skin stats (see skin_darkness).
+        """
+        debug_dir = os.path.join(self.skin_root, folder) if self.save_debug else None
+        return (self.image_path(folder, filename), self.regions, self.hsv_thresh, debug_dir, artifact_dir,
+                self.landmark_max_side)
+
+    @property
+    def stats_name(self) -> str:
+        """Artifact name under which this analyzer's skin stats are cached."""
+        return skin_stats_name(self.hsv_thresh, self.landmark_max_side)
+
+    def _folders(self) -> List[Tuple[str, str]]:
+        """(out_subdir, input_dir) for the originals and every occupation folder."""
+        folders = [("originals", self.orig_dir)]
         for occ in os.listdir(self.trans_dir):
             occ_in = os.path.join(self.trans_dir, occ)
-            if not os.path.isdir(occ_in):
-                continue
-            fc = self._face_crop_dir(occ_in, occ)
-            # If no faces detected for this transform, set value to None
-            if not os.listdir(fc):
-                result[occ] = None
-                continue
-            hsv = self._convert_hsv_dir(fc, occ)
-            result[occ] = self._compute_darkness(hsv, occ_in, occ)
-        return result
\ No newline at end of file
+            if os.path.isdir(occ_in):
+                folders.append((occ, occ_in))
+        return folders
+
+    @staticmethod
+    def to_frame(records):
+        """
+        image_name / avg_darkness table for one folder (avg_darkness is NaN where
+        no face was found), or None if no image had a face.
+        """
+        if all(r["avg_darkness"] is None for r in records):
+            return None
+        return pd.DataFrame(records, columns=["image_name", "avg_darkness"]).astype({"avg_darkness": float})
+
+    def analyze(self, folders=None):
+        """
+        Returns {folder: darkness DataFrame or None} for the originals and every
+        occupation, or only for the folder names listed in `folders`. Used by the
+        benchmarks; the service runs one darkness_fn task per image instead.
+        """
+        # One task per image across all folders, so the pool stays busy past folder boundaries
+        folders = [f for f in self._folders() if folders is None or f[0] in folders]
+        tasks = []
+        for out_subdir, input_dir in folders:
+            debug_dir = os.path.join(self.skin_root, out_subdir) if self.save_debug else None
+            for fn in sorted(os.listdir(input_dir)):
+                if fn.lower().endswith(IMAGE_EXTS):
+                    tasks.append((out_subdir, fn, (os.path.join(input_dir, fn), self.regions, self.hsv_thresh, debug_dir,
+                                                   None, self.landmark_max_side)))
+
+        if self.workers > 1 and len(tasks) > 1:
+            chunksize = max(1, len(tasks) // (self.workers * 4))
+            values = list(_get_pool(self.workers).map(_worker_darkness, [t[2] for t in tasks], chunksize=chunksize))
+        else:
+            values = [skin_darkness(self.face_mesh, *t[2]) for t in tasks]
+
+        records = {out_subdir: [] for out_subdir, _ in folders}
+        for (out_subdir, fn, _), darkness in zip(tasks, values):
+            records[out_subdir].append({"image_name": fn, "avg_darkness": darkness})
+        # If no faces are detected in a folder, its value is None
+        return {out_subdir: self.to_frame(recs) for out_subdir, recs in records.items()}
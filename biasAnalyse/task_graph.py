@@ -0,0 +1,142 @@
+import time
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TaskGraph:
+    """
+    Runs a DAG of small tasks over named executors (e.g. a network pool and a
+    CPU pool). A task is submitted as soon as all of its dependencies have
+    finished, so independent chains overlap instead of waiting on stage
+    barriers; `run()` is the only join.
+
+    Tasks on the "local" pool run on a single thread owned by the graph, which
+    suits cheap joins such as building a table from finished tasks. A task with
+    `prepare` gets its arguments from prepare(*dependency_results), or is skipped
+    (result None) when that returns None.
+
+    `on_task(key, start, end)` (time.perf_counter values) is called as each task
+    finishes. On thread pools start is when the task began running; on other
+    executors (process pools) it is when it was submitted, so queueing counts.
+    """
+    def __init__(self, pools: Dict[str, Executor], on_task: Optional[Callable[[Hashable, float, float], None]] = None):
+        self.pools = dict(pools)
+        self.on_task = on_task
+        self.results: Dict[Hashable, Any] = {}
+        self._tasks = {}  # key -> (fn, args, deps, pool, prepare)
+        self._dependents = defaultdict(list)
+        self._waiting: Dict[Hashable, int] = {}
+        self._remaining = 0
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add(self, key: Hashable, fn: Callable, *args, after: Iterable[Hashable] = (), pool: str = "local",
+            prepare: Optional[Callable[..., Optional[tuple]]] = None):
+        """Register `fn(*args)` to run on `pool` once every task in `after` has finished."""
+        if key in self._tasks:
+            raise ValueError(f"Duplicate task {key!r}")
+        deps = tuple(after)
+        self._tasks[key] = (fn, args, deps, pool, prepare)
+
+    def run(self) -> Dict[Hashable, Any]:
+        """Run every task; returns {key: result}. Re-raises the first task error once in-flight tasks stop."""
+        for key, (_, _, deps, _, _) in self._tasks.items():
+            missing = [d for d in deps if d not in self._tasks]
+            if missing:
+                raise ValueError(f"Task {key!r} depends on unknown tasks {missing!r}")
+            self._waiting[key] = len(deps)
+            for dep in deps:
+                self._dependents[dep].append(key)
+        self._check_acyclic()
+        self._remaining = len(self._tasks)
+        if not self._tasks:
+            return self.results
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="graph") as local:
+            self.pools.setdefault("local", local)
+            for key in [k for k, n in self._waiting.items() if n == 0]:
+                self._start(key)
+            self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self.results
+
+    def _check_acyclic(self):
+        waiting = dict(self._waiting)
+        ready = [k for k, n in waiting.items() if n == 0]
+        seen = 0
+        while ready:
+            key = ready.pop()
+            seen += 1
+            for child in self._dependents.get(key, ()):
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ready.append(child)
+        if seen != len(self._tasks):
+            raise ValueError("Task graph has a cycle")
+
+    def _start(self, key: Hashable):
+        fn, args, deps, pool, prepare = self._tasks[key]
+        if self._error is not None:
+            # After a failure nothing new starts; the task only counts as finished
+            self._finish(key, None)
+            return
+        try:
+            if prepare is not None:
+                args = prepare(*(self.results[d] for d in deps))
+                if args is None:
+                    self._finish(key, None)
+                    return
+            executor = self.pools[pool]
+            if self.on_task is not None and isinstance(executor, ThreadPoolExecutor):
+                future, submitted = executor.submit(self._timed, key, fn, *args), None
+            else:
+                future, submitted = executor.submit(fn, *args), time.perf_counter()
+        except BaseException as e:
+            self._fail(key, e)
+            return
+        future.add_done_callback(lambda f, key=key: self._collect(key, f, submitted))
+
+    def _timed(self, key: Hashable, fn: Callable, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.on_task(key, start, time.perf_counter())
+
+    def _collect(self, key: Hashable, future: Future, submitted: Optional[float] = None):
+        if submitted is not None and self.on_task is not None:
+            self.on_task(key, submitted, time.perf_counter())
+        try:
+            result = future.result()
+        except BaseException as e:
+            self._fail(key, e)
+            return
+        self._finish(key, result)
+
+    def _fail(self, key: Hashable, error: BaseException):
+        logger.error(f"[TaskGraph] Task {key!r} failed: {error}")
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._finish(key, None)
+
+    def _finish(self, key: Hashable, result: Any):
+        ready = []
+        with self._lock:
+            self.results[key] = result
+            self._remaining -= 1
+            for child in self._dependents.get(key, ()):
+                self._waiting[child] -= 1
+                if self._waiting[child] == 0:
+                    ready.append(child)
+            if self._remaining == 0:
+                self._done.set()
+        for child in ready:
+            self._start(child)
@@ -0,0 +1,191 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Tuple
+
+# Seconds; spans from cached lookups (ms) up to Face++ backoff chains and whole stages (minutes)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    """Monotonic count per label set."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield from super().render()
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(zip(self.labelnames, key))} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram per label set, as Prometheus expects."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, the +Inf overflow last; then sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def render(self):
+        yield from super().render()
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text format (0.0.4)."""
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "biaslens_stage_seconds", "Duration of pipeline stage tasks (per image, occupation or job)", ("stage",))
+EXTERNAL_SECONDS = REGISTRY.histogram(
+    "biaslens_external_request_seconds", "Duration of single outgoing HTTP requests", ("service",))
+FACEPP_REQUESTS = REGISTRY.counter(
+    "biaslens_facepp_requests_total", "Face++ detect requests sent, by HTTP status (or error)", ("status",))
+FACEPP_LIMITER_WAIT = REGISTRY.counter(
+    "biaslens_facepp_limiter_wait_seconds_total", "Time spent waiting on the Face++ QPS limiter")
+RETRIES = REGISTRY.counter(
+    "biaslens_retries_total", "Retried outgoing requests", ("service",))
+CACHE_REQUESTS = REGISTRY.counter(
+    "biaslens_cache_requests_total", "Cache lookups by cache and result (hit / miss)", ("cache", "result"))
+FACE_DETECTION_FAILURES = REGISTRY.counter(
+    "biaslens_face_detection_failures_total", "Images in which no face was found", ("source",))
+JOBS = REGISTRY.counter(
+    "biaslens_jobs_total", "Finished jobs by final status", ("status",))
+
+
+@contextmanager
+def external_request(service: str):
+    """Times one outgoing request into EXTERNAL_SECONDS, failed ones included."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        EXTERNAL_SECONDS.observe(time.perf_counter() - start, service=service)
+
+
+class StageTimer:
+    """
+    One job's stage breakdown. Every observation also lands in the process-wide
+    STAGE_SECONDS histogram. Stages run many tasks that overlap, so each stage
+    reports its task count, summed task time and wall time (first task start to
+    last task end).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, dict] = {}
+
+    def observe(self, stage: str, start: float, end: float):
+        """Record one task of `stage` running from `start` to `end` (time.perf_counter values)."""
+        STAGE_SECONDS.observe(end - start, stage=stage)
+        with self.lock:
+            s = self.stages.setdefault(stage, {"count": 0, "total_s": 0.0, "first": start, "last": end})
+            s["count"] += 1
+            s["total_s"] += end - start
+            s["first"] = min(s["first"], start)
+            s["last"] = max(s["last"], end)
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, start, time.perf_counter())
+
+    def breakdown(self) -> Dict[str, dict]:
+        """{stage: {"count", "total_s", "wall_s"}} in the order stages started."""
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda kv: kv[1]["first"])
+        return {
+            stage: {"count": s["count"], "total_s": round(s["total_s"], 6), "wall_s": round(s["last"] - s["first"], 6)}
+            for stage, s in stages
+        }
+
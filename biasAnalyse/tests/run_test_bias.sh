@@ -4,8 +4,21 @@ set -euo pipefail
 API=http://127.0.0.1:8000
 OUT_FILE=test_response_bias.json
 
-# Run the analysis synchronously, save to file, and echo to console
-curl -s -X POST "$API/analyze_bias" \
+# Submit the analysis job
+JOB_ID=$(curl -s -X POST "$API/analyze_bias" \
      -H "Content-Type: application/json" \
      -d @test_payload_bias.json \
-  | tee "$OUT_FILE"
+  | python3 -c 'import json,sys; print(json.load(sys.stdin)["job_id"])')
+echo "Submitted job $JOB_ID"
+
+# Poll until the job finishes, then save to file and echo to console
+while true; do
+  RESPONSE=$(curl -s "$API/jobs/$JOB_ID")
+  STATUS=$(echo "$RESPONSE" | python3 -c 'import json,sys; print(json.load(sys.stdin)["status"])')
+  if [ "$STATUS" = "bias_analyzed" ] || [ "$STATUS" = "failed" ]; then
+    break
+  fi
+  echo "Status: $STATUS"
+  sleep 2
+done
+echo "$RESPONSE" | tee "$OUT_FILE"
@@ -0,0 +1,103 @@
+import importlib
+import queue
+
+import pandas as pd
+import pytest
+
+from benchmarks.pipeline_bench import make_payload
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    # The service reads BASE_TMP (job store, workspaces, caches) at import time
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("BASE_TMP", str(tmp_path_factory.mktemp("base_tmp")))
+        mp.setenv("WORKSPACE_GC_INTERVAL", "0")
+        yield importlib.import_module("app")
+
+
+@pytest.fixture
+def no_workspace(app, monkeypatch):
+    def acquire(job_id, n_images):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(app.workspaces, "acquire", acquire)
+
+
+def submit(app, request) -> str:
+    return app.create_job(request, getattr(request, "groups", [request]))
+
+
+def test_job_fails_when_workspace_cannot_be_acquired(app, no_workspace):
+    payload = app.AnalyzeRequest(**make_payload("http://images.test", 2, 1))
+    job_id = submit(app, payload)
+    app.run_job(job_id, payload)
+
+    job = app.job_store.get(job_id)
+    assert job["status"] == "failed"
+    assert "No space left on device" in job["error"]
+    assert job_id not in app.jobs
+
+
+def test_batch_job_fails_when_workspace_cannot_be_acquired(app, no_workspace):
+    batch = app.BatchAnalyzeRequest(groups=[make_payload("http://images.test", 2, 1)])
+    job_id = submit(app, batch)
+    app.run_batch_job(job_id, batch)
+
+    assert app.job_store.get(job_id)["status"] == "failed"
+
+
+def test_stream_ends_with_error_when_workspace_cannot_be_acquired(app, no_workspace):
+    payload = app.AnalyzeRequest(**make_payload("http://images.test", 2, 1))
+    job_id = submit(app, payload)
+    events = queue.Queue()
+    app.run_stream_job(job_id, payload, events)
+
+    assert app.job_store.get(job_id)["status"] == "failed"
+    error = events.get_nowait()
+    assert error["event"] == "error" and "No space left on device" in error["error"]
+    # None closes the stream
+    assert events.get_nowait() is None
+
+
+class NoAggregation:
+    def __init__(self, metrics):
+        pass
+
+    def aggregate(self):
+        return {}
+
+
+@pytest.fixture
+def finished_pipeline(app, monkeypatch):
+    """Images, aggregation and bias scoring stubbed with a fixed result; finishing, storing and indexing run for real."""
+    matrix = pd.DataFrame({"Occupation0": [0.5, 0.25]}, index=pd.Index(["0", "1"], name="image_name"))
+
+    def compute_bias(consolidated_map, payload):
+        summary = {"attribute": app.attribute_name(payload), "age_bias": 0.5, "gender_bias": 0.0, "race_bias": 0.25}
+        return {"summary": summary, "age_matrix": matrix, "gender_matrix": matrix, "race_matrix": matrix}
+
+    monkeypatch.setattr(app, "run_groups", lambda job_id, groups, workspace, on_occupation=None: [{"metrics": {}}])
+    monkeypatch.setattr(app, "Aggregator", NoAggregation)
+    monkeypatch.setattr(app, "compute_bias", compute_bias)
+    monkeypatch.setattr(app, "timed_response", lambda job_id: {"job_id": job_id, "status": "bias_analyzed"})
+
+
+def test_result_is_indexed_once_stored(app, finished_pipeline):
+    payload = app.AnalyzeRequest(**make_payload("http://images.test", 2, 1))
+    job_id = submit(app, payload)
+    app.run_job(job_id, payload)
+
+    assert app.job_store.get(job_id)["status"] == "bias_analyzed"
+    assert job_id in app.bias_index.indexed_jobs()
+
+
+def test_job_failing_to_store_is_not_indexed(app, finished_pipeline, monkeypatch):
+    def store_result(job_id, result):
+        raise OSError("database is locked")
+    monkeypatch.setattr(app, "store_result", store_result)
+    payload = app.AnalyzeRequest(**make_payload("http://images.test", 2, 1))
+    job_id = submit(app, payload)
+    app.run_job(job_id, payload)
+
+    assert app.job_store.get(job_id)["status"] == "failed"
+    assert job_id not in app.bias_index.indexed_jobs()
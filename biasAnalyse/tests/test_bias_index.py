@@ -0,0 +1,35 @@
+from bias_index import BiasIndex
+
+REQUEST = {"gender": "Female", "age": "20-29", "race": "Black", "model": "pix2pix"}
+SUMMARY = {"age_bias": 0.1, "gender_bias": 0.0, "race_bias": 0.2}
+
+
+class FakeJobStore:
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def finished(self, skip=frozenset()):
+        for job_id, result in self.jobs:
+            if job_id not in skip:
+                yield job_id, 1.7e9, REQUEST, result
+
+
+def matrix(value):
+    return [{"image_name": "1", "Nurse": value}, {"image_name": "2", "Nurse": None}]
+
+
+def test_backfill_skips_empty_matrices_and_bad_jobs(tmp_path):
+    index = BiasIndex(str(tmp_path / "index.sqlite3"))
+    store = FakeJobStore([
+        ("empty", {"bias_summary": SUMMARY, "age_bias_matrix": [], "gender_bias_matrix": [], "race_bias_matrix": []}),
+        ("broken", {"age_bias_matrix": []}),
+        ("full", {"bias_summary": SUMMARY, **{f"{m}_matrix": matrix(0.5) for m in ("age_bias", "gender_bias", "race_bias")}}),
+    ])
+
+    # The broken job is logged and left out; the others are indexed
+    assert index.backfill(store) == 2
+    assert index.indexed_jobs() == {"empty", "full"}
+    rows = index.query(group_by=["job"], scope="job")
+    assert [row["job"] for row in rows] == ["empty", "full"]
+    rows = index.query(group_by=["job", "occupation"])
+    assert [(row["job"], row["occupation"]) for row in rows] == [("full", "Nurse")]
@@ -0,0 +1,130 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import facepp_client
+from facepp_client import CONCURRENCY_ERROR, FaceppClient, TokenBucket
+from telemetry import RETRIES
+
+QPS = 5
+
+
+class StubFacepp:
+    """
+    Face++ detect stub: the first `failures` calls are rejected (429 with Retry-After,
+    then 403 CONCURRENCY_LIMIT_EXCEEDED); image URLs in `rejected` always get the
+    given (status, error_message).
+    """
+    def __init__(self, failures: int, retry_after: float, rejected=None):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.rejected = rejected or {}
+        self.calls = []  # (time, image_url, status)
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode(errors="replace")
+                url = body.split('name="image_url"', 1)[1].split("\r\n\r\n", 1)[1].split("\r\n", 1)[0]
+                with stub.lock:
+                    n = len(stub.calls)
+                    status = 200 if n >= stub.failures else (429, 403)[n % 2]
+                    if url in stub.rejected:
+                        status = stub.rejected[url][0]
+                    stub.calls.append((time.monotonic(), url, status))
+                headers = {}
+                if url in stub.rejected:
+                    data = json.dumps({"error_message": stub.rejected[url][1]}).encode()
+                elif status == 429:
+                    data, headers = b"", {"Retry-After": str(stub.retry_after)}
+                elif status == 403:
+                    data = json.dumps({"error_message": CONCURRENCY_ERROR}).encode()
+                else:
+                    data = json.dumps({"faces": [{"url": url}]}).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/detect"
+
+
+def serve(monkeypatch, server: StubFacepp) -> StubFacepp:
+    monkeypatch.setenv("FACEPP_KEY", "test")
+    monkeypatch.setenv("FACEPP_SECRET", "test")
+    monkeypatch.setattr(facepp_client, "FACEPP_URL", server.url)
+    monkeypatch.setattr(facepp_client, "RETRY_DELAY", 0.01)
+    return server
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = serve(monkeypatch, StubFacepp(failures=4, retry_after=0.3))
+    yield server
+    server.server.shutdown()
+
+
+@pytest.fixture
+def rejecting_stub(monkeypatch):
+    server = serve(monkeypatch, StubFacepp(failures=0, retry_after=0, rejected={
+        "http://images.test/missing.jpg": (400, "INVALID_IMAGE_URL"),
+        "http://images.test/denied.jpg": (403, "AUTHORIZATION_ERROR:DENIED"),
+    }))
+    yield server
+    server.server.shutdown()
+
+
+def retries() -> float:
+    return RETRIES.values.get(("facepp",), 0)
+
+
+def test_detect_batch_retries_rate_limits_in_order(stub):
+    images = [(f"tag-{i}", f"http://images.test/{i}.jpg") for i in range(8)]
+    before = retries()
+    with FaceppClient(max_workers=4, limiter=TokenBucket(QPS, capacity=1)) as client:
+        results = client.detect_batch(images)
+
+    # Every image answered, keyed and ordered as given
+    assert list(results) == [tag for tag, _ in images]
+    assert all(results[tag]["faces"][0]["url"] == url for tag, url in images)
+    # One retry per rejected call
+    assert len(stub.calls) == len(images) + stub.failures
+    assert retries() - before == stub.failures
+
+    # A 429 is retried no sooner than its Retry-After
+    for i, (rejected_at, url, status) in enumerate(stub.calls):
+        if status == 429:
+            retried_at = next(t for t, u, _ in stub.calls[i + 1:] if u == url)
+            assert retried_at - rejected_at >= stub.retry_after - 0.01
+
+    # Never faster than the token bucket allows (capacity 1: one call per 1/QPS seconds)
+    times = sorted(t for t, _, _ in stub.calls)
+    for a, b in zip(times, times[4:]):
+        assert b - a >= 4 / QPS - 0.05
+
+
+def test_client_errors_are_not_retried(rejecting_stub):
+    images = [(name, f"http://images.test/{name}.jpg") for name in ("missing", "denied", "ok")]
+    before = retries()
+    with FaceppClient(max_workers=1, limiter=TokenBucket(0)) as client:
+        results = client.detect_batch(images)
+
+    # One call per image: a 400 or a 403 other than the concurrency limit fails at once
+    assert sorted(url for _, url, _ in rejecting_stub.calls) == sorted(url for _, url in images)
+    assert retries() == before
+    assert "INVALID_IMAGE_URL" in results["missing"]["error"]
+    assert "AUTHORIZATION_ERROR" in results["denied"]["error"]
+    assert results["ok"]["faces"]
@@ -0,0 +1,35 @@
+import hashlib
+import shutil
+
+from image_store import ImageStore
+
+
+class FakeDownloader:
+    """Writes fixed bytes to `dest` like ImageDownloader.download, counting the calls."""
+    def __init__(self, content: bytes):
+        self.content = content
+        self.calls = 0
+
+    def download(self, tag, url, dest, headers=None):
+        self.calls += 1
+        with open(dest, "wb") as f:
+            f.write(self.content)
+        return {"path": dest, "bytes": len(self.content), "sha256": hashlib.sha256(self.content).hexdigest(), "etag": None}
+
+
+def test_link_after_eviction_is_a_miss(tmp_path):
+    store = ImageStore(str(tmp_path / "store"))
+    downloader = FakeDownloader(b"image bytes")
+    dest = str(tmp_path / "job" / "images" / "1.jpg")
+
+    fetched = store.fetch("orig-1", "http://host/1.jpg", downloader)
+    # Evicted by another job between fetch and link
+    shutil.rmtree(store.blob_dir(fetched["sha256"]))
+    assert not store.link(fetched["sha256"], dest)
+
+    # Fetching again downloads the evicted blob instead of trusting the URL index
+    fetched = store.fetch("orig-1", "http://host/1.jpg", downloader)
+    assert downloader.calls == 2
+    assert store.link(fetched["sha256"], dest)
+    with open(dest, "rb") as f:
+        assert f.read() == b"image bytes"
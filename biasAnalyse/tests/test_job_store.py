@@ -0,0 +1,64 @@
+import sqlite3
+import time
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+from job_store import JobStore
+
+
+def test_claims_only_expired_leases(tmp_path):
+    db = str(tmp_path / "jobs.sqlite3")
+    dead, live, survivor = JobStore(db, lease_ttl=5), JobStore(db, lease_ttl=5), JobStore(db, lease_ttl=5)
+    dead.create("dead-job", {"n": 1})
+    live.create("live-job", {"n": 2})
+    live.create("done-job", {"n": 3})
+    live.update("done-job", "bias_analyzed", result={})
+    # The dead worker stopped renewing its lease a while ago
+    with closing(sqlite3.connect(db)) as conn, conn:
+        conn.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = 'dead-job'", (time.time() - 60,))
+
+    assert survivor.claim_orphans() == [("dead-job", {"n": 1})]
+    assert survivor.get("dead-job")["owner"] == survivor.owner
+    assert survivor.get("live-job")["owner"] == live.owner
+    # Claimed jobs get a fresh lease and are not taken twice
+    assert live.claim_orphans() == []
+
+
+def test_owner_is_unique_per_start(tmp_path):
+    db = str(tmp_path / "jobs.sqlite3")
+    assert JobStore(db).owner != JobStore(db).owner
+
+
+def test_migrates_store_without_heartbeat(tmp_path):
+    db = str(tmp_path / "jobs.sqlite3")
+    with closing(sqlite3.connect(db)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE jobs (job_id TEXT PRIMARY KEY, status TEXT NOT NULL, owner TEXT NOT NULL, "
+            "request TEXT NOT NULL, result TEXT, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO jobs VALUES ('old-job', 'running', 'host:1', '{}', NULL, NULL, ?, ?)",
+            (time.time() - 120, time.time() - 120),
+        )
+
+    store = JobStore(db, lease_ttl=5)
+    # Without a heartbeat yet, the last update stands in for the lease
+    assert store.claim_orphans() == [("old-job", {})]
+
+
+def test_queue_cap_holds_under_concurrent_submissions(tmp_path):
+    db = str(tmp_path / "jobs.sqlite3")
+    stores = [JobStore(db) for _ in range(8)]
+    barrier = threading.Barrier(len(stores) * 4)
+
+    def submit(store, i):
+        barrier.wait()
+        return store.create(f"job-{i}", {}, max_active=5)
+
+    with ThreadPoolExecutor(len(stores) * 4) as pool:
+        accepted = list(pool.map(lambda i: submit(stores[i % len(stores)], i), range(len(stores) * 4)))
+
+    assert sum(accepted) == 5
+    with closing(sqlite3.connect(db)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 5
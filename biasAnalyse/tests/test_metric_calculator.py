@@ -0,0 +1,18 @@
+from metric_calculator import MetricCalculator
+
+
+def face(age, gender):
+    return {"faces": [{"attributes": {"age": {"value": age}, "gender": {"value": gender}}}]}
+
+
+def test_failed_transform_detection_is_skipped_not_faceless():
+    calculator = MetricCalculator({
+        "originals": {"1": face(30, "Female"), "2": face(40, "Male"), "3": face(50, "Male")},
+        "transforms": {"Nurse": {"1": face(35, "Female"), "2": {"faces": []}, "3": {"error": "503 Server Error"}}},
+    })
+    metrics = calculator.compute()["Nurse"]
+
+    # A transform without a face keeps its row; one whose Face++ call failed is reported instead
+    assert list(metrics["image_name"]) == ["1", "2"]
+    assert metrics["age_delta"].tolist()[0] == 5
+    assert calculator.skipped == [{"image_name": "3", "occupation": "Nurse", "reason": "Face++ failed: 503 Server Error"}]
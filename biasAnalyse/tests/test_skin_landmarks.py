@@ -0,0 +1,36 @@
+import os
+import random
+
+import cv2
+import numpy as np
+
+from benchmarks.pipeline_bench import synthetic_face
+from skin_analyzer import face_regions, new_face_mesh, skin_darkness
+
+UPSCALE = 3
+MAX_SIDE = 512
+TOLERANCE = 0.5  # same default as benchmarks/skin_bench.py --tolerance
+
+
+def test_downscaled_landmarks_match_full_resolution(tmp_path):
+    rng = random.Random(0)
+    paths = []
+    for i in range(4):
+        # High-resolution uploads: drawn at 512px, stored 3x larger
+        img = cv2.resize(synthetic_face(512, rng), None, fx=UPSCALE, fy=UPSCALE, interpolation=cv2.INTER_CUBIC)
+        paths.append(str(tmp_path / f"{i}.jpg"))
+        cv2.imwrite(paths[-1], img)
+    # An image without a face must stay without one at both sizes
+    paths.append(str(tmp_path / "blank.jpg"))
+    cv2.imwrite(paths[-1], np.full((512 * UPSCALE, 512 * UPSCALE, 3), 200, np.uint8))
+
+    regions, hsv_thresh = face_regions(), (0, 179, 0, 255, 0, 255)
+    with new_face_mesh() as face_mesh:
+        full = [skin_darkness(face_mesh, p, regions, hsv_thresh, max_side=0) for p in paths]
+        small = [skin_darkness(face_mesh, p, regions, hsv_thresh, max_side=MAX_SIDE) for p in paths]
+
+    assert [d is None for d in full] == [False] * 4 + [True]
+    assert [d is None for d in small] == [d is None for d in full]
+    for name, a, b in zip(map(os.path.basename, paths), full, small):
+        if a is not None:
+            assert abs(a - b) <= TOLERANCE, f"{name}: {a} at full resolution, {b} at max_side={MAX_SIDE}"
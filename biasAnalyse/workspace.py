@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = ".workspace.json"
+DEFAULT_TTL = 3600              # seconds a finished workspace is kept (debug crops, images)
+DEFAULT_MAX_AGE = 24 * 3600     # seconds before an unfinished workspace is considered abandoned
+DEFAULT_GC_INTERVAL = 300       # seconds between background collections
+USAGE_REFRESH = 10              # seconds a measured disk usage is reused by has_capacity()
+
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.lstat(os.path.join(root, fn)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class Workspace:
+    """
+    One job's scratch folder, <base>/<job_id>, with the images/originals and
+    images/transforms/<occupation> layout (plus skin/ for debug crops).
+    `base` is BASE_TMP, or the RAM-backed folder for small jobs.
+    """
+    def __init__(self, manager: "WorkspaceManager", job_id: str, base: str, in_memory: bool):
+        self.manager = manager
+        self.job_id = job_id
+        self.base = base
+        self.in_memory = in_memory
+        self.root = os.path.join(base, job_id)
+
+    def path(self, *parts: str) -> str:
+        return os.path.join(self.root, *parts)
+
+    def release(self):
+        """The job is done with its files: RAM workspaces go at once, disk ones after the TTL."""
+        self.manager.release(self)
+
+
+class WorkspaceManager:
+    """
+    Creates and garbage-collects job workspaces under `base_tmp`.
+
+    Every workspace carries a small metadata file (job id, created, finished),
+    so collection only ever touches job folders, never the caches or the job
+    database living next to them. Finished workspaces are removed `ttl` seconds
+    after release, unfinished ones once older than `max_age` (a crashed worker).
+    New jobs are refused while workspaces use more than `quota_bytes` or the
+    disk has less than `min_free_bytes` left. Jobs with at most
+    `ram_max_images` images get a workspace under `ram_dir` (e.g. /dev/shm).
+    """
+    def __init__(
+        self,
+        base_tmp: str,
+        ttl: float = DEFAULT_TTL,
+        max_age: float = DEFAULT_MAX_AGE,
+        quota_bytes: int = 0,
+        min_free_bytes: int = 0,
+        ram_dir: Optional[str] = None,
+        ram_max_images: int = 0,
+        gc_interval: float = DEFAULT_GC_INTERVAL
+    ):
+        self.base_tmp = base_tmp
+        self.ttl = ttl
+        self.max_age = max_age
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.ram_dir = ram_dir if ram_dir and ram_max_images > 0 else None
+        self.ram_max_images = ram_max_images
+        self.gc_interval = gc_interval
+        self.active: Dict[str, Workspace] = {}
+        self.lock = threading.Lock()
+        self._usage = (0.0, 0)  # (measured at, bytes)
+        self._gc_thread = None
+        os.makedirs(base_tmp, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, base_tmp: str) -> "WorkspaceManager":
+        """WORKSPACE_* env vars; quota / free-space limits of 0 are disabled."""
+        ram_dir = os.getenv("WORKSPACE_RAM_DIR", "/dev/shm")
+        return cls(
+            base_tmp,
+            ttl=float(os.getenv("WORKSPACE_TTL", DEFAULT_TTL)),
+            max_age=float(os.getenv("WORKSPACE_MAX_AGE", DEFAULT_MAX_AGE)),
+            quota_bytes=int(float(os.getenv("WORKSPACE_QUOTA_MB", "0")) * 1024 * 1024),
+            min_free_bytes=int(float(os.getenv("WORKSPACE_MIN_FREE_MB", "0")) * 1024 * 1024),
+            ram_dir=ram_dir if os.path.isdir(ram_dir) else None,
+            ram_max_images=int(os.getenv("WORKSPACE_RAM_MAX_IMAGES", "0")),
+            gc_interval=float(os.getenv("WORKSPACE_GC_INTERVAL", DEFAULT_GC_INTERVAL)),
+        )
+
+    def _bases(self):
+        return [self.base_tmp] + ([self.ram_dir] if self.ram_dir else [])
+
+    def acquire(self, job_id: str, n_images: int = 0) -> Workspace:
+        """Create (or reopen, for a resumed job) the workspace of `job_id`."""
+        in_memory = self.ram_dir is not None and 0 < n_images <= self.ram_max_images
+        workspace = Workspace(self, job_id, self.ram_dir if in_memory else self.base_tmp, in_memory)
+        for sub in ("images/originals", "images/transforms"):
+            os.makedirs(workspace.path(sub), exist_ok=True)
+        meta = os.path.join(workspace.root, METADATA_FILE)
+        if not os.path.exists(meta):
+            with open(meta, "w") as f:
+                json.dump({"job_id": job_id, "created": time.time(), "finished": None}, f)
+        with self.lock:
+            self.active[job_id] = workspace
+        return workspace
+
+    def release(self, workspace: Workspace):
+        with self.lock:
+            self.active.pop(workspace.job_id, None)
+        if workspace.in_memory or self.ttl <= 0:
+            shutil.rmtree(workspace.root, ignore_errors=True)
+            return
+        meta = os.path.join(workspace.root, METADATA_FILE)
+        try:
+            with open(meta) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {"job_id": workspace.job_id, "created": time.time()}
+        data["finished"] = time.time()
+        with open(meta, "w") as f:
+            json.dump(data, f)
+
+    def _workspaces(self):
+        """Yield (root, metadata) for every workspace on disk or in RAM."""
+        for base in self._bases():
+            try:
+                entries = list(os.scandir(base))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                meta = os.path.join(entry.path, METADATA_FILE)
+                if not entry.is_dir() or not os.path.exists(meta):
+                    continue
+                try:
+                    with open(meta) as f:
+                        yield entry.path, json.load(f)
+                except (FileNotFoundError, ValueError):
+                    continue
+
+    def collect(self) -> int:
+        """One GC pass: remove expired finished and abandoned workspaces. Returns how many were removed."""
+        now = time.time()
+        with self.lock:
+            active = set(self.active)
+        removed = 0
+        for root, meta in self._workspaces():
+            if meta.get("job_id") in active:
+                continue
+            finished = meta.get("finished")
+            expired = now - finished > self.ttl if finished else now - meta.get("created", now) > self.max_age
+            if expired:
+                shutil.rmtree(root, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info(f"[WorkspaceManager] removed {removed} workspaces")
+        self._usage = (0.0, 0)
+        return removed
+
+    def usage(self) -> int:
+        """Bytes used by all disk workspaces (re-measured at most every USAGE_REFRESH seconds)."""
+        measured_at, used = self._usage
+        if time.time() - measured_at > USAGE_REFRESH:
+            used = sum(_dir_bytes(root) for root, _ in self._workspaces() if not root.startswith(self.ram_dir or "\0"))
+            self._usage = (time.time(), used)
+        return used
+
+    def has_capacity(self) -> bool:
+        """False while over the quota or short on free disk space, even after a GC pass."""
+        for attempt in range(2):
+            over_quota = self.quota_bytes > 0 and self.usage() >= self.quota_bytes
+            low_disk = self.min_free_bytes > 0 and shutil.disk_usage(self.base_tmp).free < self.min_free_bytes
+            if not (over_quota or low_disk):
+                return True
+            if attempt == 0:
+                self.collect()
+        logger.warning("[WorkspaceManager] workspace disk quota reached, refusing new jobs")
+        return False
+
+    def start_gc(self):
+        """Run collect() every gc_interval seconds on a daemon thread."""
+        if self._gc_thread is not None or self.gc_interval <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.collect()
+                except Exception as e:
+                    logger.error(f"[WorkspaceManager] GC failed: {e}")
+                time.sleep(self.gc_interval)
+
+        self._gc_thread = threading.Thread(target=loop, name="workspace-gc", daemon=True)
+        self._gc_thread.start()
@@ -0,0 +1,212 @@
+# inference_queue.py
+
+import math
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from functools import partial
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List, Optional
+
+
+class QueueFull(Exception):
+    """A model queue is at capacity; `retry_after` is the suggested wait in seconds."""
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} queue is full, retry in {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class ModelQueue:
+    """
+    Worker threads and a bounded admission queue in front of one pipeline.
+
+    A request is admitted while fewer than `workers + depth` requests are in
+    flight; past that, admit() fails fast with QueueFull instead of queueing,
+    with a Retry-After estimated from recent inference times. Inference runs on
+    the queue's own threads, started on first use, so the event loop keeps
+    serving other requests.
+    """
+    def __init__(self, name: str, workers: int = 1, depth: int = 4, default_seconds: float = 30):
+        self.name = name
+        self.workers = workers
+        self.depth = depth
+        # Requests that can be running at once
+        self.slots = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.in_flight = 0
+        self.avg_seconds: Optional[float] = None
+        self.default_seconds = default_seconds
+        self.lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Threads of run(); never started by queues that bring their own workers (BatchedModelQueue)."""
+        with self.lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"infer-{self.name}")
+            return self._executor
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free: the requests ahead, spread over the workers."""
+        avg = self.avg_seconds or self.default_seconds
+        return max(1, math.ceil(avg * (self.in_flight - self.slots + 1) / self.workers))
+
+    @contextmanager
+    def admit(self):
+        """Hold one of the queue's slots for the whole request (download, inference and upload)."""
+        with self.lock:
+            if self.in_flight >= self.slots + self.depth:
+                raise QueueFull(self.name, self.retry_after())
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _record(self, seconds: float):
+        """Fold one request's inference time into the moving average."""
+        with self.lock:
+            # Exponential moving average, so the estimate follows load and model changes
+            self.avg_seconds = seconds if self.avg_seconds is None else 0.8 * self.avg_seconds + 0.2 * seconds
+
+    def _timed(self, fn: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._record(time.perf_counter() - start)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Run the blocking `fn` on one of the queue's workers and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(self._timed, fn, *args, **kwargs))
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "depth": self.depth,
+                "in_flight": self.in_flight,
+                "avg_seconds": round(self.avg_seconds, 2) if self.avg_seconds is not None else None,
+            }
+
+
+class BatchedModelQueue(ModelQueue):
+    """
+    A ModelQueue whose workers run requests in batches.
+
+    Each worker takes the oldest waiting request, then keeps collecting until
+    `max_batch` images are gathered or `max_wait` seconds have passed since
+    that first request arrived; requests that piled up while the worker was
+    busy join at once. `weight` is the number of images an item produces; an
+    item heavier than `max_batch` runs alone. `run_batch` gets the collected
+    items and returns one result per item, in order. Items only share a call
+    when `key` (e.g. the image size) matches. max_batch=1 disables batching.
+    """
+    def __init__(
+        self,
+        name: str,
+        run_batch: Callable[[List[Any]], List[Any]],
+        key: Callable[[Any], Hashable] = lambda item: None,
+        weight: Callable[[Any], int] = lambda item: 1,
+        workers: int = 1,
+        depth: int = 4,
+        max_batch: int = 4,
+        max_wait: float = 0.05,
+        default_seconds: float = 30
+    ):
+        super().__init__(name, workers=workers, depth=depth, default_seconds=default_seconds)
+        self.run_batch = run_batch
+        self.key = key
+        self.weight = weight
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.slots = workers * self.max_batch
+        self.pending: deque = deque()
+        self.arrived = threading.Condition(threading.Lock())
+        self.batch_sizes: List[int] = []
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"batch-{name}-{i}", daemon=True).start()
+
+    def _collect(self) -> list:
+        """Block for the next request, then gather a batch around it."""
+        with self.arrived:
+            while not self.pending:
+                self.arrived.wait()
+            batch = [self.pending.popleft()]
+            size = self.weight(batch[0][0])
+            deadline = batch[0][2] + self.max_wait
+            while size < self.max_batch:
+                if self.pending:
+                    # Leave a request that does not fit for the next batch
+                    if size + self.weight(self.pending[0][0]) > self.max_batch:
+                        break
+                    batch.append(self.pending.popleft())
+                    size += self.weight(batch[-1][0])
+                    continue
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.arrived.wait(remaining)
+        return batch
+
+    @staticmethod
+    def _settle(future: Future, result=None, error: Optional[Exception] = None):
+        try:
+            future.set_exception(error) if error is not None else future.set_result(result)
+        except InvalidStateError:
+            pass  # cancelled meanwhile
+
+    def _run(self, group: list):
+        """One pipeline call for `group`; a failed batch is retried item by item so one bad request fails alone."""
+        start = time.perf_counter()
+        try:
+            results = self.run_batch([item for item, _, _ in group])
+            if len(results) != len(group):
+                raise RuntimeError(f"{self.name}: {len(results)} results for {len(group)} requests")
+        except Exception as e:
+            if len(group) > 1:
+                for entry in group:
+                    self._run([entry])
+            else:
+                self._settle(group[0][1], error=e)
+            return
+        self._record((time.perf_counter() - start) / len(group))
+        with self.lock:
+            self.batch_sizes = (self.batch_sizes + [sum(self.weight(item) for item, _, _ in group)])[-100:]
+        for (_, future, _), result in zip(group, results):
+            self._settle(future, result)
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            groups = {}
+            for entry in batch:
+                # Skip requests whose caller went away while waiting
+                if entry[1].set_running_or_notify_cancel():
+                    groups.setdefault(self.key(entry[0]), []).append(entry)
+            for group in groups.values():
+                self._run(group)
+
+    async def submit(self, item: Any):
+        """Queue `item` for the next batch and await its own result."""
+        future = Future()
+        with self.arrived:
+            self.pending.append((item, future, time.perf_counter()))
+            self.arrived.notify()
+        return await asyncio.wrap_future(future)
+
+    def status(self) -> dict:
+        status = super().status()
+        with self.lock:
+            sizes = list(self.batch_sizes)
+        status.update({
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000),
+            "avg_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else None,
+        })
+        return status
@@ -1,11 +1,15 @@
 # main.py
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from typing import Callable, List, Optional, Tuple
 from PIL import Image
-import requests, torch, uuid, os, json
+import requests, torch, uuid, os, json, random
 from io import BytesIO
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -21,6 +25,10 @@ from diffusers import StableDiffusionInstructPix2PixPipeline, AutoPipelineForIma
 import firebase_admin
 from firebase_admin import credentials, storage
 
+from model_registry import ModelRegistry
+from inference_queue import BatchedModelQueue, ModelQueue, QueueFull
+from prompt_cache import PromptEmbeddingCache
+
 # Initialize FastAPI app
 app = FastAPI()
 app.add_middleware(
@@ -46,36 +54,119 @@ print("Firebase ready.")
 device = "cpu"  # Use CPU (e.g., for macOS)
 login(HF_TOKEN)
 
-# Load InstructPix2Pix pipeline
-pix2pix = StableDiffusionInstructPix2PixPipeline.from_pretrained(
-    "timbrooks/instruct-pix2pix",
-    torch_dtype=torch.float32,
-    safety_checker=None,
-    low_cpu_mem_usage=True 
-).to(device)
-pix2pix.scheduler = EulerAncestralDiscreteScheduler.from_config(pix2pix.scheduler.config)
-pix2pix.enable_attention_slicing()
-print("Pix2Pix Pipeline ready.")
-
-# Load Img2Img pipeline
-img2img = AutoPipelineForImage2Image.from_pretrained(
-    "kandinsky-community/kandinsky-2-2-decoder", 
-    torch_dtype=torch.float32,
-    use_safetensors=True
-)
-img2img.to(torch.device("cpu"))
-img2img.enable_attention_slicing()
-print("Img2Img Pipeline ready.")
-
-# Load MagicBrush pipeline
-magicbrush = StableDiffusionInstructPix2PixPipeline.from_pretrained(
-    "vinesmsuic/magicbrush-jul7",
-    torch_dtype=torch.float32,
-    use_safetensors=False
-).to(device)
-magicbrush.scheduler = EulerAncestralDiscreteScheduler.from_config(magicbrush.scheduler.config)
-magicbrush.enable_attention_slicing()
-print("MagicBrush Pipeline ready.")
+# Prompt embeddings are cached per (pipeline, prompt), so steady-state requests skip
+# text encoding (Kandinsky: its prior). PROMPT_CACHE_SIZE bounds the entries (0 disables);
+# PROMPT_WARMUP_OCCUPATIONS are encoded as soon as a pipeline loads.
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+PROMPT_WARMUP_OCCUPATIONS = [o.strip() for o in os.getenv("PROMPT_WARMUP_OCCUPATIONS", "").split(",") if o.strip()]
+# Kandinsky's prior samples its embeddings; a fixed seed per prompt keeps them the same after a cache eviction
+PRIOR_SEED = 0
+prompt_cache = PromptEmbeddingCache(max_entries=PROMPT_CACHE_SIZE)
+
+def occupation_prompt(occupation: str) -> str:
+    return f"A photo of a {occupation}"
+
+def encode_text(pipe, prompts: List[str]) -> List[torch.Tensor]:
+    """CLIP text embeddings, one (tokens, dim) tensor per prompt, computed as the SD pipelines do."""
+    tokens = pipe.tokenizer(prompts, padding="max_length", max_length=pipe.tokenizer.model_max_length, truncation=True, return_tensors="pt")
+    use_mask = getattr(pipe.text_encoder.config, "use_attention_mask", False)
+    with torch.no_grad():
+        embeds = pipe.text_encoder(
+            tokens.input_ids.to(pipe.device),
+            attention_mask=tokens.attention_mask.to(pipe.device) if use_mask else None
+        )[0]
+    return list(embeds)
+
+def text_embeddings(name: str, pipe, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """(prompt_embeds, negative_prompt_embeds) for an InstructPix2Pix pipeline; misses share one encoder pass."""
+    embeds = prompt_cache.get_many(name, prompts + [""], lambda missing: encode_text(pipe, missing))
+    return torch.stack(embeds[:-1]), embeds[-1].expand(len(prompts), -1, -1)
+
+def encode_prior(pipe, prompts: List[str]) -> List[tuple]:
+    """(image_embeds, negative_image_embeds) per prompt from Kandinsky's prior, with the combined pipeline's defaults."""
+    image_embeds, negative_image_embeds = pipe.prior_pipe(
+        prompt=prompts,
+        num_inference_steps=25,
+        guidance_scale=4.0,
+        generator=[torch.Generator(device).manual_seed(PRIOR_SEED) for _ in prompts],
+        output_type="pt",
+        return_dict=False
+    )
+    return list(zip(image_embeds, negative_image_embeds))
+
+def prior_embeddings(pipe, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+    embeds = prompt_cache.get_many("img2img", prompts, lambda missing: encode_prior(pipe, missing))
+    return torch.stack([e for e, _ in embeds]), torch.stack([n for _, n in embeds])
+
+def warm_up(embed: Callable, *args):
+    """Encode PROMPT_WARMUP_OCCUPATIONS ahead of the first requests, a few prompts at a time."""
+    if not PROMPT_WARMUP_OCCUPATIONS or PROMPT_CACHE_SIZE <= 0:
+        return
+    prompts = [occupation_prompt(o) for o in PROMPT_WARMUP_OCCUPATIONS]
+    try:
+        for i in range(0, len(prompts), 16):
+            embed(*args, prompts[i:i + 16])
+        print(f"Prompt embeddings warmed up for {len(prompts)} occupations.")
+    except Exception as e:
+        # Requests still encode their prompts on a miss
+        print(f"❌ [PromptCache] Warm-up failed: {str(e)}")
+
+# Pipelines load on first use and are evicted least-recently-used first when
+# MODEL_MEMORY_BUDGET_MB (0 = unlimited) would be exceeded.
+# MODEL_PRELOAD names pipelines to load in the background at startup ("all" for every one).
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "")
+
+# InstructPix2Pix pipeline
+def load_pix2pix():
+    pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(
+        "timbrooks/instruct-pix2pix",
+        torch_dtype=torch.float32,
+        safety_checker=None,
+        low_cpu_mem_usage=True 
+    ).to(device)
+    pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
+    pipe.enable_attention_slicing()
+    warm_up(text_embeddings, "pix2pix", pipe)
+    return pipe
+
+# Img2Img pipeline
+def load_img2img():
+    pipe = AutoPipelineForImage2Image.from_pretrained(
+        "kandinsky-community/kandinsky-2-2-decoder", 
+        torch_dtype=torch.float32,
+        use_safetensors=True
+    )
+    pipe.to(torch.device("cpu"))
+    pipe.enable_attention_slicing()
+    warm_up(prior_embeddings, pipe)
+    return pipe
+
+# MagicBrush pipeline
+def load_magicbrush():
+    pipe = StableDiffusionInstructPix2PixPipeline.from_pretrained(
+        "vinesmsuic/magicbrush-jul7",
+        torch_dtype=torch.float32,
+        use_safetensors=False
+    ).to(device)
+    pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
+    pipe.enable_attention_slicing()
+    warm_up(text_embeddings, "magicbrush", pipe)
+    return pipe
+
+# Estimates (float32) only decide evictions before a pipeline's first load
+models = ModelRegistry(budget_bytes=int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024))
+models.register("pix2pix", load_pix2pix, estimate_mb=4300)
+models.register("img2img", load_img2img, estimate_mb=12000)
+models.register("magicbrush", load_magicbrush, estimate_mb=4300)
+
+preload = list(models.loaders) if MODEL_PRELOAD.strip() == "all" else [n.strip() for n in MODEL_PRELOAD.split(",") if n.strip()]
+unknown = [n for n in preload if n not in models.loaders]
+if unknown:
+    raise ValueError(f"MODEL_PRELOAD: unknown pipelines {unknown}, expected any of {list(models.loaders)}")
+if preload:
+    threading.Thread(target=models.preload, args=(preload,), name="model-preload", daemon=True).start()
+print(f"Model registry ready (budget: {MODEL_MEMORY_BUDGET_MB or 'unlimited'} MB, preload: {preload or 'none'}).")
 
 # Request data schemas
 class ImageData(BaseModel):
@@ -85,6 +176,12 @@ class ImageData(BaseModel):
 class TransformRequest(BaseModel):
     occupation: str
     images: ImageData
+    seed: Optional[int] = None  # random if omitted (MagicBrush: 42)
+
+class MultiTransformRequest(BaseModel):
+    occupations: List[str]
+    images: ImageData
+    seed: Optional[int] = None  # shared by all occupations, so they start from the same noise
 
 # Helper to download image from a URL
 def download_image(url):
@@ -104,25 +201,120 @@ def upload_to_firebase(image: Image.Image) -> str:
     blob.make_public()
     return blob.public_url
 
-# Limit concurrent model executions
-MAX_CONCURRENT_REQUESTS = 2
-pix2pix_sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-img2img_sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-magicbrush_sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# Inference runs on per-pipeline worker threads, never on the event loop.
+# Up to INFERENCE_WORKERS requests run per pipeline with INFERENCE_QUEUE_DEPTH more
+# waiting; beyond that requests get 503 with a Retry-After header.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_DEPTH = int(os.getenv("INFERENCE_QUEUE_DEPTH", "4"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+# Pix2Pix and MagicBrush requests arriving within BATCH_MAX_WAIT_MS of each other
+# share one pipeline call of up to BATCH_MAX_SIZE images (1 disables batching)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+# Image downloads and Firebase uploads
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+async def run_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, fn, *args)
+
+@app.exception_handler(QueueFull)
+async def queue_full(request: Request, exc: QueueFull):
+    print(f"⏳ [{exc.name}] Queue full, rejecting request")
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+# Blocking pipeline calls, run on the model's worker threads.
+# Batched calls take (prompts, image, seed) items, one per request, and return
+# one list of images per item (one image per prompt).
+def encode_image(pipe, image: Image.Image) -> torch.Tensor:
+    """VAE latents of `image`, as InstructPix2Pix conditions on them (unscaled mode)."""
+    pixels = pipe.image_processor.preprocess(image).to(device=pipe.device, dtype=pipe.vae.dtype)
+    with torch.no_grad():
+        return pipe.vae.encode(pixels).latent_dist.mode()
+
+def run_instruct_batch(name: str, items: List[tuple], **kwargs) -> List[List[Image.Image]]:
+    prompts = [prompt for item_prompts, _, _ in items for prompt in item_prompts]
+    # A generator per image, so each result only depends on its own seed
+    generators = [torch.Generator(device).manual_seed(seed) for item_prompts, _, seed in items for _ in item_prompts]
+    with models.use(name) as pipe:
+        # Each request's image goes through the VAE once, however many prompts it has;
+        # the pipeline takes 4-channel input as ready-made image latents
+        image_latents = torch.cat([
+            encode_image(pipe, image).expand(len(item_prompts), -1, -1, -1)
+            for item_prompts, image, _ in items
+        ])
+        prompt_embeds, negative_prompt_embeds = text_embeddings(name, pipe, prompts)
+        images = pipe(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            image=image_latents,
+            num_inference_steps=10,
+            generator=generators,
+            **kwargs
+        ).images
+    out, i = [], 0
+    for item_prompts, _, _ in items:
+        out.append(images[i:i + len(item_prompts)])
+        i += len(item_prompts)
+    return out
+
+def run_pix2pix_batch(items: List[tuple]) -> List[List[Image.Image]]:
+    return run_instruct_batch("pix2pix", items, image_guidance_scale=1)
+
+def run_img2img(prompts: List[str], image: Image.Image) -> List[Image.Image]:
+    with models.use("img2img") as img2img:
+        image_embeds, negative_image_embeds = prior_embeddings(img2img, prompts)
+        # The decoder alone: the prior's work is in the embeddings, and one input
+        # image is encoded once for every prompt
+        return img2img.decoder_pipe(
+            image=image,
+            image_embeds=image_embeds,
+            negative_image_embeds=negative_image_embeds,
+            strength=0.75,
+            guidance_scale=1,
+            num_inference_steps=10
+        ).images
+
+def run_magicbrush_batch(items: List[tuple]) -> List[List[Image.Image]]:
+    return run_instruct_batch("magicbrush", items, image_guidance_scale=1, guidance_scale=7)
+
+def image_size(item: tuple):
+    # Only same-sized images can be stacked into one batch
+    return item[1].size
+
+def image_count(item: tuple) -> int:
+    return len(item[0])
+
+batch_options = dict(key=image_size, weight=image_count, workers=INFERENCE_WORKERS, depth=INFERENCE_QUEUE_DEPTH,
+                     max_batch=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT_MS / 1000)
+queues = {
+    "pix2pix": BatchedModelQueue("pix2pix", run_pix2pix_batch, **batch_options),
+    "img2img": ModelQueue("img2img", workers=INFERENCE_WORKERS, depth=INFERENCE_QUEUE_DEPTH),
+    "magicbrush": BatchedModelQueue("magicbrush", run_magicbrush_batch, **batch_options),
+}
 
 # Health check route
 @app.get("/")
 async def root():
     return {"message": "Pix2Pix + Img2Img API running"}
 
+# Loaded pipelines, their memory footprint and queues
+@app.get("/models")
+async def list_models():
+    status = models.status()
+    for name, queue in queues.items():
+        status[name]["queue"] = queue.status()
+    return {"budget_mb": MODEL_MEMORY_BUDGET_MB, "models": status, "prompt_cache": prompt_cache.status()}
+
 # Transform using InstructPix2Pix
 @app.post("/transform-image")
 async def transform_image(data: TransformRequest):
-    async with pix2pix_sem:
+    queue = queues["pix2pix"]
+    with queue.admit():
         try:
-            image = download_image(data.images.url)
-            out = pix2pix(f"A photo of a {data.occupation}", image=image, num_inference_steps=10, image_guidance_scale=1).images[0]
-            firebase_url = upload_to_firebase(out)
+            image = await run_io(download_image, data.images.url)
+            seed = data.seed if data.seed is not None else random.getrandbits(32)
+            out = (await queue.submit(([occupation_prompt(data.occupation)], image, seed)))[0]
+            firebase_url = await run_io(upload_to_firebase, out)
             return {
                 "transform": {
                     "occupation": data.occupation,
@@ -136,12 +328,13 @@ async def transform_image(data: TransformRequest):
 # Transform using Img2Img
 @app.post("/transform-img2img")
 async def transform_img2img(data: TransformRequest):
-    async with img2img_sem:
+    queue = queues["img2img"]
+    with queue.admit():
         try:
             print(f"▶️ [Img2Img] Start transforming for occupation: {data.occupation}")
-            image = download_image(data.images.url).resize((384, 384))
-            out = img2img(f"A photo of a {data.occupation}", image=image, strength=0.75, guidance_scale=1, num_inference_steps=10).images[0]
-            firebase_url = upload_to_firebase(out)
+            image = (await run_io(download_image, data.images.url)).resize((384, 384))
+            out = (await queue.run(run_img2img, [occupation_prompt(data.occupation)], image))[0]
+            firebase_url = await run_io(upload_to_firebase, out)
             print(f"✅ [Img2Img] Done transforming: {firebase_url}")
             return {
                 "transform": {
@@ -156,12 +349,14 @@ async def transform_img2img(data: TransformRequest):
 # Transform using MagicBrush
 @app.post("/transform-magicbrush")
 async def transform_magicbrush(data: TransformRequest):
-    async with magicbrush_sem:
+    queue = queues["magicbrush"]
+    with queue.admit():
         try:
             print(f"▶️ [MagicBrush] Start transforming for occupation: {data.occupation}")
-            image = download_image(data.images.url)
-            out = magicbrush(f"A photo of a {data.occupation}", image=image, num_inference_steps=10, image_guidance_scale=1, guidance_scale=7, generator=torch.manual_seed(42)).images[0]
-            firebase_url = upload_to_firebase(out)
+            image = await run_io(download_image, data.images.url)
+            seed = data.seed if data.seed is not None else 42
+            out = (await queue.submit(([occupation_prompt(data.occupation)], image, seed)))[0]
+            firebase_url = await run_io(upload_to_firebase, out)
             print(f"✅ [MagicBrush] Done transforming: {firebase_url}")
             return {
                 "transform": {
@@ -173,6 +368,53 @@ async def transform_magicbrush(data: TransformRequest):
             print(f"❌ [MagicBrush] Failed transforming: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
+# Transform one image into several occupations: one download, one image encoding and
+# one batched pipeline call
+MAX_OCCUPATIONS = int(os.getenv("MAX_OCCUPATIONS", "16"))
+
+async def transform_occupations(name: str, label: str, data: MultiTransformRequest, default_seed: Optional[int] = None):
+    if not data.occupations or len(data.occupations) > MAX_OCCUPATIONS:
+        raise HTTPException(status_code=400, detail=f"occupations must list 1 to {MAX_OCCUPATIONS} occupations")
+    queue = queues[name]
+    with queue.admit():
+        try:
+            print(f"▶️ [{label}] Start transforming for occupations: {', '.join(data.occupations)}")
+            image = await run_io(download_image, data.images.url)
+            prompts = [occupation_prompt(occupation) for occupation in data.occupations]
+            if isinstance(queue, BatchedModelQueue):
+                seed = data.seed if data.seed is not None else default_seed
+                if seed is None:
+                    seed = random.getrandbits(32)
+                outs = await queue.submit((prompts, image, seed))
+            else:
+                outs = await queue.run(run_img2img, prompts, image.resize((384, 384)))
+            firebase_urls = await asyncio.gather(*(run_io(upload_to_firebase, out) for out in outs))
+            print(f"✅ [{label}] Done transforming {len(firebase_urls)} occupations")
+            return {
+                "transforms": [
+                    {
+                        "occupation": occupation,
+                        "images": {"original": data.images.url, "url": firebase_url}
+                    }
+                    for occupation, firebase_url in zip(data.occupations, firebase_urls)
+                ]
+            }
+        except Exception as e:
+            print(f"❌ [{label}] Failed transforming: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/transform-image/batch")
+async def transform_image_batch(data: MultiTransformRequest):
+    return await transform_occupations("pix2pix", "Pix2Pix", data)
+
+@app.post("/transform-img2img/batch")
+async def transform_img2img_batch(data: MultiTransformRequest):
+    return await transform_occupations("img2img", "Img2Img", data)
+
+@app.post("/transform-magicbrush/batch")
+async def transform_magicbrush_batch(data: MultiTransformRequest):
+    return await transform_occupations("magicbrush", "MagicBrush", data, default_seed=42)
+
 # Optional: DiffEdit route placeholder (currently disabled)
 # diffedit_pipe = StableDiffusionDiffEditPipeline.from_pretrained(
 #     "stabilityai/stable-diffusion-2-1", 
@@ -0,0 +1,139 @@
+# model_registry.py
+
+import gc
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List
+
+import torch
+
+
+def pipeline_bytes(pipe) -> int:
+    """Bytes held by the parameters and buffers of a pipeline's torch modules (shared tensors counted once)."""
+    seen, total = set(), 0
+    for component in pipe.components.values():
+        if not isinstance(component, torch.nn.Module):
+            continue
+        for t in list(component.parameters()) + list(component.buffers()):
+            if t.data_ptr() in seen:
+                continue
+            seen.add(t.data_ptr())
+            total += t.numel() * t.element_size()
+    return total
+
+
+class ModelRegistry:
+    """
+    Loads diffusion pipelines on first use and keeps them under a memory budget.
+
+    Every pipeline is registered with a loader and a rough size estimate; the
+    measured size replaces the estimate after the first load. When loading a
+    pipeline would exceed `budget_bytes`, the least-recently-used pipelines not
+    currently running a request are dropped first. A budget of 0 never evicts.
+    """
+    def __init__(self, budget_bytes: int = 0):
+        self.budget_bytes = budget_bytes
+        self.loaders: Dict[str, Callable] = {}
+        self.sizes: Dict[str, int] = {}
+        self.loaded: "OrderedDict[str, object]" = OrderedDict()  # least recently used first
+        self.pins: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.load_locks: Dict[str, threading.Lock] = {}
+
+    def register(self, name: str, loader: Callable, estimate_mb: float = 0):
+        self.loaders[name] = loader
+        self.sizes[name] = int(estimate_mb * 1024 * 1024)
+        self.pins[name] = 0
+        self.load_locks[name] = threading.Lock()
+
+    def _pin(self, name: str):
+        """The loaded pipeline `name`, marked in use and most recently used (call with self.lock held)."""
+        pipe = self.loaded.get(name)
+        if pipe is not None:
+            self.loaded.move_to_end(name)
+            self.pins[name] += 1
+        return pipe
+
+    def _make_room(self, incoming: int, keep: str) -> List[str]:
+        """Drop idle pipelines, oldest first, until `incoming` more bytes fit (call with self.lock held)."""
+        evicted = []
+        if self.budget_bytes <= 0:
+            return evicted
+        while sum(self.sizes[n] for n in self.loaded) + incoming > self.budget_bytes:
+            idle = [n for n in self.loaded if n != keep and self.pins[n] == 0]
+            if not idle:
+                print("[ModelRegistry] Memory budget exceeded, but no idle pipeline left to evict")
+                break
+            self.loaded.pop(idle[0])
+            evicted.append(idle[0])
+        return evicted
+
+    def _release_memory(self, evicted: List[str]):
+        if not evicted:
+            return
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"[ModelRegistry] Evicted {', '.join(evicted)}")
+
+    def _acquire(self, name: str):
+        if name not in self.loaders:
+            raise KeyError(f"Unknown pipeline: {name}")
+        with self.lock:
+            pipe = self._pin(name)
+        if pipe is not None:
+            return pipe
+
+        # One loader per pipeline; concurrent first requests wait for it
+        with self.load_locks[name]:
+            with self.lock:
+                pipe = self._pin(name)
+                evicted = [] if pipe is not None else self._make_room(self.sizes[name], keep=name)
+            self._release_memory(evicted)
+            if pipe is not None:
+                return pipe
+
+            print(f"[ModelRegistry] Loading {name}...")
+            start = time.perf_counter()
+            pipe = self.loaders[name]()
+            with self.lock:
+                self.sizes[name] = pipeline_bytes(pipe)
+                self.loaded[name] = pipe
+                self.pins[name] += 1
+                # The estimate may have been too low
+                evicted = self._make_room(0, keep=name)
+            self._release_memory(evicted)
+            print(f"[ModelRegistry] {name} ready in {time.perf_counter() - start:.1f}s "
+                  f"({self.sizes[name] / 1024 ** 2:.0f} MB)")
+            return pipe
+
+    @contextmanager
+    def use(self, name: str):
+        """The pipeline `name`, loaded if needed; it cannot be evicted inside the block."""
+        pipe = self._acquire(name)
+        try:
+            yield pipe
+        finally:
+            with self.lock:
+                self.pins[name] -= 1
+
+    def preload(self, names: Iterable[str]):
+        for name in names:
+            try:
+                with self.use(name):
+                    pass
+            except Exception as e:
+                print(f"❌ [ModelRegistry] Failed preloading {name}: {str(e)}")
+
+    def status(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                name: {
+                    "loaded": name in self.loaded,
+                    "in_use": self.pins[name],
+                    "size_mb": round(self.sizes[name] / 1024 ** 2),
+                }
+                for name in self.loaders
+            }
@@ -0,0 +1,51 @@
+# prompt_cache.py
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of prompt embeddings keyed by (model, prompt).
+
+    get_many() returns one embedding per prompt and calls `encode` once, for
+    all missing prompts together. At most `max_entries` embeddings are kept,
+    least recently used dropped first; 0 disables caching. Entries outlive
+    the model's eviction from the ModelRegistry, since they only depend on its weights.
+    """
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()  # least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, model: str, prompts: List[str], encode: Callable[[List[str]], List[Any]]) -> List[Any]:
+        """Embeddings of `prompts` for `model`; `encode(prompts)` returns one embedding per prompt."""
+        found: Dict[str, Any] = {}
+        with self.lock:
+            for prompt in prompts:
+                value = self.entries.get((model, prompt))
+                if value is not None:
+                    self.entries.move_to_end((model, prompt))
+                    found[prompt] = value
+            missing = list(dict.fromkeys(p for p in prompts if p not in found))
+            self.hits += len(prompts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            # Encoded outside the lock: other pipelines keep using the cache meanwhile
+            values = encode(missing)
+            found.update(zip(missing, values))
+            with self.lock:
+                for prompt, value in zip(missing, values):
+                    self.entries[(model, prompt)] = value
+                    self.entries.move_to_end((model, prompt))
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return [found[p] for p in prompts]
+
+    def status(self) -> Dict[str, int]:
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
@@ -143,14 +143,32 @@ app.post('/refresh-image', async (req, res) => {
 
 /**
  * POST /analyze-bias
- * Sends transformed images and original images to bias analysis backend
+ * Submits transformed images and original images to the bias analysis backend,
+ * then polls its job endpoint until the analysis finishes
  */
+const BIAS_POLL_INTERVAL_MS = 2000;
+const BIAS_POLL_TIMEOUT_MS = 30 * 60 * 1000;
+
+// Job status URL next to the submit endpoint, keeping any proxy path prefix
+// (https://host/bias/analyze_bias -> https://host/bias/jobs/<id>)
+const biasJobUrl = (jobId) =>
+  new URL(`jobs/${encodeURIComponent(jobId)}`, BIAS_API_URL.replace(/analyze[-_]bias\/?$/, '')).href;
+
 app.post('/analyze-bias', async (req, res) => {
   try {
-    const response = await axios.post(BIAS_API_URL, req.body, {
+    const submitted = await axios.post(BIAS_API_URL, req.body, {
       headers: { 'Content-Type': 'application/json' }
     });
-    res.status(response.status).json(response.data);
+    const jobUrl = biasJobUrl(submitted.data.job_id);
+    const deadline = Date.now() + BIAS_POLL_TIMEOUT_MS;
+
+    while (Date.now() < deadline) {
+      const { data } = await axios.get(jobUrl);
+      if (data.status === 'bias_analyzed') return res.json(data);
+      if (data.status === 'failed') return res.status(500).json({ error: data.error || 'Processing failed' });
+      await new Promise(resolve => setTimeout(resolve, BIAS_POLL_INTERVAL_MS));
+    }
+    res.status(504).json({ error: 'Bias analysis timed out' });
   } catch (err) {
     console.error('❌ [Express->Render] analyze-bias failed:', err?.response?.data || err.message);
     if (err.response) res.status(err.response.status).json(err.response.data);